@@ -53,7 +53,8 @@ def get_status_fields_for_form(redcap_api, form_name):
 
     Returns a dict with 'completeness' and 'missingness' keys.
     """
-    datadict = redcap_api.export_metadata(format_type='df').reset_index()
+    # Use the (possibly cached) metadata of the project instead of exporting it again
+    datadict = pd.DataFrame(redcap_api.metadata)
     form_datadict = datadict.loc[datadict['form_name'] == form_name, :]
     if form_datadict.empty:
         raise NameError('{}: No such form in selected API!'.format(form_name))
@@ -0,0 +1,238 @@
+##
+##  See COPYING file distributed along with the package for the copyright and license terms
+##
+"""
+Cases Manifest
+==============
+SQLite manifest of the files written to a cases directory. For each output
+file it records the path (relative to the cases directory), size, mtime,
+sha1 of the content, the version of the export plan (see
+redcap_to_casesdir.ExportPlan), the export that wrote it and optionally a
+hash of the inputs the file was generated from (e.g., the metadata of a
+data dictionary).
+
+Writers pass the view returned by CasesManifest.digests to
+utils.safe_dataframe_to_csv, which then skips unchanged files without
+reading or writing them and records changed ones. Changes are collected in a
+transaction that is committed by CasesManifest.commit (or when leaving a
+with block), so that the manifest always reflects complete subject-visits.
+
+Usage:
+    manifest = CasesManifest('/fs/cases/.manifest.sqlite', '/fs/cases')
+    with manifest:
+        sutils.safe_dataframe_to_csv(df, path, digests=manifest.digests(plan.version, 'stroop'))
+    manifest.get_outdated({'stroop': plan.version})
+"""
+import os
+import sqlite3
+import datetime
+
+from sibispy import utils as sutils
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    plan_version TEXT,
+    export_name TEXT,
+    updated TEXT NOT NULL,
+    source_hash TEXT
+)
+"""
+
+COLUMNS = ['path', 'size', 'mtime_ns', 'sha1', 'plan_version', 'export_name', 'updated', 'source_hash']
+
+
+class CasesManifest(object):
+    def __init__(self, manifest_file, cases_dir, timeout=60):
+        """
+        manifest_file: the SQLite file (created if missing), which should be
+                       on a local file system
+        cases_dir: the directory the paths of the manifest are relative to
+        timeout: seconds to wait for a concurrent writer to commit
+        """
+        self.manifest_file = str(manifest_file)
+        self.cases_dir = os.path.abspath(str(cases_dir))
+        self.timeout = timeout
+        self.__conn = None
+        self.__pid = None
+
+    # the connection is not shared with worker processes, they open their own
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_CasesManifest__conn'] = None
+        state['_CasesManifest__pid'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def __connection__(self):
+        self.__forget_inherited_connection__()
+        if self.__conn is None:
+            self.__conn = sqlite3.connect(self.manifest_file, timeout=self.timeout)
+            self.__conn.execute(SCHEMA)
+            # manifests written before source_hash was added
+            columns = [row[1] for row in self.__conn.execute("PRAGMA table_info(files)")]
+            if 'source_hash' not in columns:
+                self.__conn.execute("ALTER TABLE files ADD COLUMN source_hash TEXT")
+            self.__conn.commit()
+            self.__pid = os.getpid()
+        return self.__conn
+
+    # SQLite connections must not be used across a fork: a forked (worker)
+    # process drops the connection of its parent without closing it
+    def __forget_inherited_connection__(self):
+        if self.__conn is not None and self.__pid != os.getpid():
+            self.__conn = None
+            self.__pid = None
+
+    def close(self):
+        self.__forget_inherited_connection__()
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+
+    def commit(self):
+        self.__forget_inherited_connection__()
+        if self.__conn is not None:
+            self.__conn.commit()
+
+    def rollback(self):
+        self.__forget_inherited_connection__()
+        if self.__conn is not None:
+            self.__conn.rollback()
+
+    def get_relative_path(self, path):
+        return os.path.relpath(os.path.abspath(str(path)), self.cases_dir)
+
+    def get_entry(self, path):
+        """
+        Entry of a file as dict (keys: see COLUMNS) or None
+        """
+        row = self.__connection__().execute(
+            "SELECT " + ", ".join(COLUMNS) + " FROM files WHERE path = ?",
+            (self.get_relative_path(path),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(COLUMNS, row))
+
+    def record(self, path, sha1=None, plan_version=None, export_name=None, source_hash=None):
+        """
+        Add or update the entry of a (just written) file; sha1 is computed
+        from the content of the file if not given
+        """
+        if sha1 is None:
+            with open(str(path), 'rb') as fd:
+                sha1 = sutils.get_csv_digest(fd.read())
+        stat = os.stat(str(path))
+        self.__connection__().execute(
+            "INSERT OR REPLACE INTO files (" + ", ".join(COLUMNS) + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.get_relative_path(path), stat.st_size, stat.st_mtime_ns, sha1, plan_version,
+             export_name, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), source_hash))
+
+    def remove(self, paths):
+        self.__connection__().executemany("DELETE FROM files WHERE path = ?",
+                                          [(self.get_relative_path(path),) for path in paths])
+
+    def is_modified(self, path, entry):
+        """
+        Whether the file was changed or deleted since its entry was recorded
+        (compares size and mtime only)
+        """
+        try:
+            stat = os.stat(os.path.join(self.cases_dir, self.get_relative_path(path)))
+        except OSError:
+            return True
+        return stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime_ns']
+
+    def digests(self, plan_version=None, export_name=None, source_hash=None):
+        """
+        Mapping of file name to sha1 for utils.safe_dataframe_to_csv; files
+        written by another plan version or modified since they were recorded
+        (size or mtime differ) count as unknown (i.e., they are compared to
+        the file on disk once); source_hash is recorded with the written files
+        """
+        return ManifestDigests(self, plan_version, export_name, source_hash)
+
+    def get_paths(self, prefix=None):
+        """
+        Paths of the manifest, e.g., of a subject-visit with prefix
+        'A-00001-F-1/standard/baseline'
+        """
+        sql = "SELECT path FROM files"
+        params = ()
+        if prefix:
+            sql += " WHERE path LIKE ? ESCAPE '\\'"
+            escaped = prefix.rstrip('/').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params = (escaped + '/%',)
+        return [row[0] for row in self.__connection__().execute(sql + " ORDER BY path", params)]
+
+    def get_outdated(self, plan_versions):
+        """
+        Paths written by an export whose plan changed since
+        (plan_versions: dict of export name to current plan version)
+        """
+        outdated = []
+        for (path, plan_version, export_name) in self.__connection__().execute(
+                "SELECT path, plan_version, export_name FROM files ORDER BY path"):
+            if export_name in plan_versions and plan_versions[export_name] != plan_version:
+                outdated.append(path)
+        return outdated
+
+    def get_modified(self, prefix=None):
+        """
+        Paths whose file was changed or deleted since it was recorded
+        (compares size and mtime only)
+        """
+        entries = self.__connection__().execute("SELECT path, size, mtime_ns FROM files ORDER BY path")
+        paths = set(self.get_paths(prefix)) if prefix else None
+        modified = []
+        for (path, size, mtime_ns) in entries:
+            if paths is not None and path not in paths:
+                continue
+            if self.is_modified(os.path.join(self.cases_dir, path), dict(size=size, mtime_ns=mtime_ns)):
+                modified.append(path)
+        return modified
+
+    def get_updated_since(self, since):
+        """
+        Paths recorded at or after the datetime since
+        """
+        return [row[0] for row in self.__connection__().execute(
+            "SELECT path FROM files WHERE updated >= ? ORDER BY path",
+            (since.strftime('%Y-%m-%d %H:%M:%S'),))]
+
+
+class ManifestDigests(object):
+    """
+    Digests of the files of a manifest for utils.safe_dataframe_to_csv
+    """
+    def __init__(self, manifest, plan_version=None, export_name=None, source_hash=None):
+        self.manifest = manifest
+        self.plan_version = plan_version
+        self.export_name = export_name
+        self.source_hash = source_hash
+
+    def get(self, path, default=None):
+        entry = self.manifest.get_entry(path)
+        if entry is None or entry['plan_version'] != self.plan_version:
+            return default
+        # the file was changed or deleted since it was recorded
+        if self.manifest.is_modified(path, entry):
+            return default
+        return entry['sha1']
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def __setitem__(self, path, sha1):
+        self.manifest.record(path, sha1, self.plan_version, self.export_name, self.source_hash)
@@ -156,7 +156,13 @@ if not redcap_project :
 
     sys.exit()
 
-form_event_mapping = redcap_project.export_instrument_event_mappings(format_type='df')
+form_event_mapping = session.redcap_export_instrument_event_mappings('data_entry')
+if form_event_mapping is None :
+    if args.verbose:
+        print("Error: Could not export the instrument event mappings of Data Entry")
+
+    sys.exit(1)
+
 fem_form_key = session.get_redcap_form_key()
 #
 # MAIN LOOP
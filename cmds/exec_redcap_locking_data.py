@@ -8,6 +8,7 @@ from sibispy import cli
 from sibispy import sibislogger as slog
 from sibispy import redcap_locking_data 
 import pandas as pd
+from sqlalchemy import text
 
 def get_site_subjs_from_sql(session, engine, site):
     """
@@ -16,22 +17,20 @@ def get_site_subjs_from_sql(session, engine, site):
     """
     site = site[0].upper()
 
-    # Create a connection and execute a query
-  
-    query = """
-        SELECT * FROM 
+    # Only select the columns needed and return the connection to the pool
+    query = text("""
+        SELECT DISTINCT t1.record, t2.group_name FROM 
             redcap_data as t1
         INNER JOIN
             redcap_data_access_groups as t2
         ON
-            t1.field_name = "__GROUPID__" and t1.value = t2.group_id
+            t1.field_name = '__GROUPID__' and t1.value = t2.group_id
         WHERE 
             t1.project_id = 20;
-    """
-    df = pd.read_sql_query(query, engine.connect())
+    """)
+    with engine.connect() as conn:
+        df = pd.read_sql_query(query, conn)
 
-    # drop unneeded columns and duplicates
-    df = df[['record', 'group_name']].drop_duplicates()
     # store only the group_name from argument
     df = df[df['group_name'].str.upper() == site].reset_index()
 
@@ -74,50 +73,62 @@ def main(args=None):
     if subject_list is None:
         if args.site:
             subject_list = get_site_subjs_from_sql(session, engine, args.site)
-        else:
-            subject_list = [None]
     else:
         print("INFO: kp: I do not think it works if subjects are defined")
 
-    for event_desc in args.event:
-        if args.verbose: 
-            print("Visit: {0}".format(event_desc))
-
-        if args.lock:
-            if args.verbose:
-                print("Attempting to lock form: {0}".format(args.form))
-
-            for sid in subject_list:
-                for form in args.form:
-                    locked_record_num = red_lock.lock_form(args.project, args.arm, event_desc, form, outfile=args.outfile, subject_id=sid)
-                    slog.takeTimer1("script_time", "{'records': " + str(locked_record_num) + "}")
-                    if args.verbose:
-                        print("The {0} form has been locked for {1}".format(form, sid))
-                        print("Record of locked files: {0}".format(args.outfile))
-
-        elif args.unlock:
-            if args.verbose:
-                print("Attempting to unlock form: {0}".format(args.form))
-                
-            for sid in subject_list:
-                for form in args.form:
-                    if not red_lock.unlock_form(args.project, args.arm, event_desc, form, subject_id=sid):
-                        if sid:
-                            print("Warning: Nothing to unlock! Form '{0}' or subject '{1}' might not exist".format(form, sid))
-                        else:
-                            print("Warning: Nothing to unlock! Form '{0}' might not exist".format(form))
-                    elif args.verbose:
-                        print("The {0} form has been unlocked for {1}".format(form, sid))
-
-        elif args.report:
-            if not args.subject_id:
-                raise NotImplementedError("Cannot create report if no subject ID is passed!")
-            form_array = args.form
-            if args.verbose:
-                print("Attempting to create a report for form(s) {0} and subject_id {1} ".format(form_array,args.subject_id))
-            for subject in args.subject_id:
-                # FIXME: Currently, Session.get_mysql_table_records cannot take multiple subject IDs
-                print(red_lock.report_locked_forms(subject, subject, form_array, args.project, args.arm, event_desc))
+    if args.lock:
+        if args.verbose:
+            print("Attempting to lock form(s) {0} of visit(s) {1}".format(args.form, args.event))
+
+        # all events, forms and subjects are locked in a single transaction
+        locked_counts = red_lock.lock_forms(args.project, args.arm, args.event, args.form,
+                                            subject_ids=subject_list, outfile=args.outfile,
+                                            sync=args.sync)
+        slog.takeTimer1("script_time", "{'records': " + str(sum(locked_counts.values())) + "}")
+        if args.verbose:
+            for form, count in locked_counts.items():
+                print("The {0} form has been locked for {1} record(s)".format(form, count))
+            print("Record of locked files: {0}".format(args.outfile))
+
+    elif args.unlock:
+        if args.verbose:
+            print("Attempting to unlock form(s) {0} of visit(s) {1}".format(args.form, args.event))
+
+        unlocked_counts = red_lock.unlock_forms(args.project, args.arm, args.event, args.form,
+                                                subject_ids=subject_list)
+        for form, count in unlocked_counts.items():
+            if not count:
+                if subject_list:
+                    print("Warning: Nothing to unlock! Form '{0}' or subject(s) '{1}' might not exist".format(form, subject_list))
+                else:
+                    print("Warning: Nothing to unlock! Form '{0}' might not exist".format(form))
+            elif args.verbose:
+                print("The {0} form has been unlocked for {1} record(s)".format(form, count))
+
+    elif args.report:
+        form_array = args.form
+        if not args.subject_id:
+            # all subjects (of the site) in a single pivot of the lock table
+            event_dict = red_lock.get_event_names_for_ids()
+            for event_desc in args.event:
+                if args.verbose:
+                    print("Visit: {0}".format(event_desc))
+                lock_data = session.get_mysql_table_records('redcap_locking_data', args.project, args.arm,
+                                                            event_desc, subject_id=subject_list)
+                if lock_data.empty:
+                    print("No locked forms")
+                    continue
+                report = red_lock.report_locked_forms_batch(args.project, form_array,
+                                                            lock_data.merge(event_dict, how='left'))
+                print(report.to_string())
+        else:
+            for event_desc in args.event:
+                if args.verbose:
+                    print("Visit: {0}".format(event_desc))
+                    print("Attempting to create a report for form(s) {0} and subject_id {1} ".format(form_array,args.subject_id))
+                for subject in args.subject_id:
+                    # FIXME: Currently, Session.get_mysql_table_records cannot take multiple subject IDs
+                    print(red_lock.report_locked_forms(subject, subject, form_array, args.project, args.arm, event_desc))
 
     if args.verbose:
         print("Done!")
@@ -150,6 +161,8 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--outfile", dest="outfile",
                         default='/tmp/locked_records.csv',
                         help="Path to scratch-write current locked records file. {0}".format(default))
+    parser.add_argument("--sync", dest="sync", action="store_true",
+                        help="With --lock: only add missing locks and remove obsolete ones instead of re-locking all records (keeps existing lock timestamps)")
     action_group = parser.add_argument_group('Action parameters', '(Mutually exclusive)')
     action_group_exclusives = action_group.add_mutually_exclusive_group(required=True)
     action_group_exclusives.add_argument("--lock", dest="lock", action="store_true", help="Lock form(s)")
@@ -9,6 +9,7 @@ from __future__ import print_function
 from builtins import str
 import sys
 import argparse
+import datetime
 
 import pandas
 import sibispy
@@ -40,9 +41,15 @@ parser.add_argument("-a", "--update-all",
                          "(otherwise, only update records where incoming data completion status "
                          "exceeds existing summary data status)",
                     action="store_true")
+parser.add_argument("--incremental",
+                    help="Only score records that changed since the last successful incremental run.",
+                    action="store_true")
 parser.add_argument("-n", "--no-upload",
                     help="Do not upload any scores to REDCap server; instead write to CSV file with given path.",
                     action="store")
+parser.add_argument("-w", "--import-workers",
+                    help="Number of batches uploaded to REDCap in parallel.",
+                    action="store", type=int, default=None)
 parser.add_argument("-p", "--post-to-github", help="Post all issues to GitHub instead of std out.", action="store_true")
 parser.add_argument("-t", "--time-log-dir",
                     help="If set then time logs are written to that directory",
@@ -93,6 +100,15 @@ if args.event_list:
 else:
     event_list = None
 
+# Incremental runs restrict scoring to records changed since the last successful run
+since = None
+run_start = datetime.datetime.now()
+if args.incremental:
+    since = session.get_redcap_checkpoint('redcap_update_summary_scores')
+    if args.verbose:
+        print("Scoring records changed since", since)
+run_failed = False
+
 for instrument in instrument_list:
     slog.startTimer2()
     if args.verbose:
@@ -100,17 +116,19 @@ for instrument in instrument_list:
 
     if 'lifetime' in instrument:
         (scored_records, errorFlag) = red_score_update.compute_lifetime_summary_scores(
-            instrument, subject_list,  event_list, args.update_all, args.verbose, log=slog)
+            instrument, subject_list,  event_list, args.update_all, args.verbose, log=slog, since=since)
         if errorFlag:
             if args.verbose:
                 print("Error occured when scoring lifetime", instrument) 
+            run_failed = True
             continue
     else:
         (scored_records, errorFlag) = red_score_update.compute_summary_scores(
-            instrument, subject_list,  event_list, args.update_all, args.verbose, log=slog)
+            instrument, subject_list,  event_list, args.update_all, args.verbose, log=slog, since=since)
         if errorFlag:
             if args.verbose:
                 print("Error occured when scoring", instrument) 
+            run_failed = True
             continue
 
     len_scored_records = len(scored_records)
@@ -126,8 +144,9 @@ for instrument in instrument_list:
         scored_records.to_csv(args.no_upload)
         continue  
 
-    uploaded = red_score_update.upload_summary_scores_to_redcap(instrument,scored_records)
+    uploaded = red_score_update.upload_summary_scores_to_redcap(instrument,scored_records,args.import_workers)
     if not uploaded :
+        run_failed = True
         if args.verbose and args.subject_id and not event_list:
            print("The following record failed to be uploaded")
            print(scored_records)
@@ -150,4 +169,9 @@ for instrument in instrument_list:
         print (scored_records.sort_index())
     slog.takeTimer2(instrument + "_time","{'uploads': " +  str(count) + "}")
 
+# Only move the checkpoint forward if all instruments were scored and uploaded
+if (args.incremental and not run_failed and not args.no_upload
+        and not args.instruments and not args.subject_id and not event_list):
+    session.advance_redcap_checkpoint('redcap_update_summary_scores', run_start)
+
 slog.takeTimer1("script_time","{'records': " + str(len(instrument_list)) + ", 'uploads': " +  str(count_uploaded) + "}")
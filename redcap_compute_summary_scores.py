@@ -12,9 +12,8 @@ from builtins import object
 import os
 import re
 import sys
-import time
 import hashlib
-import urllib3
+import requests
 import pandas
 import numpy as np
 import redcap
@@ -74,7 +73,9 @@ class redcap_compute_summary_scores(object):
         if not self.__rc_summary:
             return False
             
-        self.__form_event_mapping = self.__rc_summary.export_instrument_event_mappings(format_type='df')
+        self.__form_event_mapping = self.__session.redcap_export_instrument_event_mappings(target_api)
+        if self.__form_event_mapping is None:
+            return False
 
         # Get record IDs and exclusions
         baseline_events = cfgParser.get_category('redcap_compute_summary_scores')['baseline_events'].split(",")
@@ -109,18 +110,19 @@ class redcap_compute_summary_scores(object):
                 matches.update([field_pattern])
         return matches
 
-    def __get_record_ids__(self, instrument_complete, subject_id=None, event_id=None):
-        """Retrieve REDCap record IDs for a given instrument, optionally filtered by subject or event."""
+    def __get_record_ids__(self, instrument_complete, subject_id=None, event_id=None, since=None):
+        """
+        Retrieve REDCap record IDs for a given instrument, optionally filtered by subject or event.
+        If since is set, only records created or modified after that datetime are returned.
+        """
+        select_stmt = dict(fields=[instrument_complete], event_name='unique', format_type='df')
         if subject_id:
-            if event_id:
-                return self.__rc_summary.export_records(
-                    fields=[instrument_complete], records=subject_id, events=event_id, event_name='unique', format_type='df')
-            return self.__rc_summary.export_records(
-                fields=[instrument_complete], records=subject_id, event_name='unique', format_type='df')
-        elif event_id:
-            return self.__rc_summary.export_records(
-                fields=[instrument_complete], events=event_id, event_name='unique', format_type='df')
-        return self.__rc_summary.export_records(fields=[instrument_complete], event_name='unique', format_type='df')
+            select_stmt['records'] = subject_id
+        if event_id:
+            select_stmt['events'] = event_id
+        if since:
+            select_stmt['date_begin'] = since
+        return self.__rc_summary.export_records(**select_stmt)
 
     def __get_import_fields__(self, instrument):
         """
@@ -136,28 +138,30 @@ class redcap_compute_summary_scores(object):
         return import_fields
 
     def __fetch_records__(self, record_ids, import_fields):
-        """Fetch imported record data from REDCap for specified IDs and fields in batches."""
+        """Fetch imported record data from REDCap for specified IDs and fields in batches (None if a batch failed)."""
         imported = []
         for event_name in set(record_ids.index.map(lambda key: key[1]).tolist()):
             records_this_event = record_ids.xs(event_name, level=1).index.tolist()
             for idx in range(0, len(records_this_event), 50):
-                i = 0
-                while i < 5:
-                    try:
-                        imported.append(
-                            self.__rc_summary.export_records(
-                                fields=import_fields,
-                                records=records_this_event[idx:idx + 50],
-                                events=[event_name],
-                                event_name='unique',
-                                format_type='df'
-                            )
+                # transient errors are retried by the session's redcap transport
+                try:
+                    imported.append(
+                        self.__rc_summary.export_records(
+                            fields=import_fields,
+                            records=records_this_event[idx:idx + 50],
+                            events=[event_name],
+                            event_name='unique',
+                            format_type='df'
                         )
-                    except urllib3.exceptions.MaxRetryError:
-                        i += 1
-                        time.sleep(12)
-                        continue
-                    break
+                    )
+                except requests.exceptions.RequestException as err_msg:
+                    # scoring without the batch would silently skip its records
+                    slog.info("redcap_compute_summary_scores.__fetch_records__",
+                              "ERROR: failed to export records from REDCap",
+                              event=event_name,
+                              records=str(records_this_event[idx:idx + 50]),
+                              err_msg=str(err_msg))
+                    return None
         return imported
 
     def __score_records__(self, instrument, imported):
@@ -173,7 +177,7 @@ class redcap_compute_summary_scores(object):
             slog.info(f"compute_summary_scores-{instrument}", "ERROR: scoring failed!", err_msg=str(e))
             return (pandas.DataFrame(), False)
 
-    def compute_summary_scores(self, instrument, subject_id=None, event_id=None, update_all=False, verbose=False, log=slog):
+    def compute_summary_scores(self, instrument, subject_id=None, event_id=None, update_all=False, verbose=False, log=slog, since=None):
         """Compute standard summary scores for an instrument across available REDCap records."""
         scored_records = pandas.DataFrame()
         if instrument not in self.get_list_of_instruments():
@@ -181,7 +185,11 @@ class redcap_compute_summary_scores(object):
             return (scored_records, True)
 
         instrument_complete = f'{instrument}_complete'
-        record_ids = self.__get_record_ids__(instrument_complete, subject_id, event_id)
+        record_ids = self.__get_record_ids__(instrument_complete, subject_id, event_id, since)
+        if record_ids.empty:
+            if verbose:
+                print("No records to score")
+            return (scored_records, False)
 
         ridx = record_ids.index
         if ridx.get_level_values(0).dtype != np.dtype(object):
@@ -214,9 +222,11 @@ class redcap_compute_summary_scores(object):
 
         import_fields = self.__get_import_fields__(instrument)
         imported = self.__fetch_records__(record_ids, import_fields)
+        if imported is None:
+            return (scored_records, True)
         return self.__score_records__(instrument, imported)
 
-    def compute_lifetime_summary_scores(self, instrument, subject_id=None, event_id=None, update_all=False, verbose=False, log=slog):
+    def compute_lifetime_summary_scores(self, instrument, subject_id=None, event_id=None, update_all=False, verbose=False, log=slog, since=None):
         """Compute lifetime summary scores for an instrument across all relevant REDCap events."""
         scored_records = pandas.DataFrame()
         if instrument not in self.get_list_of_instruments():
@@ -226,7 +236,11 @@ class redcap_compute_summary_scores(object):
         instrument_name = instrument.replace('_lifetime', '')
         instrument_complete = f'{instrument_name}_complete'
         # ALWAYS pull every event for the subject (Ignore event_id for the fetch step!)
-        record_ids = self.__get_record_ids__(instrument_complete, subject_id, event_id=None) 
+        record_ids = self.__get_record_ids__(instrument_complete, subject_id, event_id=None, since=since)
+        if record_ids.empty:
+            if verbose:
+                print("No records to score")
+            return (scored_records, False)
 
         ridx = record_ids.index
         if ridx.get_level_values(0).dtype != np.dtype(object):
@@ -249,6 +263,8 @@ class redcap_compute_summary_scores(object):
 
         import_fields = self.__get_import_fields__(instrument)
         imported = self.__fetch_records__(record_ids, import_fields)
+        if imported is None:
+            return (scored_records, True)
         scored_records_full, error_flag = self.__score_records__(instrument, imported)
 
         if error_flag:
@@ -267,5 +283,6 @@ class redcap_compute_summary_scores(object):
 
         return rows_to_push, False
 
-    def upload_summary_scores_to_redcap(self, instrument, scored_records):
-        return self.__session.redcap_import_record(instrument, None, None, None, scored_records)
+    def upload_summary_scores_to_redcap(self, instrument, scored_records, max_workers=None):
+        return self.__session.redcap_import_record(instrument, None, None, None, scored_records,
+                                                   max_workers=max_workers)
@@ -0,0 +1,94 @@
+##
+##  See COPYING file distributed along with the package for the copyright and license terms
+##
+"""
+REDCap ID Resolver
+==================
+Translates names used in REDCap (project name, arm name/number, event
+description) into the ids of the REDCap MySQL database.
+
+The lookup tables (redcap_projects, redcap_events_arms and
+redcap_events_metadata) are small, so they are read once and kept as
+dictionaries. Call refresh() after projects, arms or events were changed.
+"""
+import pandas as pd
+from sqlalchemy import text
+
+
+def _first_match(keys, values):
+    """
+    Dictionary of keys to values; of repeated keys (e.g. two events with the
+    same description in an arm) the first row wins, as when selecting the
+    matching rows and taking .iloc[0]
+    """
+    index = dict()
+    for key, value in zip(keys, values):
+        index.setdefault(key, value)
+    return index
+
+
+class RedcapIdResolver(object):
+    def __init__(self, engine):
+        """
+        engine: sqlalchemy.Engine of the REDCap MySQL database
+        """
+        self.engine = engine
+        self.projects = None
+        self.arms = None
+        self.events = None
+        self.__indexes = None
+
+    def refresh(self):
+        """
+        (Re)read the lookup tables from the database
+        """
+        with self.engine.connect() as conn:
+            projects = pd.read_sql_query(
+                text("SELECT project_id, project_name FROM redcap_projects"), conn
+            )
+            arms = pd.read_sql_query(
+                text("SELECT arm_id, project_id, arm_num, arm_name FROM redcap_events_arms"), conn
+            )
+            events = pd.read_sql_query(
+                text("SELECT event_id, arm_id, descrip FROM redcap_events_metadata"), conn
+            )
+
+        self.projects = projects
+        self.arms = arms
+        self.events = events
+        self.__indexes = dict(
+            project=_first_match(projects.project_name, projects.project_id.astype(int)),
+            arm=_first_match(zip(arms.arm_name, arms.project_id.astype(int)),
+                             arms.arm_id.astype(int)),
+            arm_num=_first_match(zip(arms.arm_num.astype(int), arms.project_id.astype(int)),
+                                 arms.arm_id.astype(int)),
+            event=_first_match(zip(events.descrip, events.arm_id.astype(int)),
+                               events.event_id.astype(int)),
+        )
+
+    def load(self):
+        """
+        Read the lookup tables unless they were read before
+        """
+        if self.__indexes is None:
+            self.refresh()
+
+    def __lookup__(self, index_name, key):
+        self.load()
+
+        try:
+            return int(self.__indexes[index_name][key])
+        except KeyError:
+            raise KeyError("{0} not found in REDCap database".format(key))
+
+    def get_project_id(self, project_name):
+        return self.__lookup__("project", project_name)
+
+    def get_arm_id(self, arm_name, project_id):
+        return self.__lookup__("arm", (arm_name, int(project_id)))
+
+    def get_arm_id_from_arm_num(self, arm_num, project_id):
+        return self.__lookup__("arm_num", (int(arm_num), int(project_id)))
+
+    def get_event_id(self, event_descrip, arm_id):
+        return self.__lookup__("event", (event_descrip, int(arm_id)))
@@ -0,0 +1,75 @@
+##
+##  See COPYING file distributed along with the package for the copyright and license terms
+##
+"""
+REDCap Link Builder
+===================
+Builds links to the data entry pages of REDCap (e.g., for issues posted by
+QA scripts). The event_id of each (project_id, redcap_event_name) is
+resolved once via the RedcapIdResolver of the session; afterwards links are
+formatted without any database access.
+"""
+import re
+
+
+class RedcapLinkBuilder(object):
+    def __init__(self, session):
+        """
+        session: sibispy.Session connected to redcap_mysql_db (and a redcap
+                 project, which defines the REDCap version in the links)
+        """
+        self.__session = session
+        self.__base_url = None
+        self.__event_ids = dict()
+
+    def __get_base_url__(self):
+        if self.__base_url is None:
+            version = self.__session.get_redcap_version()
+            base_url = "{0}redcap_v{1}/DataEntry/".format(
+                self.__session.get_redcap_base_address(), version
+            )
+            # only keep the url once the REDCap version is known
+            if version is None:
+                return base_url
+            self.__base_url = base_url
+
+        return self.__base_url
+
+    def get_event_id(self, project_id, redcap_event_name):
+        key = (int(project_id), redcap_event_name)
+        if key not in self.__event_ids:
+            arm_match = re.search(r"arm_(\d*)", redcap_event_name)
+            if arm_match is None:
+                raise ValueError(f"No arm for {redcap_event_name}")
+            arm_num = int(arm_match.group(1))
+
+            event_descrip = self.__session.get_event_descrip_from_redcap_event_name(redcap_event_name)
+            resolver = self.__session.get_redcap_id_resolver()
+            arm_id = resolver.get_arm_id_from_arm_num(arm_num, project_id)
+            self.__event_ids[key] = resolver.get_event_id(event_descrip, arm_id)
+
+        return self.__event_ids[key]
+
+    def get_form_address(self, project_id, redcap_event_name, subject_id=None, name_of_form=None):
+        """
+        Link to a form of a subject; subject_id and name_of_form default to
+        the placeholder %s, which can be replaced later, i.e.,
+        address % (subject_id, form_name)
+        """
+        event_id = self.get_event_id(project_id, redcap_event_name)
+        if not name_of_form:
+            name_of_form = "%s"
+        if not subject_id:
+            subject_id = "%s"
+
+        return (self.__get_base_url__()
+                + f"index.php?pid={project_id}&id={subject_id}&event_id={event_id}&page={name_of_form}")
+
+    def get_subject_address(self, project_id, arm_num, subject_id=None):
+        """
+        Link to the record home page of a subject (subject_id defaults to %s)
+        """
+        if not subject_id:
+            subject_id = "%s"
+
+        return self.__get_base_url__() + f"record_home.php?pid={project_id}&arm={arm_num}&id={subject_id}"
@@ -10,10 +10,15 @@ The SIBIS Locking Object provides functionality to lock, unlock, and report on t
 from ast import literal_eval
 from builtins import str
 from builtins import object
+import os
+import json
+import hashlib
+import datetime
+import tempfile
 import pandas as pd
+from sqlalchemy import text, bindparam
 import sibispy
 from sibispy import sibislogger as slog
-import re
 from typing import List
 
 
@@ -21,6 +26,7 @@ class redcap_locking_data(object):
     def __init__(self):
         self.__session__ = None
         self.__event_dict = None
+        self.__export_visits = dict()
 
     def configure(self, sessionObj):
         self.__session__ = sessionObj
@@ -35,16 +41,12 @@ class redcap_locking_data(object):
         :param event_descrip: str
         :param name_of_form: str
         :param subject_id: str
-        :return: None
+        :return: int (number of unlocked records)
         """
-        locked_forms = self.__session__.get_mysql_table_records('redcap_locking_data', project_name, arm_name, event_descrip, name_of_form=name_of_form, subject_id=subject_id)
-        locked_list = ', '.join([str(i) for i in locked_forms.ld_id.values.tolist()])
-        if locked_list:
-            return self.__session__.delete_mysql_table_records('redcap_locking_data', locked_list)
- 
-        return 0
+        subject_ids = [subject_id] if subject_id else None
+        return self.unlock_forms(project_name, arm_name, [event_descrip], [name_of_form], subject_ids)[name_of_form]
 
-    def lock_form(self,project_name, arm_name, event_descrip, name_of_form, outfile = None, subject_id = None):
+    def lock_form(self,project_name, arm_name, event_descrip, name_of_form, outfile = None, subject_id = None, sync = False):
         """
         Lock all records for a given form for a project and event
 
@@ -52,17 +54,182 @@ class redcap_locking_data(object):
         :param arm: str
         :param event_descrip: str
         :param name_of_form: str
-        :return:
-        """
-        
-        # first make sure that all those forms are unlocked 
-        self.unlock_form(project_name, arm_name, event_descrip, name_of_form, subject_id)
-        # Then get records to lock 
-        project_records = self.__session__.get_mysql_project_records(project_name, arm_name, event_descrip, subject_id = subject_id)
-        # Lock them 
-        # lock all the records for this form by appending entries to locking table
-        # Kilian: Problem this table is created regardless if the form really exists in redcap or not
-        return self.__session__.add_mysql_table_records('redcap_locking_data',project_name, arm_name, event_descrip, name_of_form, project_records, outfile) 
+        :param sync: bool (only add missing locks, see lock_forms)
+        :return: int (number of locked records)
+        """
+        subject_ids = [subject_id] if subject_id else None
+        return self.lock_forms(project_name, arm_name, [event_descrip], [name_of_form], subject_ids, outfile, sync)[name_of_form]
+
+    def __get_lock_scope__(self, project_name, arm_name, event_descrips, subject_ids):
+        resolver = self.__session__.get_redcap_id_resolver()
+        project_id = resolver.get_project_id(project_name)
+        arm_id = resolver.get_arm_id(arm_name, project_id)
+        scope = dict(project_id=project_id,
+                     event_ids=[resolver.get_event_id(descrip, arm_id) for descrip in event_descrips])
+        # None (or [None]) selects all records
+        if subject_ids is not None and None not in subject_ids:
+            scope['subject_ids'] = list(subject_ids)
+
+        return scope
+
+    @staticmethod
+    def __select__(conn, sql, scope, **params):
+        expanding = ['event_ids'] + list(params.keys())
+        if 'subject_ids' in scope:
+            sql += " AND record IN :subject_ids"
+            expanding.append('subject_ids')
+
+        stmt = text(sql).bindparams(*[bindparam(key, expanding=True) for key in expanding])
+        return pd.read_sql_query(stmt, conn, params=dict(scope, **params))
+
+    def __select_locks__(self, conn, scope, forms):
+        return self.__select__(
+            conn,
+            "SELECT ld_id, record, event_id, form_name FROM redcap_locking_data "
+            "WHERE project_id = :project_id AND event_id IN :event_ids AND form_name IN :forms",
+            scope, forms=list(forms))
+
+    @staticmethod
+    def __delete_lock_ids__(conn, ld_ids):
+        if len(ld_ids):
+            stmt = text("DELETE FROM redcap_locking_data WHERE ld_id IN :ld_ids")
+            conn.execute(stmt.bindparams(bindparam('ld_ids', expanding=True)),
+                         dict(ld_ids=[int(ld_id) for ld_id in ld_ids]))
+
+    def unlock_forms(self, project_name, arm_name, event_descrips, forms, subject_ids=None):
+        """
+        Unlock forms of several events (and subjects) in a single transaction
+
+        :param project_name: str
+        :param arm_name: str
+        :param event_descrips: list of str
+        :param forms: list of str
+        :param subject_ids: list of str (default: all records)
+        :return: dict (number of unlocked records per form)
+        """
+        scope = self.__get_lock_scope__(project_name, arm_name, event_descrips, subject_ids)
+        with self.__session__.api['redcap_mysql_db'].begin() as conn:
+            locks = self.__select_locks__(conn, scope, forms)
+            self.__delete_lock_ids__(conn, locks.ld_id)
+
+        counts = locks.groupby('form_name').size()
+        return {form: int(counts.get(form, 0)) for form in forms}
+
+    def lock_forms(self, project_name, arm_name, event_descrips, forms, subject_ids=None, outfile=None,
+                   sync=False):
+        """
+        Lock forms of all records (or the given subjects) of several events in
+        a single transaction. By default existing locks of those forms are
+        replaced; with sync=True only missing locks are added and locks of
+        records that no longer exist are removed, so that existing lock
+        timestamps are kept.
+
+        :param project_name: str
+        :param arm_name: str
+        :param event_descrips: list of str
+        :param forms: list of str
+        :param subject_ids: list of str (default: all records)
+        :param outfile: str (csv file listing the locked records)
+        :param sync: bool
+        :return: dict (number of locked records per form)
+        """
+        scope = self.__get_lock_scope__(project_name, arm_name, event_descrips, subject_ids)
+        user_name = self.__session__.get_redcap_user()
+        timestamp = datetime.datetime.now()
+        with self.__session__.api['redcap_mysql_db'].begin() as conn:
+            locks = self.__select_locks__(conn, scope, forms)
+            records = self.__select__(
+                conn,
+                "SELECT DISTINCT record, event_id FROM redcap_data "
+                "WHERE project_id = :project_id AND event_id IN :event_ids",
+                scope)
+            # Kilian: Problem this table is created regardless if the form really exists in redcap or not
+            desired = [(record, int(event_id), form)
+                       for form in forms
+                       for record, event_id in zip(records.record, records.event_id)]
+
+            if sync:
+                # keep one existing lock per (record, event, form) that should be locked
+                desired_keys = set(desired)
+                kept = set()
+                extra_ids = []
+                for ld_id, key in zip(locks.ld_id, zip(locks.record, locks.event_id.astype(int), locks.form_name)):
+                    if key in desired_keys and key not in kept:
+                        kept.add(key)
+                    else:
+                        extra_ids.append(ld_id)
+                desired = [key for key in desired if key not in kept]
+            else:
+                extra_ids = locks.ld_id
+
+            self.__delete_lock_ids__(conn, extra_ids)
+            if desired:
+                conn.execute(text(
+                    "INSERT INTO redcap_locking_data "
+                    "(project_id, record, event_id, form_name, username, timestamp) "
+                    "VALUES (:project_id, :record, :event_id, :form_name, :username, :timestamp)"),
+                    [dict(project_id=scope['project_id'], record=record, event_id=event_id,
+                          form_name=form, username=user_name, timestamp=timestamp)
+                     for record, event_id, form in desired])
+
+        slog.count("sibis_lock_rows_deleted_total", len(extra_ids), project=project_name)
+        slog.count("sibis_lock_rows_inserted_total", len(desired), project=project_name)
+        if outfile:
+            records.record.drop_duplicates().to_csv(outfile, index=False, header=False)
+
+        return {form: len(records) for form in forms}
+
+    def report_locked_forms_batch(self, project_name, forms, enriched_table, xnat_ids=None):
+        """
+        Report the lock timestamps of all subjects and visits of a project in
+        a single pivot of the enriched lock table (see report_locked_forms_all)
+
+        :param project_name: str (e.g., ncanda_subject_visit_log)
+        :param forms: list
+        :param enriched_table: `pandas.DataFrame`
+        :param xnat_ids: dict mapping site ids to the subject ids reported (default: site id)
+        :return: `pandas.DataFrame` indexed by (subject, arm, visit) with one column per form
+        """
+        report = self.__pivot_locks__(project_name, forms, enriched_table)
+        if xnat_ids:
+            report = report.rename(index=xnat_ids, level='subject')
+
+        return report
+
+    def __pivot_locks__(self, project_name, forms, enriched_table):
+        # If a form of a subject-visit was locked more than once, the last lock
+        # in table order is reported. A subject-visit may span several arms:
+        # its locks are reported together, with the arm of its last lock.
+        project_id = self.__session__.get_mysql_project_id(project_name)
+        lock_table = enriched_table.loc[(enriched_table['project_id'] == project_id)
+                                        & enriched_table['form_name'].isin(forms)]
+
+        visit_keys = ['record', 'export_event']
+        report = (lock_table.groupby(visit_keys + ['form_name'])['timestamp']
+                  .last()
+                  .unstack('form_name')
+                  .reindex(columns=list(forms))
+                  .astype(object))
+        report.columns.name = None
+        arms = lock_table.groupby(visit_keys)['export_arm'].last().reindex(report.index)
+        report.index = pd.MultiIndex.from_arrays(
+            [report.index.get_level_values('record'), arms.to_numpy(),
+             report.index.get_level_values('export_event')],
+            names=['subject', 'arm', 'visit'])
+
+        return report
+
+    def __get_export_visit__(self, project_name, redcap_event_name):
+        # (export_arm, export_event) of an event; the event dict does not change after configure
+        key = (project_name, redcap_event_name)
+        if key not in self.__export_visits:
+            project_id = self.__session__.get_mysql_project_id(project_name)
+            event_details = self.__event_dict.query(
+                f"project_id == {project_id} and redcap_event_name == '{redcap_event_name}'").squeeze()
+            assert isinstance(event_details, pd.Series)
+            self.__export_visits[key] = (event_details.get('export_arm'), event_details.get('export_event'))
+
+        return self.__export_visits[key]
 
     def report_locked_forms_from_enriched_lock_table(
         self,
@@ -73,35 +240,21 @@ class redcap_locking_data(object):
         redcap_event_name: str,
         enriched_table: pd.DataFrame,
     ) -> pd.DataFrame:
-        # 1. Subset to project_id of interest (so that redcap_event_name is
-        #    guaranteed unique)
-        project_id = self.__session__.get_mysql_project_id(project_name)
-        project_idx = enriched_table['project_id'] == project_id
-        lock_table = enriched_table.loc[project_idx]
-
-        # 2. Get export_arm and export_event via redcap_event_name
-        event_details = self.__event_dict.query(
-            f"project_id == {project_id} and redcap_event_name == '{redcap_event_name}'").squeeze()
-        assert isinstance(event_details, pd.Series)
-        arm_name = event_details.get('export_arm')
-        event_name = event_details.get('export_event')
+        # 1. Get export_arm and export_event via redcap_event_name
+        arm_name, event_name = self.__get_export_visit__(project_name, redcap_event_name)
 
-        # event_id = lock_table.loc[event_idx, 'event_id'].values[0]
-        index_cols = dict(subject=xnat_id, arm=arm_name, visit=event_name)
+        # 2. The row of the subject and event in the report of all subjects
+        #    (restricted to their locks first, which results in the same row)
+        select_idx = ((enriched_table['record'] == subject_id)
+                      & (enriched_table['export_event'] == event_name))
+        report = self.__pivot_locks__(project_name, forms, enriched_table.loc[select_idx])
 
-        # 3. Subset to just the subject and event of interest
-        select_idx = ((lock_table['record'] == subject_id) 
-                      & (lock_table['export_event'] == event_name))
-        lock_table = lock_table.loc[select_idx]
-
-        # 4. Write out to a single-row DataFrame
         columns = ['subject', 'arm', 'visit'] + list(forms)
-        data = pd.DataFrame(data=index_cols, index=[0], columns=columns)
-        for _, row in lock_table.iterrows():
-            name_of_form = row.get('form_name')
-            if name_of_form in forms:
-                timestamp = row.get('timestamp')
-                data.at[0, name_of_form] = timestamp
+        data = pd.DataFrame(data=dict(subject=xnat_id, arm=arm_name, visit=event_name),
+                            index=[0], columns=columns)
+        if not report.empty:
+            locked = report.iloc[0].dropna()
+            data.loc[0, list(locked.index)] = locked.tolist()
 
         return data
 
@@ -126,16 +279,15 @@ class redcap_locking_data(object):
         dataframe = pd.DataFrame(data=data, index=[0], columns=columns)
 
         if my_sql_table.empty:
-            locked_forms = self.__session__.get_mysql_table_records('redcap_locking_data',project_name, arm_name, event_descrip, subject_id=subject_id)
+            locked_forms = self.__session__.get_mysql_table_records('redcap_locking_data',project_name, arm_name, event_descrip, subject_id=subject_id, columns=['form_name', 'timestamp'])
         else: 
             locked_forms = self.__session__.get_mysql_table_records_from_dataframe(my_sql_table,project_name, arm_name, event_descrip, subject_id=subject_id)
            
-        for _, row in locked_forms.iterrows():
-            # form_name is not version dependent as it did not change in redcap table only api ! 
-            name_of_form = row.get('form_name')
-            if name_of_form in forms: 
-                timestamp = row.get('timestamp')
-                dataframe.at[0, name_of_form] = timestamp
+        # form_name is not version dependent as it did not change in redcap table only api ! 
+        locked = (locked_forms.loc[locked_forms['form_name'].isin(forms)]
+                  .groupby('form_name')['timestamp'].last())
+        if not locked.empty:
+            dataframe.loc[0, list(locked.index)] = locked.tolist()
 
         return dataframe
 
@@ -154,26 +306,65 @@ class redcap_locking_data(object):
 
         return enriched_lock_data
 
-    def get_event_names_for_ids(self) -> pd.DataFrame:
-        # 0. Check if this work has already been done (only needs doing once)
-        if self.__event_dict is not None:
-            return self.__event_dict
-
-        # 1. Match event_id to constructed redcap_event_name
+    def __get_redcap_event_names__(self) -> pd.DataFrame:
+        """
+        Map event_id to the constructed redcap_event_name. The mapping is
+        cached locally (per database) and only rebuilt when events or arms
+        were added, i.e., the largest event_id or arm_id changed.
+        """
         db_conn = self.__session__.api['redcap_mysql_db']
+        db_url = db_conn.url
+        database = "{0}:{1}/{2}".format(db_url.host, db_url.port, db_url.database)
+        with db_conn.connect() as conn:
+            max_ids = conn.execute(text(
+                "SELECT (SELECT MAX(event_id) FROM redcap_events_metadata), "
+                "(SELECT MAX(arm_id) FROM redcap_events_arms)")).fetchone()
+        cache_key = [int(max_id or 0) for max_id in max_ids]
+
+        cache_file = os.path.join(self.__session__.get_cache_dir(), 'redcap_event_names_'
+                                  + hashlib.sha1(database.encode('utf-8')).hexdigest()[0:12] + '.json')
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as fd:
+                    cached = json.load(fd)
+                if cached.get('key') == cache_key and cached.get('database') == database:
+                    return pd.DataFrame.from_records(
+                        cached['events'], columns=['project_id', 'event_id', 'redcap_event_name'])
+            except (IOError, ValueError, KeyError) as err_msg:
+                slog.info("redcap_locking_data.get_event_names_for_ids",
+                          "WARNING: ignoring unreadable event name cache",
+                          cache_file=cache_file, err_msg=str(err_msg))
+
         events = pd.read_sql_table('redcap_events_metadata', db_conn,
                                    columns=['event_id', 'arm_id', 'descrip'])
         arms = pd.read_sql_table('redcap_events_arms', db_conn,
                                  columns=['arm_id', 'arm_num', 'project_id'])
         event_arm = events.merge(arms, how='outer')
-        event_arm['redcap_event_name'] = event_arm.apply(
-            lambda x: "{}_arm_{}".format(
-                re.sub(r'-', '', re.sub(r'[ ]', '_', x['descrip']).lower()),
-                x['arm_num']
-            ), axis=1
+        event_arm['redcap_event_name'] = (
+            event_arm['descrip'].str.replace(' ', '_', regex=False).str.lower().str.replace('-', '', regex=False)
+            + '_arm_' + event_arm['arm_num'].astype('Int64').astype(str)
         )
+        event_names = event_arm[['project_id', 'event_id', 'redcap_event_name']]
+
+        # write to a temporary file first so that readers never see a partial cache
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as tmp_fd:
+            json.dump(dict(key=cache_key, database=database,
+                           events=json.loads(event_names.to_json(orient='records'))), tmp_fd)
+        os.replace(tmp_file, cache_file)
 
-        event_dict = event_arm[['project_id', 'event_id', 'redcap_event_name']]
+        return event_names
+
+    def get_event_names_for_ids(self) -> pd.DataFrame:
+        # 0. Check if this work has already been done (only needs doing once)
+        if self.__event_dict is not None:
+            return self.__event_dict
+
+        # 1. Match event_id to constructed redcap_event_name
+        event_dict = self.__get_redcap_event_names__()
 
         # 2. Match Redcap event name to the export event name
         config, error = self.__session__.get_config_sys_parser()
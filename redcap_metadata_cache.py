@@ -0,0 +1,217 @@
+##
+##  See COPYING file distributed along with the package for the copyright and license terms
+##
+"""
+REDCap Metadata Cache
+=====================
+Keeps the metadata of a REDCap project (data dictionary, export field names,
+instrument-event mappings, events, arms and REDCap version) on local disk so
+that scripts do not have to download it on every run.
+
+An entry is keyed by the project (server + api type) and stores a signature
+built from the REDCap version and the project information. An entry is only
+reused if the signature still matches and the project log does not list any
+design changes since the entry was validated the last time (if the log
+cannot be read, the signature alone decides). Entries can be
+dropped explicitly via invalidate().
+"""
+import os
+import json
+import hashlib
+import datetime
+import tempfile
+
+from redcap import RedcapError
+
+from sibispy import sibislogger as slog
+
+CACHE_FORMAT_VERSION = 1
+# format used by PyCap when passing datetimes to the logging api
+LOG_TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+
+class RedcapMetadataCache(object):
+    def __init__(self, cache_dir, max_age=0):
+        """
+        cache_dir: directory the cache entries are written to
+        max_age: number of seconds an entry is trusted without checking the
+                 server for changes (default: always check)
+        """
+        self.__cache_dir = cache_dir
+        self.__max_age = max_age
+
+    def get_cache_dir(self):
+        return self.__cache_dir
+
+    def __get_entry_file__(self, project_key):
+        name = hashlib.sha1(str(project_key).encode("utf-8")).hexdigest()
+        return os.path.join(self.__cache_dir, "redcap_metadata_" + name + ".json")
+
+    def load(self, project_key):
+        entry_file = self.__get_entry_file__(project_key)
+        if not os.path.exists(entry_file):
+            return None
+
+        try:
+            with open(entry_file, "r") as fd:
+                entry = json.load(fd)
+        except (IOError, ValueError) as err_msg:
+            slog.info("RedcapMetadataCache.load",
+                      "WARNING: ignoring unreadable metadata cache entry",
+                      cache_file=entry_file, err_msg=str(err_msg))
+            return None
+
+        if entry.get("cache_format") != CACHE_FORMAT_VERSION or entry.get("project_key") != project_key:
+            return None
+
+        return entry
+
+    def save(self, project_key, entry):
+        entry = dict(entry, project_key=project_key, cache_format=CACHE_FORMAT_VERSION)
+        if not os.path.exists(self.__cache_dir):
+            os.makedirs(self.__cache_dir)
+
+        # write to a temporary file first so that readers never see a partial entry
+        entry_file = self.__get_entry_file__(project_key)
+        fd, tmp_file = tempfile.mkstemp(dir=self.__cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as tmp_fd:
+                json.dump(entry, tmp_fd)
+            os.replace(tmp_file, entry_file)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+        return entry
+
+    def invalidate(self, project_key=None):
+        """
+        Remove the entry of project_key or all entries if project_key is None
+        """
+        if not os.path.exists(self.__cache_dir):
+            return
+
+        if project_key is not None:
+            entry_files = [self.__get_entry_file__(project_key)]
+        else:
+            entry_files = [os.path.join(self.__cache_dir, name)
+                           for name in os.listdir(self.__cache_dir)
+                           if name.startswith("redcap_metadata_")]
+
+        for entry_file in entry_files:
+            if os.path.exists(entry_file):
+                os.remove(entry_file)
+
+    def get(self, project_key, red_api, refresh=False):
+        """
+        Return the metadata entry of a project. The cached entry is returned if
+        it is still valid, otherwise the metadata is downloaded via red_api and
+        the cache is updated.
+        """
+        entry = None if refresh else self.load(project_key)
+        now = datetime.datetime.now()
+
+        if entry is not None:
+            checked_at = datetime.datetime.strptime(entry["checked_at"], LOG_TIME_FORMAT)
+            if (now - checked_at).total_seconds() < self.__max_age:
+                return entry
+
+            signature = get_project_signature(red_api)
+            if signature == entry.get("signature") and not has_design_changes(red_api, checked_at):
+                entry["checked_at"] = now.strftime(LOG_TIME_FORMAT)
+                return self.save(project_key, entry)
+        else:
+            signature = get_project_signature(red_api)
+
+        entry = fetch_project_metadata(red_api)
+        entry["signature"] = signature
+        entry["checked_at"] = now.strftime(LOG_TIME_FORMAT)
+        return self.save(project_key, entry)
+
+
+def get_project_signature(red_api):
+    """
+    Cheap change signal of a project: the REDCap version and project settings
+    """
+    version = red_api.export_version()
+    project_info = red_api.export_project_info()
+    signature = json.dumps([str(version), project_info], sort_keys=True, default=str)
+    return hashlib.sha1(signature.encode("utf-8")).hexdigest()
+
+
+def has_design_changes(red_api, since):
+    """
+    Check the project log for changes to the project design since the given
+    time. If the log cannot be accessed (e.g., the token lacks logging
+    rights), the project signature alone decides, i.e., no changes are
+    reported.
+    """
+    try:
+        changes = red_api.export_logging(log_type="manage", begin_time=since)
+    except RedcapError as err_msg:
+        slog.info("redcap_metadata_cache.has_design_changes",
+                  "WARNING: cannot read the project log, relying on the project signature",
+                  err_msg=str(err_msg))
+        return False
+
+    return len(changes) > 0
+
+
+def reset_project(red_api):
+    """
+    Drop the values a redcap.Project derived from its metadata
+    """
+    red_api._metadata = None
+    red_api._forms = None
+    red_api._field_names = None
+    red_api._def_field = None
+
+
+def is_classic_project_error(err):
+    """
+    Whether the api refused to export events, arms or mappings because the
+    project is not longitudinal (as opposed to network or server errors)
+    """
+    return isinstance(err, RedcapError) and "classic project" in str(err).lower()
+
+
+def fetch_project_metadata(red_api):
+    # reset cached values of the project so that everything is pulled from the server
+    reset_project(red_api)
+    entry = dict(
+        redcap_version=str(red_api.export_version()),
+        metadata=red_api.metadata,
+        field_names=red_api.export_field_names(),
+    )
+
+    # only longitudinal projects define events, arms and mappings
+    try:
+        entry["events"] = red_api.export_events()
+    except RedcapError as err:
+        if not is_classic_project_error(err):
+            raise
+        entry["events"] = []
+
+    if entry["events"]:
+        entry["arms"] = red_api.export_arms()
+        entry["instrument_event_mappings"] = red_api.export_instrument_event_mappings()
+    else:
+        entry["arms"] = []
+        entry["instrument_event_mappings"] = []
+
+    return entry
+
+
+def prime_project(red_api, entry):
+    """
+    Initialize the lazily loaded properties of a redcap.Project with the cached
+    entry so that they do not trigger additional api calls
+    """
+    import semantic_version
+
+    reset_project(red_api)
+    red_api._metadata = entry["metadata"]
+    red_api._redcap_version = semantic_version.Version(entry["redcap_version"])
+    red_api._is_longitudinal = len(entry["events"]) > 0
+    return red_api
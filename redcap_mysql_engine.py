@@ -0,0 +1,109 @@
+##
+##  See COPYING file distributed along with the package for the copyright and license terms
+##
+"""
+REDCap MySQL Engine
+===================
+Connection pool settings and query instrumentation of the engine connecting
+to the REDCap MySQL (MariaDB) database.
+
+Every statement executed via the engine is timed: the latency is added to
+the histogram sibis_mysql_statement_seconds and the number of affected or
+returned rows to the counter sibis_mysql_statement_rows_total of the
+sibislogger metrics (labeled by statement type and table, e.g.,
+'delete redcap_locking_data'). If the timer of the logger is enabled, slow
+statements are also written to its time log.
+"""
+import re
+import time
+
+from sqlalchemy import event
+
+from sibispy import sibislogger as slog
+
+STATEMENT_PATTERN = re.compile(
+    r"^\s*(select|insert|update|delete|replace)\b.*?\b(?:from|into|update)\s+([\w.`]+)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def get_engine_options(cfg):
+    """
+    Keyword arguments of create_engine defined by the redcap-mysql section
+    of the config file (pool_size, max_overflow, pool_timeout, pool_recycle,
+    pool_pre_ping)
+    """
+    return dict(
+        pool_size=int(cfg.get("pool_size", 5)),
+        max_overflow=int(cfg.get("max_overflow", 10)),
+        pool_timeout=float(cfg.get("pool_timeout", 30)),
+        pool_recycle=int(cfg.get("pool_recycle", 3600)),
+        pool_pre_ping=bool(cfg.get("pool_pre_ping", True)),
+    )
+
+
+def get_statement_label(statement):
+    """
+    Short label of a statement for metrics, e.g., 'select redcap_data'
+    """
+    match = STATEMENT_PATTERN.match(statement)
+    if not match:
+        return statement.split(None, 1)[0].lower() if statement.strip() else "unknown"
+
+    return "{0} {1}".format(match.group(1).lower(), match.group(2).strip("`").split(".")[-1])
+
+
+def set_statement_timeout(engine, statement_timeout):
+    """
+    Abort statements running longer than statement_timeout seconds on the
+    server (max_statement_time of MariaDB, max_execution_time of MySQL which
+    only applies to SELECT statements)
+    """
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SELECT VERSION()")
+            version = cursor.fetchone()[0]
+            if "mariadb" in str(version).lower():
+                cursor.execute("SET SESSION max_statement_time = %s" % float(statement_timeout))
+            else:
+                cursor.execute("SET SESSION max_execution_time = %d" % int(1000 * statement_timeout))
+        finally:
+            cursor.close()
+
+
+def instrument_engine(engine, slow_statement_seconds=None):
+    """
+    Record latency and row count of each statement executed via engine;
+    statements taking at least slow_statement_seconds are also written to the
+    time log of the logger
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("sibis_statement_start", []).append(time.time())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        start_time = conn.info["sibis_statement_start"].pop()
+        end_time = time.time()
+        label = get_statement_label(statement)
+        slog.observe("sibis_mysql_statement_seconds", end_time - start_time, statement=label)
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            slog.count("sibis_mysql_statement_rows_total", cursor.rowcount, statement=label)
+
+        if slow_statement_seconds is not None and end_time - start_time >= slow_statement_seconds:
+            slog.logTiming(start_time, end_time, "mysql " + label,
+                           "rows: {0}".format(cursor.rowcount))
+
+    @event.listens_for(engine, "handle_error")
+    def on_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("sibis_statement_start"):
+            conn.info["sibis_statement_start"].pop()
+        label = get_statement_label(exception_context.statement or "")
+        slog.count("sibis_mysql_statement_failures_total", statement=label)
+
+    return engine
@@ -0,0 +1,254 @@
+##
+##  See COPYING file distributed along with the package for the copyright and license terms
+##
+"""
+REDCap MySQL Export
+===================
+Read path for records that bypasses the REDCap API: the EAV rows of
+redcap_data are selected via its (project_id, event_id, record, field_name)
+index and pivoted into the frame that
+<redcap_project>.export_records(format_type='df') returns, i.e., indexed by
+(record id field, redcap_event_name) for longitudinal projects.
+
+Known differences to the API export:
+  - repeating instruments/events are not supported (only the first instance
+    is exported, redcap_repeat_* columns are missing)
+  - no redcap_data_access_group or survey columns (identifier, timestamps)
+  - file upload and signature fields contain the edoc id stored in the
+    database instead of the file name
+  - user rights (de-identification, form export rights) are not applied
+  - records are ordered by their id as string and not by REDCap's natural
+    ordering of numeric record ids
+  - values are parsed with the dtypes passed by the caller (derived from the
+    metadata by Session.redcap_mysql_export_records), while
+    export_records(format_type='df') infers them from the values, e.g.,
+    completion status and numbers are float64 even if no value is missing
+"""
+import re
+from io import StringIO
+
+import pandas as pd
+from sqlalchemy import text, bindparam
+
+# the number of the data table of a project depends on the REDCap version
+DATA_TABLE_PATTERN = re.compile(r"^redcap_data\d*$")
+
+
+def get_export_columns(entry, fields=None, forms=None):
+    """
+    Columns of an export in the order of the API, i.e., fields in the order of
+    the data dictionary with <form>_complete following the last field of each
+    form. Returns the list of column names as well as a dictionary mapping
+    each column to (field_name, checkbox code or None).
+    """
+    metadata = entry["metadata"]
+    def_field = metadata[0]["field_name"]
+    checkbox_names = dict()
+    for name in entry["field_names"]:
+        if name.get("choice_value") not in (None, ""):
+            checkbox_names[(name["original_field_name"], str(name["choice_value"]))] = name[
+                "export_field_name"
+            ]
+
+    forms = set(forms or [])
+    fields = set(fields or [])
+    select_all = not forms and not fields
+
+    columns = dict()
+    for form_name in dict.fromkeys(field["form_name"] for field in metadata):
+        form_fields = [field for field in metadata if field["form_name"] == form_name]
+        for field in form_fields:
+            field_name = field["field_name"]
+            if field["field_type"] == "descriptive":
+                continue
+            if not (select_all or field_name == def_field
+                    or form_name in forms or field_name in fields):
+                continue
+
+            if field["field_type"] == "checkbox":
+                for choice in field["select_choices_or_calculations"].split("|"):
+                    code = choice.split(",")[0].strip()
+                    column = checkbox_names.get(
+                        (field_name, code), "%s___%s" % (field_name, code.lower())
+                    )
+                    columns[column] = (field_name, code)
+            else:
+                columns[field_name] = (field_name, None)
+
+        complete_field = form_name + "_complete"
+        if select_all or form_name in forms or complete_field in fields:
+            columns[complete_field] = (complete_field, None)
+
+    return list(columns.keys()), columns
+
+
+def get_event_names(entry, resolver, project_id):
+    """
+    Map the event_ids of a project to their unique event names by matching
+    event description and arm number with the events of the metadata entry
+    """
+    unique_names = {
+        (event["event_name"], int(event["arm_num"])): event["unique_event_name"]
+        for event in entry["events"]
+    }
+    if resolver.events is None:
+        resolver.refresh()
+
+    arms = resolver.arms[resolver.arms.project_id.astype(int) == int(project_id)]
+    arm_nums = dict(zip(arms.arm_id.astype(int), arms.arm_num.astype(int)))
+    event_names = dict()
+    for event_id, arm_id, descrip in zip(
+        resolver.events.event_id, resolver.events.arm_id, resolver.events.descrip
+    ):
+        arm_num = arm_nums.get(int(arm_id))
+        if arm_num is not None and (descrip, arm_num) in unique_names:
+            event_names[int(event_id)] = unique_names[(descrip, arm_num)]
+
+    return event_names
+
+
+def get_data_table(conn, project_id):
+    """
+    Name of the table holding the data of the project (REDCap 14 spreads
+    projects across redcap_data, redcap_data2, ...)
+    """
+    try:
+        data_table = conn.execute(
+            text("SELECT data_table FROM redcap_projects WHERE project_id = :project_id"),
+            dict(project_id=project_id),
+        ).scalar()
+    except Exception:
+        conn.rollback()
+        data_table = None
+
+    if not data_table:
+        return "redcap_data"
+    if not DATA_TABLE_PATTERN.match(data_table):
+        raise ValueError("Unexpected data table {} of project {}".format(data_table, project_id))
+    return data_table
+
+
+def select_records(engine, project_id, event_ids=None, records=None, field_names=None):
+    """
+    EAV rows (record, event_id, field_name, value) of the first instance
+    """
+    with engine.connect() as conn:
+        data_table = get_data_table(conn, project_id)
+        sql = (
+            "SELECT record, event_id, field_name, value FROM " + data_table + " "
+            "WHERE project_id = :project_id AND instance IS NULL"
+        )
+        params = dict(project_id=project_id)
+        expanding = []
+        for column, values in [("event_id", event_ids), ("record", records), ("field_name", field_names)]:
+            if values is None:
+                continue
+            sql += " AND {0} IN :{0}s".format(column)
+            params[column + "s"] = list(values)
+            expanding.append(bindparam(column + "s", expanding=True))
+
+        stmt = text(sql).bindparams(*expanding)
+        return pd.read_sql_query(stmt, conn, params=params)
+
+
+def pivot_records(rows, entry, columns, column_fields, event_names, dtypes=None):
+    """
+    Pivot EAV rows into the frame returned by the API. The wide table is
+    written to csv and parsed again with the arguments PyCap uses, so that
+    values and dtypes match the ones of an API export.
+    """
+    def_field = entry["metadata"][0]["field_name"]
+    longitudinal = len(entry["events"]) > 0
+    index_col = [def_field, "redcap_event_name"] if longitudinal else def_field
+
+    rows = rows.copy()
+    rows["redcap_event_name"] = rows.event_id.astype(int).map(event_names)
+    if longitudinal:
+        # data of deleted events is still in the table
+        rows = rows[rows.redcap_event_name.notnull()]
+    else:
+        rows["redcap_event_name"] = ""
+
+    # checkboxes are stored as one row per checked code
+    export_names = {key: column for column, key in column_fields.items()}
+    checkbox_fields = {field for field, code in column_fields.values() if code is not None}
+    is_checkbox = rows.field_name.isin(checkbox_fields)
+    rows["column"] = rows.field_name
+    rows.loc[is_checkbox, "column"] = [
+        export_names.get((field, str(code)), "%s___%s" % (field, str(code).lower()))
+        for field, code in zip(rows.field_name[is_checkbox], rows.value[is_checkbox])
+    ]
+    rows.loc[is_checkbox, "value"] = "1"
+
+    wide = (
+        rows.drop_duplicates(["record", "redcap_event_name", "column"], keep="last")
+        .set_index(["record", "redcap_event_name", "column"])["value"]
+        .unstack("column")
+        .reindex(columns=columns)
+        .astype(object)
+    )
+
+    # unchecked boxes and never saved forms are reported as 0 by the API
+    filled_columns = [column for column, (field, code) in column_fields.items()
+                      if code is not None or field.endswith("_complete")]
+    if len(wide) and filled_columns:
+        form_of_field = {field["field_name"]: field["form_name"] for field in entry["metadata"]}
+        designated = None
+        if longitudinal:
+            designated = {(mapping.get("form", mapping.get("form_name")), mapping["unique_event_name"])
+                          for mapping in entry["instrument_event_mappings"]}
+        event_level = wide.index.get_level_values("redcap_event_name")
+        is_designated = dict()
+        for column in filled_columns:
+            field = column_fields[column][0]
+            form_name = form_of_field.get(field, field[: -len("_complete")])
+            if designated is None:
+                mask = wide[column].isnull()
+            else:
+                if form_name not in is_designated:
+                    is_designated[form_name] = pd.Series(
+                        [(form_name, event) in designated for event in event_level], index=wide.index
+                    )
+                mask = wide[column].isnull() & is_designated[form_name]
+            wide.loc[mask, column] = "0"
+
+    # the record id field is always the first column (and comes from the index)
+    wide = wide.drop(columns=def_field)
+    wide.index = wide.index.set_names([def_field, "redcap_event_name"])
+    wide = wide.reset_index()
+    if longitudinal:
+        event_order = {event["unique_event_name"]: order for order, event in enumerate(entry["events"])}
+        wide = (
+            wide.assign(_event_order=wide.redcap_event_name.map(event_order))
+            .sort_values([def_field, "_event_order"], kind="stable")
+            .drop(columns="_event_order")
+        )
+    else:
+        wide = wide.sort_values(def_field, kind="stable").drop(columns="redcap_event_name")
+
+    return pd.read_csv(StringIO(wide.to_csv(index=False)), index_col=index_col, dtype=dtypes)
+
+
+def export_records(engine, resolver, project_id, entry, fields=None, events=None,
+                   records=None, forms=None, dtypes=None):
+    """
+    Export records of a project straight from the REDCap database
+
+    engine: sqlalchemy.Engine of the REDCap MySQL database
+    resolver: RedcapIdResolver of that database
+    entry: metadata of the project (see Session.get_redcap_metadata)
+    fields, events, records, forms: same meaning as for export_records of the API
+    dtypes: dtype argument passed to pandas.read_csv
+    """
+    columns, column_fields = get_export_columns(entry, fields, forms)
+    event_names = get_event_names(entry, resolver, project_id)
+
+    event_ids = None
+    if events is not None:
+        event_ids = [event_id for event_id, name in event_names.items() if name in set(events)]
+    field_names = None
+    if fields is not None or forms is not None:
+        field_names = sorted({field for field, code in column_fields.values()})
+
+    rows = select_records(engine, project_id, event_ids, records, field_names)
+    return pivot_records(rows, entry, columns, column_fields, event_names, dtypes)
@@ -1,15 +1,21 @@
 from __future__ import print_function
 from builtins import zip
 from builtins import str
-from builtins import range
 from builtins import object
 import os
 import re
+import json
+import tempfile
 import ast
 import glob
 import hashlib
+import time
 from pathlib import Path
+from dataclasses import dataclass
 from typing import Union
+from collections.abc import Mapping
+from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas
 import numpy as np
@@ -23,6 +29,9 @@ from sibispy import utils as sutils
 from sibispy import config_file_parser as cfg_parser
 from sibispy.cluster_util import SlurmScheduler
 
+# event with the date of birth unless redcap_to_casesdir.baseline_event is set
+DEFAULT_BASELINE_EVENT = 'baseline_visit_arm_1'
+
 
 class redcap_to_casesdir(object):
     def __init__(self):
@@ -34,12 +43,18 @@ class redcap_to_casesdir(object):
         self.__metadata_dict = dict()
         self.__event_dict = dict()
         self.__demographic_event_skips = list()
+        self.__baseline_event = DEFAULT_BASELINE_EVENT
         self.__forms_dir =  None
         self.__sibis_defs = None
         self.__scanner_dict = None
+        self.__export_plans = dict()
+        self.__manifest = None
+        self.__datadict_hashes = dict()
 
 
-    def configure(self, sessionObj, redcap_metadata):
+    # export_plans: plans saved by an earlier run (see load_export_plans), which
+    # are used instead of reading the form files in operations/redcap_to_casesdir
+    def configure(self, sessionObj, redcap_metadata, export_plans=None):
         # Make sure it was set up correctly
         if not sessionObj.get_ordered_config_load() :
             slog.info('recap_to_cases_dir.configure',"ERROR: session has to be configured with ordered_config_load set to True")
@@ -66,8 +81,19 @@ class redcap_to_casesdir(object):
         # Reading in which events to skip demographics generation for (i.e. midyears)
         self.__demographic_event_skips = self.__sibis_defs['skip_demographics_for']
 
+        # Event with the date of birth of a subject (optional)
+        self.__baseline_event = self.__sibis_defs.get('baseline_event', DEFAULT_BASELINE_EVENT)
+
         # reading in all forms and variables that should be exported to cases_dir
         self.__forms_dir  = os.path.join(sessionObj.get_operations_dir(),'redcap_to_casesdir')
+        # (or take them from the saved plans)
+        if export_plans is not None:
+            for export_name, plan in export_plans.items():
+                self.__import_forms[export_name] = plan.import_form
+                self.__export_forms[export_name] = list(plan.form_fields)
+                self.__export_rename[export_name] = dict(plan.renames)
+            return self.__organize_metadata__(redcap_metadata, export_plans)
+
         if not os.path.exists(self.__forms_dir) :
             slog.info('redcap_to_casesdir.configure','ERROR: ' + str(self.__forms_dir)  + " does not exist!")
             return False
@@ -107,7 +133,7 @@ class redcap_to_casesdir(object):
         return dict_tup
 
     # Organize REDCap metadata (data dictionary)
-    def __organize_metadata__(self,redcap_metadata):
+    def __organize_metadata__(self,redcap_metadata,export_plans=None):
         # turn metadata into easily digested dict
         for field in redcap_metadata:
             field_tuple = (field['field_type'],
@@ -129,8 +155,78 @@ class redcap_to_casesdir(object):
             return False
 
         self.__make_code_label_dict__(redcap_metadata)
+        if export_plans is None:
+            self.__compile_export_plans__()
+        else:
+            self.__export_plans = dict(export_plans)
         return True
 
+    # Precompute everything an export of a form needs from the configuration
+    def __compile_export_plans__(self):
+        self.__export_plans = dict()
+        for export_name, export_fields in self.__export_forms.items():
+            complete = f"{self.__import_forms[export_name]}_complete"
+            fields = [f for f in export_fields if f != complete and f not in ('subject', 'arm', 'visit')]
+            columns = ['subject', 'arm', 'visit'] + fields
+            label_columns = [col for col in columns
+                             if col in self.__code_to_label_dict and not col.endswith('_why')]
+            columns += [f"{col}_label" for col in label_columns]
+
+            # rename once: first the names defined in the form file, then *_age -> *_age_months
+            rename = self.__export_rename[export_name]
+            output_names = {col: re.sub(r'_age$', '_age_months', rename.get(col, col)) for col in columns}
+            age_columns = [col for col in fields if col.endswith('_age')]
+
+            self.__export_plans[export_name] = ExportPlan(
+                export_name=export_name,
+                import_form=self.__import_forms[export_name],
+                form_fields=tuple(export_fields),
+                request_fields=tuple(re.sub(r'___.*', '', field) for field in export_fields),
+                fields=tuple(fields),
+                age_columns=tuple(age_columns),
+                label_maps={col: dict(self.__code_to_label_dict[col]) for col in label_columns},
+                output_names=output_names,
+                renames=dict(rename),
+                dtypes={output_names[col]: 'Int64' for col in age_columns},
+            )
+
+    def get_baseline_event(self):
+        """
+        Event whose record holds the date of birth (baseline_event of the
+        redcap_to_casesdir settings, default: baseline_visit_arm_1)
+        """
+        return self.__baseline_event
+
+    def get_export_plans(self):
+        """
+        ExportPlan of each export form (see save_export_plans)
+        """
+        return dict(self.__export_plans)
+
+    def use_export_plans(self, export_plans):
+        """
+        Export with the given plans instead of the ones compiled by
+        configure (to skip reading the form files, pass saved plans to
+        configure instead)
+        """
+        self.__export_plans = dict(export_plans)
+
+    def use_manifest(self, manifest):
+        """
+        Record the written files in a cases_manifest.CasesManifest (None to
+        stop); unchanged files are then skipped without reading them
+        """
+        self.__manifest = manifest
+
+    def get_manifest(self):
+        return self.__manifest
+
+    def __get_digests__(self, export_name):
+        if self.__manifest is None:
+            return None
+        plan = self.__export_plans.get(export_name)
+        return self.__manifest.digests(plan.version if plan else None, export_name)
+
     # Filter confidential fields from all forms
     def __check_all_forms__(self):
         # Filter each form
@@ -251,11 +347,10 @@ class redcap_to_casesdir(object):
                                    "Question Number (surveys only)",
                                    "Matrix Group Name", "Matrix Ranking?"]
 
-        # Insert standard set of data elements into each datadict.
-        for i in range(3):
-            elements = ['subject', 'arm', 'visit']
-            export_forms_list.insert(i, export_forms_list[0])
-            variable_list.insert(i, elements[i])
+        # Insert standard set of data elements into each datadict
+        # (copies, variable_list usually is the field list of the form)
+        export_forms_list = [export_forms_list[0]] * 3 + list(export_forms_list)
+        variable_list = ['subject', 'arm', 'visit'] + list(variable_list)
 
         if not os.path.exists(datadict_dir):
             os.makedirs(datadict_dir)
@@ -265,38 +360,60 @@ class redcap_to_casesdir(object):
             (re.sub(r'_age$', '_age_months', v) if v.endswith('_age') else v)
             for v in variable_list
         ]
+        # What we write into the datadict and what we look up in metadata (map months back to REDCap name)
+        field_names_out = [re.sub(r'___.*', '', v) for v in out_vars]
+        meta_fields = [re.sub(r'_age_months$', '_age', v) for v in field_names_out]
 
-        ddict = pandas.DataFrame(index=out_vars, columns=redcap_datadict_columns)
-
-        for name_of_form, var_in, var_out in zip(export_forms_list, variable_list, out_vars):
-            # What we write into the datadict
-            field_name_out = re.sub(r'___.*', '', var_out)
-            ddict.loc[var_out, "Variable / Field Name"] = field_name_out
-            ddict.loc[var_out, "Form Name"] = name_of_form
-
-            # What we look up in metadata (map months back to REDCap name)
-            field_name_in = re.sub(r'___.*', '', var_in)
-            meta_field = re.sub(r'_age_months$', '_age', field_name_out)
-
-            if meta_field in self.__metadata_dict:
-                ddict.loc[var_out, "Field Type"] = self.__metadata_dict[meta_field][0]
-                ddict.loc[var_out, "Field Label"] = self.__metadata_dict[meta_field][2]
-                ddict.loc[var_out, "Text Validation Type OR Show Slider Number"] = self.__metadata_dict[meta_field][1]
-                ddict.loc[var_out, "Text Validation Min"] = self.__metadata_dict[meta_field][3]
-                ddict.loc[var_out, "Text Validation Max"] = self.__metadata_dict[meta_field][4]
-                ddict.loc[var_out, "Choices, Calculations, OR Slider Labels"] = self.__metadata_dict[meta_field][5]
+        # Skip the datadict if neither the metadata of its fields nor the export plan changed
+        dicFileName = os.path.join(datadict_dir,datadict_base_file + '_datadict.csv')
+        plan = self.__export_plans.get(datadict_base_file)
+        datadict_hash = hashlib.sha1(json.dumps(
+            [redcap_datadict_columns, export_forms_list, out_vars,
+             [self.__metadata_dict.get(meta_field) for meta_field in meta_fields],
+             plan.version if plan else None], default=str).encode('utf-8')).hexdigest()
+        if self.__get_datadict_hash__(dicFileName) == datadict_hash and os.path.exists(dicFileName):
+            return dicFileName
 
+        # Build the rows as columns of the metadata frame
+        meta_columns = ["Field Type", "Text Validation Type OR Show Slider Number", "Field Label",
+                        "Text Validation Min", "Text Validation Max",
+                        "Choices, Calculations, OR Slider Labels"]
+        metadata = pandas.DataFrame.from_dict(
+            {field: tuple(self.__metadata_dict[field])[:len(meta_columns)]
+             for field in dict.fromkeys(meta_fields) if field in self.__metadata_dict},
+            orient='index', columns=meta_columns, dtype=object)
+        ddict = metadata.reindex(meta_fields)
+        ddict.index = out_vars
+        ddict["Variable / Field Name"] = field_names_out
+        ddict["Form Name"] = export_forms_list
+        ddict = ddict.reindex(columns=redcap_datadict_columns)
 
         # Finally, write the data dictionary to a CSV file
-        dicFileName = os.path.join(datadict_dir,datadict_base_file + '_datadict.csv')
+        digests = None
+        if self.__manifest is not None:
+            digests = self.__manifest.digests(plan.version if plan else None, datadict_base_file + '_datadict',
+                                              source_hash=datadict_hash)
         try:
-            sutils.safe_dataframe_to_csv(ddict,dicFileName)
+            sutils.safe_dataframe_to_csv(ddict,dicFileName,digests=digests)
+            self.__datadict_hashes[dicFileName] = datadict_hash
+            if self.__manifest is not None:
+                self.__manifest.commit()
             return dicFileName
         except Exception as err_msg:
             slog.info('redcap_to_casesdir.__create_datadicts_general__',"ERROR: could not export dictionary" + dicFileName,
                       err_msg = str(err_msg))
             return None
 
+    # Hash of the metadata a datadict was last written with (the manifest
+    # keeps it across runs as the source hash of the file)
+    def __get_datadict_hash__(self, dicFileName):
+        if self.__manifest is not None:
+            entry = self.__manifest.get_entry(dicFileName)
+            if entry is None or self.__manifest.is_modified(dicFileName, entry):
+                return None
+            return entry['source_hash']
+        return self.__datadict_hashes.get(dicFileName)
+
 
     def __ndar_months__(self, dob_ymd: str, ref_ymd: str,
                         fmt: str = sutils.date_format_ymd):
@@ -495,7 +612,8 @@ class redcap_to_casesdir(object):
 
             return sutils.safe_dataframe_to_csv(pandas.DataFrame(series).T,
                                                     target_path,
-                                                    verbose=verbose)
+                                                    verbose=verbose,
+                                                    digests=self.__get_digests__('demographics'))
 
     def update_export_log(self, measures_dir):
         """
@@ -518,9 +636,8 @@ class redcap_to_casesdir(object):
         # ------------------------------------------------------------------
         # 1.  Build initial record
         # ------------------------------------------------------------------
-        complete = f"{self.__import_forms[export_name]}_complete"
-        fields   = [f for f in self.__export_forms[export_name] if f != complete]
-        fields   = [f for f in fields if f not in ('subject', 'arm', 'visit')]
+        plan     = self.__export_plans[export_name]
+        fields   = list(plan.fields)
         record   = all_records[fields].reindex(fields, axis=1)
 
         if len(record) > 1:
@@ -540,11 +657,9 @@ class redcap_to_casesdir(object):
         record = record.copy()                # avoid fragmentation warning
 
         # ------------------------------------------------------------------
-        # 2.  Age conversion + coded-label collectionzd
+        # 2.  Age conversion + coded-label collection
         # ------------------------------------------------------------------
-        label_cols = {}
-        age_cols   = [c for c in record.columns if c.endswith('_age')]
-        record[age_cols] = record[age_cols].astype('object')
+        record[list(plan.age_columns)] = record[list(plan.age_columns)].astype('object')
 
         # === compute ONE month count for this visit (uses all_records) ===
         idx    = all_records.index[0]
@@ -552,25 +667,21 @@ class redcap_to_casesdir(object):
                     all_records.at[idx, 'dob'],
                     all_records.at[idx, 'visit_date'])
 
-        for col in record.columns:
-
-            # -------- age columns → same month value for all ------------
-            if col.endswith('_age'):
-                # is there a value in the incoming record?
-                raw_value = record[col].iloc[0]
-                if pandas.isnull(raw_value) or str(raw_value).strip() == '':
-                    # keep it blank
-                    record.iat[0, record.columns.get_loc(col)] = ''
-                else:
-                    record.iat[0, record.columns.get_loc(col)] = months or ''
-
-            # -------- coded radio/dropdown → extra <col>_label ----------
-            if (col in self.__code_to_label_dict and not col.endswith('_why')):
-                code  = str(record[col].iloc[0])
-                label = self.__code_to_label_dict[col].get(code, '')
-                label_cols[f"{col}_label"] = label
+        # -------- age columns → same month value for all ----------------
+        for col in plan.age_columns:
+            # is there a value in the incoming record?
+            raw_value = record[col].iloc[0]
+            if pandas.isnull(raw_value) or str(raw_value).strip() == '':
+                # keep it blank
+                record.iat[0, record.columns.get_loc(col)] = ''
+            else:
+                record.iat[0, record.columns.get_loc(col)] = months or ''
 
-        # attach any <col>_label columns we collected
+        # -------- coded radio/dropdown → extra <col>_label --------------
+        label_cols = {
+            f"{col}_label": label_map.get(str(record[col].iloc[0]), '')
+            for col, label_map in plan.label_maps.items()
+        }
         if label_cols:
             record = pandas.concat(
                 [record, pandas.DataFrame(label_cols, index=record.index)],
@@ -580,50 +691,105 @@ class redcap_to_casesdir(object):
         # ------------------------------------------------------------------
         # 3.  Final type cast for *_age → Int64 (no decimals)
         # ------------------------------------------------------------------
-        for col in record.columns:
-            if col.endswith('_age'):
-                record[col] = pandas.to_numeric(record[col],
-                                                errors='coerce'
-                                                ).astype('Int64')
+        for col in plan.age_columns:
+            record[col] = pandas.to_numeric(record[col],
+                                            errors='coerce'
+                                            ).astype('Int64')
 
         # ------------------------------------------------------------------
         # 4.  Rename columns *once* after everything is settled
+        #     (incl. *_age -> *_age_months as data are already months)
         # ------------------------------------------------------------------
-        rename_map = {
-            old: self.__export_rename[export_name].get(old, old)
-            for old in record.columns
-        }
-        record.rename(columns=rename_map, inplace=True)
-
-        # ------------------------------------------------------------------
-        # 4b.  Rename *_age -> *_age_months (data are already months)
-        # ------------------------------------------------------------------
-        age_rename = {c: re.sub(r'_age$', '_age_months', c)
-                      for c in record.columns
-                      if c.endswith('_age')}
-        if age_rename:
-            record.rename(columns=age_rename, inplace=True)
-
+        record.rename(columns=plan.output_names, inplace=True)
 
         # ------------------------------------------------------------------
         # 5.  Export
         # ------------------------------------------------------------------
         out_path = os.path.join(measures_dir, f"{export_name}.csv")
-        return sutils.safe_dataframe_to_csv(record, out_path, verbose=verbose)
+        return sutils.safe_dataframe_to_csv(record, out_path, verbose=verbose,
+                                            digests=self.__get_digests__(export_name))
 
-    # First get data for all fields across all forms in this event - this
-    # speeds up transfers over getting each form separately
-    def get_subject_specific_form_data(self,subject,event,forms_this_event, redcap_project,select_exports=None):
+    def export_form_all_visits(self, export_name, records, visits, verbose=False):
+        """
+        Vectorized export_subject_form: export a form for many subject-visits
+        at once and write the same measures/<form>.csv files.
+
+        records: values of the form fields, dob and visit_date as exported
+                 (csv strings), indexed by (record id, redcap_event_name), e.g.,
+                 RedcapPrefetchStore.get_event_records
+        visits: DataFrame with the same index and the columns subject_code,
+                arm_code, visit_code and measures_dir
+
+        Returns the number of files written
+        """
+        plan = self.__export_plans[export_name]
+        fields = list(plan.fields)
+
+        # visits with several records are skipped (as by export_subject_form)
+        duplicated = records.index[records.index.duplicated()].unique()
+        for key in duplicated:
+            if key in visits.index:
+                visit_code = visits.loc[[key], 'visit_code'].iloc[0]
+                slog.info(f"{key[0]}-{visit_code}",
+                          f"ERROR: multiple records for form '{export_name}'!")
+        records = records[~records.index.isin(duplicated)]
+
+        visits = visits[visits.index.isin(records.index) & ~visits.index.duplicated()]
+        records = records.loc[visits.index]
+        if records.empty:
+            return 0
+
+        # parse values as a separate export of each subject-visit would
+        values = _read_csv_rows(records.reindex(columns=fields + ['dob', 'visit_date']))
+        record = pandas.DataFrame({'subject': visits.subject_code, 'arm': visits.arm_code,
+                                   'visit': visits.visit_code})
+        record = pandas.concat([record, values[fields]], axis=1)
+
+        # age columns -> months of the visit (blank stays blank)
+        months = ndar_months(values['dob'], values['visit_date'])
+        months = months.where(months != 0, '')
+        for col in plan.age_columns:
+            blank = record[col].isnull() | (record[col].astype(str).str.strip() == '')
+            record[col] = months.where(~blank, '')
+
+        # coded radio/dropdown -> extra <col>_label
+        label_cols = {f"{col}_label": record[col].map(str).map(label_map).fillna('')
+                      for col, label_map in plan.label_maps.items()}
+        if label_cols:
+            record = pandas.concat([record, pandas.DataFrame(label_cols, index=record.index)], axis=1)
+
+        for col in plan.age_columns:
+            record[col] = pandas.to_numeric(record[col], errors='coerce').astype(plan.dtypes[plan.output_names[col]])
+
+        record = record.rename(columns=plan.output_names)
+
+        # split into the files of the subject-visits
+        digests = self.__get_digests__(export_name)
+        num_files = 0
+        for key, measures_dir in visits.measures_dir.items():
+            if not os.path.exists(measures_dir):
+                os.makedirs(measures_dir)
+            out_path = os.path.join(measures_dir, f"{export_name}.csv")
+            if sutils.safe_dataframe_to_csv(record.loc[[key]], out_path, verbose=verbose, digests=digests):
+                num_files += 1
+
+        if self.__manifest is not None:
+            self.__manifest.commit()
+
+        return num_files
+
+    # Fields (and names of export forms) needed to export the forms of an event
+    def get_export_fields(self, forms_this_event, select_exports=None):
         # define fields and forms to export
         all_fields = ['study_id']
         forbidden_export_fields = ['subject', 'visit', 'arm']
         export_list = []
-        for export_name in list(self.__export_forms.keys()):
+        for export_name, plan in self.__export_plans.items():
             if export_name in forbidden_export_fields:
                 continue
-            if (self.__import_forms[export_name] in forms_this_event):
+            if (plan.import_form in forms_this_event):
                 if (not select_exports or export_name in select_exports):
-                    all_fields += [re.sub(r'___.*', '', field_name) for field_name in self.__export_forms[export_name]]
+                    all_fields += list(plan.request_fields)
                     export_list.append(export_name)
 
         # Remove the fields we are forbidden to export from REDCap
@@ -633,6 +799,19 @@ class redcap_to_casesdir(object):
         always_needed = ['dob', 'visit_date']
         all_fields += always_needed
 
+        return (all_fields, export_list)
+
+    # First get data for all fields across all forms in this event - this
+    # speeds up transfers over getting each form separately
+    def get_subject_specific_form_data(self,subject,event,forms_this_event, redcap_project,select_exports=None, prefetch_store=None):
+        (all_fields, export_list) = self.get_export_fields(forms_this_event, select_exports)
+
+        # Records prefetched for all subjects of the event
+        if prefetch_store is not None and prefetch_store.has_event(event, all_fields):
+            all_records = prefetch_store.get_subject_records(subject, event)
+            all_records['dob'] = prefetch_store.get_dob(subject)
+            return (all_records, export_list)
+
         # Get data
         # all_records = redcap_project.export_records(fields=all_fields,records=[subject], events=[event],format_type='df')
         all_records = sutils.try_redcap_export_records(redcap_project, fields=all_fields,records=[subject], events=[event],format_type='df')
@@ -645,7 +824,7 @@ class redcap_to_casesdir(object):
 
         baseline_dob = sutils.try_redcap_export_records(redcap_project,
             fields=['dob'], records=[subject],
-            events=['baseline_visit_arm_1'], format_type='df'
+            events=[self.__baseline_event], format_type='df'
         ).iloc[0]['dob']
 
         all_records['dob'] = baseline_dob
@@ -653,8 +832,35 @@ class redcap_to_casesdir(object):
         # return results
         return (all_records,export_list)
 
+    def prefetch_records(self, redcap_project, forms_by_event, subjects=None, select_exports=None,
+                         chunk_records=500, max_tries=3, timeout=30, prefetch_store=None):
+        """
+        Export the fields of all subjects (or the given ones) needed by
+        export_subject_all_forms in a few chunked calls per event (instead of
+        two calls per subject and event).
+
+        forms_by_event: dict mapping each event to the forms of that event
+        Returns a RedcapPrefetchStore to be passed to export_subject_all_forms
+        """
+        if prefetch_store is None:
+            prefetch_store = RedcapPrefetchStore(redcap_project.def_field)
+
+        for event, forms_this_event in forms_by_event.items():
+            (all_fields, export_list) = self.get_export_fields(forms_this_event, select_exports)
+            chunks = sutils.redcap_export_records_chunked(
+                redcap_project, chunk_records, max_tries, timeout, records=subjects,
+                fields=all_fields, events=[event], format_type='csv')
+            prefetch_store.add_event_records(event, all_fields, chunks)
+
+        chunks = sutils.redcap_export_records_chunked(
+            redcap_project, chunk_records, max_tries, timeout, records=subjects,
+            fields=[redcap_project.def_field, 'dob'], events=[self.__baseline_event], format_type='csv')
+        prefetch_store.add_dob(chunks)
+
+        return prefetch_store
+
     # Export selected REDCap data to cases dir
-    def export_subject_all_forms(self,redcap_project, site, subject, event, subject_data, visit_age, visit_data, arm_code, visit_code, subject_code, subject_datadir,forms_this_event, exceeds_criteria_baseline, siblings_enrolled_yn_corrected,siblings_id_first_corrected, select_exports=None, force_demo_flag=False, verbose=False):
+    def export_subject_all_forms(self,redcap_project, site, subject, event, subject_data, visit_age, visit_data, arm_code, visit_code, subject_code, subject_datadir,forms_this_event, exceeds_criteria_baseline, siblings_enrolled_yn_corrected,siblings_id_first_corrected, select_exports=None, force_demo_flag=False, verbose=False, prefetch_store=None):
 
         measures_dir = os.path.join(subject_datadir, 'measures')
         if not os.path.exists(measures_dir):
@@ -683,12 +889,106 @@ class redcap_to_casesdir(object):
                 conditional=conditional,
                 verbose=verbose)
 
-        (all_records,export_list) = self.get_subject_specific_form_data(subject,event,forms_this_event, redcap_project, select_exports)
+        (all_records,export_list) = self.get_subject_specific_form_data(subject,event,forms_this_event, redcap_project, select_exports, prefetch_store)
         # Now go form by form and export data
         for export_name in export_list:
             self.export_subject_form(export_name, subject, subject_code, arm_code, visit_code, all_records, measures_dir, verbose)
 
+        # the files of a subject-visit enter the manifest together
+        if self.__manifest is not None:
+            self.__manifest.commit()
+
+
+
+    def export_all_subjects_parallel(self, visits, prefetch_store, max_workers=None, select_exports=None,
+                                     force_demo_flag=False, verbose=False):
+        """
+        Export subject-visits with a pool of max_workers processes (default:
+        number of cpus). Each worker receives this (configured) exporter once
+        and then for each subject-visit only its prefetched records.
+
+        visits: list of dicts with the arguments of export_subject_all_forms
+                (site, subject, event, subject_data, visit_age, visit_data,
+                arm_code, visit_code, subject_code, subject_datadir,
+                forms_this_event, exceeds_criteria_baseline,
+                siblings_enrolled_yn_corrected, siblings_id_first_corrected)
+        prefetch_store: RedcapPrefetchStore covering all visits
+
+        Returns one dict per visit with subject, event, status ('ok' or
+        'error'), seconds and err_msg
+        """
+        tasks = []
+        for visit in visits:
+            visit = dict(visit, select_exports=select_exports, force_demo_flag=force_demo_flag,
+                         verbose=verbose)
+            tasks.append((visit, prefetch_store.subset([visit['subject']], [visit['event']])))
+
+        # workers write to the manifest, so nothing may be left uncommitted
+        if self.__manifest is not None:
+            self.__manifest.commit()
+
+        if max_workers == 1:
+            _init_export_worker(self)
+            results = [_export_subject_visit(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_export_worker,
+                                     initargs=(self,)) as executor:
+                results = list(executor.map(_export_subject_visit, tasks))
+
+        for result in results:
+            slog.observe('sibis_casesdir_export_seconds', result['seconds'], status=result['status'])
+            if result['status'] != 'ok':
+                slog.info(str(result['subject']) + '-' + str(result['event']),
+                          "ERROR: failed to export subject-visit to cases directory",
+                          err_msg=result['err_msg'])
+            elif verbose:
+                print("Exported {0} {1} in {2:.2f}s".format(result['subject'], result['event'],
+                                                            result['seconds']))
+
+        return results
+
+    def export_changed_visits(self, redcap_project, visits, changed_keys, max_workers=None,
+                              select_exports=None, force_demo_flag=False, verbose=False):
+        """
+        Incremental export: export only the subject-visits whose REDCap data
+        changed, i.e., prefetch the records of their subjects and export them
+        with export_all_subjects_parallel. The files, export log and manifest
+        entries of all other subject-visits are left untouched.
+
+        visits: list of dicts with the arguments of export_subject_all_forms
+                (see export_all_subjects_parallel), e.g., of all visits
+        changed_keys: (record id, redcap_event_name) of the changed visits
+                      (a changed baseline exports all visits of the subject)
 
+        Returns the results of export_all_subjects_parallel
+        """
+        changed_keys = set(changed_keys)
+        # the date of birth (for ages) is part of the baseline record, so a
+        # change of the baseline affects all visits of the subject
+        baseline_changed = {subject for (subject, event) in changed_keys if event == self.__baseline_event}
+        visits = [visit for visit in visits
+                  if (visit['subject'], visit['event']) in changed_keys or visit['subject'] in baseline_changed]
+        if not visits:
+            return []
+
+        forms_by_event = dict()
+        for visit in visits:
+            forms_by_event.setdefault(visit['event'], set()).update(visit['forms_this_event'] or [])
+        subjects = sorted({visit['subject'] for visit in visits})
+        prefetch_store = self.prefetch_records(
+            redcap_project, {event: sorted(forms) for event, forms in forms_by_event.items()},
+            subjects=subjects, select_exports=select_exports)
+
+        results = self.export_all_subjects_parallel(visits, prefetch_store, max_workers=max_workers,
+                                                    select_exports=select_exports,
+                                                    force_demo_flag=force_demo_flag, verbose=verbose)
+
+        # mark the exported visits as updated (other visits keep their log)
+        for visit, result in zip(visits, results):
+            if result['status'] == 'ok':
+                self.update_export_log(os.path.join(visit['subject_datadir'], 'measures'))
+
+        return results
 
     # What Arm and Visit of the study is this event?
     def translate_subject_and_event( self, subject_code, event_label):
@@ -759,3 +1059,281 @@ class redcap_to_casesdir(object):
                myfile.write(stdoutdata.decode('utf-8'))
 
         return True
+
+
+# dates as accepted by datetime.strptime(date, '%Y-%m-%d')
+YMD_PATTERN = r'^(\d{4})-(1[0-2]|0[1-9]|[1-9])-(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])$'
+
+
+def ndar_months(dob_ymd, ref_ymd, fmt=sutils.date_format_ymd):
+    """
+    Vectorized redcap_to_casesdir.__ndar_months__: age in whole months for
+    columns of dates of birth and reference dates (same length), computed
+    with numpy datetime64 arithmetic. Returns a Series (with the index of
+    dob_ymd) of ints, and '' where either date is missing.
+    """
+    index = dob_ymd.index if isinstance(dob_ymd, pandas.Series) else None
+    dob = pandas.Series(np.asarray(dob_ymd, dtype=object), dtype=object)
+    ref = pandas.Series(np.asarray(ref_ymd, dtype=object), dtype=object)
+    missing = (dob.isnull() | ref.isnull()).to_numpy()
+
+    if fmt == sutils.date_format_ymd:
+        dob_days = _parse_ymd(dob[~missing])
+        ref_days = _parse_ymd(ref[~missing])
+    else:
+        dob_days = np.array([datetime.datetime.strptime(date, fmt).date() for date in dob[~missing]],
+                            dtype='datetime64[D]')
+        ref_days = np.array([datetime.datetime.strptime(date, fmt).date() for date in ref[~missing]],
+                            dtype='datetime64[D]')
+
+    # DOB floored to the 1st of its month, +1 if the reference date is >= 16 days into its month
+    ref_month = ref_days.astype('datetime64[M]')
+    months = (ref_month - dob_days.astype('datetime64[M]')).astype(np.int64)
+    months += (ref_days - ref_month.astype('datetime64[D]')).astype(np.int64) >= 15
+
+    result = np.full(len(dob), '', dtype=object)
+    result[~missing] = months.tolist()
+    return pandas.Series(result, index=index, dtype=object)
+
+
+def _parse_ymd(dates):
+    parts = dates.astype(str).str.extract(YMD_PATTERN)
+    if parts.isnull().any(axis=None):
+        bad_date = dates[parts.isnull().any(axis=1).to_numpy()].iloc[0]
+        raise ValueError("time data %r does not match format '%s'" % (bad_date, sutils.date_format_ymd))
+
+    years = parts[0].astype(int).to_numpy()
+    if (years < 1).any():
+        raise ValueError("year 0 is out of range")
+    # zero padded iso dates; numpy rejects days out of range just as strptime does
+    iso_dates = ['%04d-%02d-%02d' % ymd for ymd in
+                 zip(years, parts[1].astype(int), parts[2].str.strip().astype(int))]
+    return np.array(iso_dates, dtype='datetime64[D]')
+
+
+class _FrozenDict(Mapping):
+    """
+    Read-only, hashable dict for the mappings of an ExportPlan
+    """
+    def __init__(self, *args, **kwargs):
+        self.__items = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self.__items[key]
+
+    def __iter__(self):
+        return iter(self.__items)
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __hash__(self):
+        return hash(frozenset(self.__items.items()))
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.__items)
+
+
+@dataclass(frozen=True)
+class ExportPlan:
+    """
+    Everything needed to export a form to the cases directory that only
+    depends on the configuration (form file and REDCap metadata). Saved
+    plans can be passed to redcap_to_casesdir.configure instead of the form
+    files:
+
+    form_fields: fields listed in the form file (and the complete field)
+    request_fields: fields to export from REDCap
+    fields: REDCap columns written to the measures file (in that order)
+    age_columns: columns converted to months at the visit
+    label_maps: code -> label dict of each column with a <col>_label column
+    output_names: name in the measures file of each column
+    renames: names defined in the form file (field[name])
+    dtypes: dtypes of the columns of the measures file (after renaming)
+    """
+    export_name: str
+    import_form: str
+    form_fields: tuple
+    request_fields: tuple
+    fields: tuple
+    age_columns: tuple
+    label_maps: Mapping
+    output_names: Mapping
+    renames: Mapping
+    dtypes: Mapping
+
+    # the mappings are stored read-only, so the plan is immutable and hashable
+    def __post_init__(self):
+        object.__setattr__(self, 'label_maps', _FrozenDict(
+            (col, _FrozenDict(label_map)) for col, label_map in self.label_maps.items()))
+        object.__setattr__(self, 'output_names', _FrozenDict(self.output_names))
+        object.__setattr__(self, 'renames', _FrozenDict(self.renames))
+        object.__setattr__(self, 'dtypes', _FrozenDict(self.dtypes))
+
+    def to_dict(self):
+        return dict(export_name=self.export_name, import_form=self.import_form,
+                    form_fields=list(self.form_fields),
+                    request_fields=list(self.request_fields), fields=list(self.fields),
+                    age_columns=list(self.age_columns),
+                    label_maps={col: dict(label_map) for col, label_map in self.label_maps.items()},
+                    output_names=dict(self.output_names), renames=dict(self.renames),
+                    dtypes=dict(self.dtypes))
+
+    @classmethod
+    def from_dict(cls, plan_dict):
+        plan_dict = dict(plan_dict)
+        for key in ['form_fields', 'request_fields', 'fields', 'age_columns']:
+            plan_dict[key] = tuple(plan_dict[key])
+        return cls(**plan_dict)
+
+    @property
+    def version(self):
+        """
+        Hash of the plan - changes whenever the exported files would change
+        because of the configuration
+        """
+        plan_json = json.dumps(self.to_dict(), sort_keys=True)
+        return hashlib.sha1(plan_json.encode('utf-8')).hexdigest()
+
+
+def save_export_plans(export_plans, plans_file):
+    """
+    Write the plans of redcap_to_casesdir.get_export_plans to a json file
+    """
+    plans = {name: plan.to_dict() for name, plan in export_plans.items()}
+    plans_dir = os.path.dirname(os.path.abspath(plans_file))
+    fd, tmp_file = tempfile.mkstemp(dir=plans_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as tmp_fd:
+        json.dump(plans, tmp_fd, indent=1, sort_keys=True)
+    os.replace(tmp_file, plans_file)
+
+
+def load_export_plans(plans_file):
+    with open(plans_file, 'r') as fd:
+        plans = json.load(fd)
+    return {name: ExportPlan.from_dict(plan) for name, plan in plans.items()}
+
+
+def _read_csv_rows(records):
+    """
+    Parse each row of csv strings with pandas.read_csv on its own, just like
+    RedcapPrefetchStore.get_subject_records parses the records of a subject,
+    so that each value gets the type of a separate export of its
+    subject-visit (e.g., an int stays an int even if the value is missing
+    for other visits). Returns a DataFrame of objects with the same index.
+    """
+    rows = [pandas.read_csv(StringIO(records.iloc[[pos]].to_csv(index=False))).astype(object)
+            for pos in range(len(records))]
+    parsed = pandas.concat(rows, ignore_index=True)
+    parsed.index = records.index
+    return parsed
+
+
+# exporter of the worker processes of export_all_subjects_parallel
+_worker_exporter = None
+
+
+def _init_export_worker(exporter):
+    global _worker_exporter
+    _worker_exporter = exporter
+
+
+def _export_subject_visit(task):
+    (visit, prefetch_store) = task
+    start_time = time.time()
+    try:
+        _worker_exporter.export_subject_all_forms(None, prefetch_store=prefetch_store, **visit)
+        status, err_msg = 'ok', None
+    except Exception as err:
+        status, err_msg = 'error', "{0}: {1}".format(type(err).__name__, err)
+
+    return dict(subject=visit['subject'], event=visit['event'], status=status,
+                seconds=time.time() - start_time, err_msg=err_msg)
+
+
+class RedcapPrefetchStore(object):
+    """
+    Records of all subjects of each event (and the baseline date of birth)
+    exported by redcap_to_casesdir.prefetch_records. Values are kept as
+    exported (csv strings) and the records of a subject are parsed just like
+    a separate export of that subject would be, so that the prefetched
+    records yield the same files as the ones exported per subject.
+    """
+    def __init__(self, def_field='study_id'):
+        self.__def_field = def_field
+        self.__fields = dict()
+        self.__records = dict()
+        self.__dob = dict()
+
+    def __read_chunks__(self, chunks):
+        frames = [pandas.read_csv(StringIO(chunk), dtype=str, keep_default_na=False)
+                  for chunk in chunks if chunk.strip()]
+        if not frames:
+            return None
+        return pandas.concat(frames, ignore_index=True)
+
+    def add_event_records(self, event, fields, chunks):
+        """
+        chunks: csv exports of the records of the event
+        """
+        records = self.__read_chunks__(chunks)
+        if records is None:
+            records = pandas.DataFrame(columns=[self.__def_field, 'redcap_event_name'])
+        self.__records[event] = records.set_index(self.__def_field, drop=False)
+        self.__fields[event] = set(fields)
+
+    def add_dob(self, chunks):
+        """
+        chunks: csv exports of the date of birth of the baseline visit
+        """
+        dob = self.__read_chunks__(chunks)
+        if dob is not None:
+            self.__dob.update(zip(dob[self.__def_field], dob['dob']))
+
+    def has_event(self, event, fields=None):
+        if event not in self.__records:
+            return False
+        return not fields or set(fields) <= self.__fields[event]
+
+    def get_event_records(self, event, subjects=None):
+        """
+        Records of all subjects (or the given ones) of an event as exported
+        (csv strings) with the baseline date of birth in column dob
+        """
+        records = self.__records[event]
+        if subjects is not None:
+            records = records[records.index.isin(subjects)]
+        records = records.set_index([self.__def_field, 'redcap_event_name'])
+        dob = [self.__dob.get(subject, '') for subject in records.index.get_level_values(0)]
+        return records.assign(dob=dob)
+
+    def subset(self, subjects, events=None):
+        """
+        Store with the records of the given subjects (and events) only, e.g.,
+        to hand them to a worker process
+        """
+        store = RedcapPrefetchStore(self.__def_field)
+        for event, records in self.__records.items():
+            if events is None or event in events:
+                store.__records[event] = records[records.index.isin(subjects)]
+                store.__fields[event] = self.__fields[event]
+        store.__dob = {subject: self.__dob[subject] for subject in subjects if subject in self.__dob}
+        return store
+
+    def get_subjects(self, event):
+        return self.__records[event].index.unique().tolist()
+
+    def get_subject_records(self, subject, event):
+        """
+        Records of a subject in the format of
+        <redcap_project>.export_records(records=[subject], events=[event], format_type='df')
+        """
+        records = self.__records[event]
+        records = records[records.index == subject]
+        # parse the values as if they were exported for this subject only
+        return pandas.read_csv(StringIO(records.to_csv(index=False)),
+                               index_col=[self.__def_field, 'redcap_event_name'])
+
+    def get_dob(self, subject):
+        dob = self.__dob.get(subject, '')
+        return dob if dob != '' else np.nan
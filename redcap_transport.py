@@ -0,0 +1,180 @@
+##
+##  See COPYING file distributed along with the package for the copyright and license terms
+##
+"""
+REDCap Transport
+================
+Connection pool and retry policy shared by all REDCap projects of a Session.
+
+PyCap sends every api call through a single module-level requests session
+(redcap.request._session). RedcapTransport is mounted on that session for
+the REDCap server so that all projects (import_laptops, import_webcnp,
+data_entry, ...) share one pool of keep-alive connections.
+
+As PyCap offers no session per project, the transport is process-wide: all
+Sessions of a process (and PyCap projects created without a Session) that
+call the same server share it. The first Session connecting to the server
+mounts it with its settings (pool size, retries), later Sessions reuse it,
+and its stats count the calls of all of them. unmount_transport removes it
+again (e.g., in tests).
+
+Failed calls are retried with exponential backoff and jitter. Retries are
+idempotency aware: calls that only read from REDCap (exports, metadata, ...)
+are retried on connection errors, timeouts and transient server errors;
+calls that modify the project (imports, deletes, ...) are only retried if
+the connection could not be established, i.e., the request never reached
+the server.
+"""
+import time
+import random
+import threading
+from urllib.parse import parse_qsl
+
+import urllib3
+import requests
+from requests.adapters import HTTPAdapter
+
+# http status codes indicating that the server is temporarily unavailable
+RETRY_STATUS_CODES = frozenset([429, 502, 503, 504])
+# api actions that change the project
+MODIFYING_ACTIONS = frozenset(["import", "delete", "rename", "switch", "createFolder"])
+
+
+def get_backoff_delay(attempt, backoff_factor=1.0, backoff_max=60.0):
+    """
+    Seconds to wait before retry number attempt (starting at 0): exponential
+    backoff capped at backoff_max with "equal jitter", i.e., the delay is
+    picked uniformly from the upper half of the backoff interval
+    """
+    delay = min(backoff_max, backoff_factor * (2 ** attempt))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def is_idempotent_request(request):
+    """
+    True if the (REDCap api) request can be repeated without side effects
+    """
+    if request.method in ("GET", "HEAD", "OPTIONS"):
+        return True
+
+    # file uploads are multipart (bytes) bodies
+    if not isinstance(request.body, str):
+        return False
+
+    payload = dict(parse_qsl(request.body))
+    return "data" not in payload and payload.get("action") not in MODIFYING_ACTIONS
+
+
+class RedcapTransport(HTTPAdapter):
+    def __init__(self, pool_size=10, max_retries=3, backoff_factor=1.0, backoff_max=60.0):
+        """
+        pool_size: number of keep-alive connections kept to the server
+        max_retries: number of times a failed call is repeated
+        backoff_factor, backoff_max: see get_backoff_delay
+        """
+        self.__max_retries = max_retries
+        self.__backoff_factor = backoff_factor
+        self.__backoff_max = backoff_max
+        self.__stats_lock = threading.Lock()
+        self.reset_stats()
+        # retries are handled in send() so urllib3 must not retry on its own
+        super(RedcapTransport, self).__init__(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=0, pool_block=True
+        )
+
+    def reset_stats(self):
+        with self.__stats_lock:
+            self.__stats = dict(requests=0, retries=0, failures=0, latency_total=0.0, latency_max=0.0)
+
+    def get_stats(self):
+        """
+        Counters since the last reset: number of requests, retries and
+        (finally) failed requests as well as total and max latency in seconds
+        """
+        with self.__stats_lock:
+            return dict(self.__stats)
+
+    def __record__(self, latency, retries, failed):
+        with self.__stats_lock:
+            self.__stats["requests"] += 1
+            self.__stats["retries"] += retries
+            self.__stats["failures"] += int(failed)
+            self.__stats["latency_total"] += latency
+            self.__stats["latency_max"] = max(self.__stats["latency_max"], latency)
+
+    def __is_retryable__(self, request, response, error):
+        if error is not None:
+            # the request never reached the server so it is always safe to repeat
+            return _is_connect_error(error) or is_idempotent_request(request)
+
+        return response.status_code in RETRY_STATUS_CODES and is_idempotent_request(request)
+
+    def send(self, request, **kwargs):
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            response = error = None
+            try:
+                response = super(RedcapTransport, self).send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                error = err
+
+            if attempt >= self.__max_retries or not self.__is_retryable__(request, response, error):
+                break
+
+            if response is not None:
+                response.close()
+            time.sleep(get_backoff_delay(attempt, self.__backoff_factor, self.__backoff_max))
+            attempt += 1
+
+        self.__record__(time.monotonic() - start, attempt,
+                        error is not None or response.status_code >= 500)
+        if error is not None:
+            raise error
+
+        return response
+
+
+def _is_connect_error(error):
+    """
+    True if the connection to the server could not be established
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+
+def get_mounted_transport(server):
+    """
+    The RedcapTransport mounted for the REDCap server (None if there is none)
+    """
+    from redcap import request as redcap_request
+
+    adapter = redcap_request._session.adapters.get(server)
+    return adapter if isinstance(adapter, RedcapTransport) else None
+
+
+def mount_transport(server, transport):
+    """
+    Route all PyCap calls to the given REDCap server through transport (in
+    the whole process, replacing a transport mounted before)
+    """
+    from redcap import request as redcap_request
+
+    redcap_request._session.mount(server, transport)
+    return transport
+
+
+def unmount_transport(server):
+    """
+    Route the PyCap calls to the REDCap server through the default adapter
+    of requests again
+    """
+    from redcap import request as redcap_request
+
+    adapter = redcap_request._session.adapters.pop(server, None)
+    if adapter is not None:
+        adapter.close()
@@ -15,20 +15,27 @@ from builtins import str
 from builtins import object
 from contextlib import contextmanager
 import ast
+import asyncio
 import os
+import json
 import time
 import datetime
 import requests
 import hashlib
 import pandas as pd
-from pandas.io.sql import execute
 import re
 import warnings
+import weakref
 from sibispy.svn_util import SibisSvnClient
 
 
 from sibispy import sibislogger as slog
 from sibispy import config_file_parser as cfg_parser
+from sibispy.redcap_metadata_cache import RedcapMetadataCache, prime_project
+from sibispy.redcap_transport import RedcapTransport, get_mounted_transport, mount_transport
+from sibispy.redcap_id_resolver import RedcapIdResolver
+from sibispy.redcap_link_builder import RedcapLinkBuilder
+from sibispy.redcap_mysql_engine import get_engine_options, instrument_engine, set_statement_timeout
 
 # --------------------------------------------
 # this class was created to capture output from xnat
@@ -42,6 +49,10 @@ try:
 except:
     # for python < 3.8
     from typing_extensions import Literal
+
+# minutes an incremental run looks back before its start (to tolerate clock
+# differences with the REDCap server)
+REDCAP_CHECKPOINT_OVERLAP_MINUTES = 5
  
 class Capturing(list):
     def __enter__(self):
@@ -194,6 +205,11 @@ class Session(object):
 
         self.__active_redcap_project__ = None
         self.__ordered_config_load = False
+        self.__redcap_metadata_cache = None
+        self.__redcap_transport = None
+        self.__redcap_id_resolver = None
+        self.__redcap_link_builder = None
+        self.__redcap_async_limits = weakref.WeakKeyDictionary()
         
         session_global = self
 
@@ -238,18 +254,22 @@ class Session(object):
         if timeFlag:
             slog.startTimer2()
 
-        if api_type == "xnat":
-            connectionPtr = self.__connect_xnat__()
-        elif api_type == "xnat_http":
-            connectionPtr = self.__connect_xnat_http__()
-        elif api_type == "browser_penncnp":
-            connectionPtr = self.__connect_penncnp__(penncnp_HiddenBrowserFlag)
-        elif api_type == "svn_laptop":
-            connectionPtr = self.__connect_svn_laptop__()
-        elif api_type == "redcap_mysql_db":
-            connectionPtr = self.__connect_redcap_mysql__()
-        else:
-            connectionPtr = self.__connect_redcap_project__(api_type)
+        with slog.timer("sibis_connect_seconds", api_type=api_type):
+            if api_type == "xnat":
+                connectionPtr = self.__connect_xnat__()
+            elif api_type == "xnat_http":
+                connectionPtr = self.__connect_xnat_http__()
+            elif api_type == "browser_penncnp":
+                connectionPtr = self.__connect_penncnp__(penncnp_HiddenBrowserFlag)
+            elif api_type == "svn_laptop":
+                connectionPtr = self.__connect_svn_laptop__()
+            elif api_type == "redcap_mysql_db":
+                connectionPtr = self.__connect_redcap_mysql__()
+            else:
+                connectionPtr = self.__connect_redcap_project__(api_type)
+
+        if connectionPtr is None:
+            slog.count("sibis_connect_failures_total", api_type=api_type)
 
         if timeFlag:
             slog.takeTimer2("connect_" + api_type)
@@ -483,6 +503,7 @@ class Session(object):
             return None
 
         try:
+            self.__get_redcap_transport__(cfg)
             data_entry = redcap.Project(
                 cfg.get("server"),
                 cfg.get(api_type + "_token"),
@@ -490,6 +511,12 @@ class Session(object):
             )
             self.api[api_type] = data_entry
 
+            # Initialize project metadata from the local cache (if enabled)
+            if cfg.get("metadata_cache"):
+                entry = self.get_redcap_metadata(api_type)
+                if entry:
+                    prime_project(data_entry, entry)
+
         except KeyError as err:
             slog.info(
                 "session.__connect_redcap_project__",
@@ -512,6 +539,36 @@ class Session(object):
 
         return data_entry
 
+    def __get_redcap_transport__(self, cfg):
+        # one connection pool and retry policy for all redcap projects; it is
+        # process-wide (see redcap_transport), so sessions of the same server share it
+        if self.__redcap_transport is None:
+            self.__redcap_transport = get_mounted_transport(cfg.get("server"))
+
+        if self.__redcap_transport is None:
+            self.__redcap_transport = mount_transport(
+                cfg.get("server"),
+                RedcapTransport(
+                    pool_size=cfg.get("pool_size", 10),
+                    max_retries=cfg.get("max_retries", 3),
+                    backoff_factor=cfg.get("retry_backoff", 1.0),
+                    backoff_max=cfg.get("retry_backoff_max", 60.0),
+                ),
+            )
+
+        return self.__redcap_transport
+
+    def get_redcap_transport_stats(self):
+        """
+        Retry and latency counters of the redcap connection pool (None if no
+        redcap project has been connected yet); the pool is shared by all
+        sessions of the process that connect to the same server
+        """
+        if self.__redcap_transport is None:
+            return None
+
+        return self.__redcap_transport.get_stats()
+
     def __connect_redcap_mysql__(self):
         from sqlalchemy import create_engine
 
@@ -544,7 +601,10 @@ class Session(object):
         )
 
         try:
-            engine = create_engine(connection_string, pool_recycle=3600)
+            engine = create_engine(connection_string, **get_engine_options(cfg))
+            if cfg.get("statement_timeout"):
+                set_statement_timeout(engine, float(cfg.get("statement_timeout")))
+            instrument_engine(engine, cfg.get("slow_statement_seconds", 1.0))
         except Exception as err_msg:
             slog.info(
                 "session.__connect_redcap_mysql__",
@@ -555,6 +615,9 @@ class Session(object):
             return None
 
         self.api["redcap_mysql_db"] = engine
+        # keep the ids loaded by earlier connections
+        if self.__redcap_id_resolver is not None:
+            self.__redcap_id_resolver.engine = engine
 
         return engine
 
@@ -912,12 +975,13 @@ class Session(object):
             slog.startTimer2()
         try:
             #  python if one cannot connect to server then
-            with Capturing() as xnat_output:
+            with Capturing() as xnat_output, slog.timer("sibis_xnat_export_seconds", form=form):
                 xnat_data = list(
                     xnat_api.search(form, fields).where(conditions).items()
                 )
 
         except Exception as err_msg:
+            slog.count("sibis_xnat_export_failures_total", form=form)
             if xnat_output:
                 slog.info(
                     "session.xnat_export_general",
@@ -1016,6 +1080,9 @@ class Session(object):
     def get_redcap_server_address(self):
         return self.__config_usr_data.get_value("redcap", "server")
 
+    def get_redcap_user(self):
+        return self.__config_usr_data.get_value("redcap", "user")
+
     def get_redcap_base_address(self):
         return self.__config_usr_data.get_value("redcap", "base_address")
 
@@ -1068,29 +1135,12 @@ class Session(object):
         # subject_id: e.g. B-00002-F-2
         # name_of_form: e.g. stroop
         # To replace formatted args, do formattable_address % (subject_id, form_name)
-        arm_match = re.search(r"arm_(\d*)", redcap_event_name)
-        if arm_match is None:
-            raise ValueError(f"No arm for {redcap_event_name}")
-        arm_num = int(arm_match.group(1))
-
-        event_descrip = self.get_event_descrip_from_redcap_event_name(redcap_event_name)
-
-        self.connect_server("redcap_mysql_db", True)
-        arm_id = self.get_mysql_arm_id_from_arm_num(arm_num, project_id)
-        event_id = self.get_mysql_event_id(event_descrip, arm_id)
-
-        if not name_of_form:
-            name_of_form = "%s"
-        if not subject_id:
-            subject_id = "%s"
+        if not self.api["redcap_mysql_db"]:
+            self.connect_server("redcap_mysql_db", True)
 
-        base_address = self.get_redcap_base_address()
-        version = str(self.get_redcap_version())
-        formattable_address = (
-            base_address
-            + f"redcap_v{version}/DataEntry/index.php?pid={project_id}&id={subject_id}&event_id={event_id}&page={name_of_form}"
+        return self.get_redcap_link_builder().get_form_address(
+            project_id, redcap_event_name, subject_id, name_of_form
         )
-        return formattable_address
 
     def get_formattable_redcap_subject_address(
         self, project_id: int, arm_num: int, subject_id=None
@@ -1101,17 +1151,18 @@ class Session(object):
         # And 1 optional (if not passed, they will be replaced by the %s placeholder which can be replaced later with the real value):
         # subject_id: e.g. B-00002-F-2
         # To replace formatted args, do formattable_address % (subject_id)
+        return self.get_redcap_link_builder().get_subject_address(
+            project_id, arm_num, subject_id
+        )
 
-        if not subject_id:
-            subject_id = "%s"
+    def get_redcap_link_builder(self):
+        """
+        Link builder that resolves the event ids of links once and reuses them
+        """
+        if self.__redcap_link_builder is None:
+            self.__redcap_link_builder = RedcapLinkBuilder(self)
 
-        base_address = self.get_redcap_base_address()
-        version = str(self.get_redcap_version())
-        formattable_address = (
-            base_address
-            + f"redcap_v{version}/DataEntry/record_home.php?pid={project_id}&arm={arm_num}&id={subject_id}"
-        )
-        return formattable_address
+        return self.__redcap_link_builder
 
     #
     # REDCAP API CALLS
@@ -1134,6 +1185,80 @@ class Session(object):
 
         return self.api[project]
 
+    def get_cache_dir(self):
+        """
+        Directory for local caches (default: ~/.cache/sibispy)
+        """
+        cache_dir = self.__config_usr_data.get_value("cache_dir")
+        if not cache_dir:
+            cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "sibispy")
+        return cache_dir
+
+    def __get_redcap_metadata_cache__(self):
+        if not self.__redcap_metadata_cache:
+            cfg = self.__config_usr_data.get_category("redcap") or {}
+            self.__redcap_metadata_cache = RedcapMetadataCache(
+                os.path.join(self.get_cache_dir(), "redcap_metadata"),
+                max_age=cfg.get("metadata_cache_max_age", 0),
+            )
+        return self.__redcap_metadata_cache
+
+    def __get_redcap_metadata_key__(self, api_type):
+        return "{0}:{1}".format(self.get_redcap_server_address(), api_type)
+
+    def get_redcap_metadata(self, api_type=None, refresh=False):
+        """
+        Metadata of a REDCap project (keys: metadata, field_names,
+        instrument_event_mappings, events, arms, redcap_version) served from
+        the local metadata cache. The cache is only refreshed if the project
+        changed on the server or refresh is set.
+        """
+        if api_type == None:
+            api_type = self.__active_redcap_project__
+
+        red_api = self.api.get(api_type)
+        if not red_api:
+            slog.info(
+                "session.get_redcap_metadata",
+                "Error: " + str(api_type) + " api not defined",
+            )
+            return None
+
+        try:
+            return self.__get_redcap_metadata_cache__().get(
+                self.__get_redcap_metadata_key__(api_type), red_api, refresh=refresh
+            )
+        except Exception as err_msg:
+            slog.info(
+                "session.get_redcap_metadata."
+                + hashlib.sha1(str(err_msg).encode("utf-8")).hexdigest()[0:6],
+                "ERROR: could not retrieve metadata of REDCap project",
+                api_type=api_type,
+                err_msg=str(err_msg),
+            )
+            return None
+
+    def invalidate_redcap_metadata(self, api_type=None):
+        """
+        Remove the cached metadata of a REDCap project (or of all projects if
+        api_type is None)
+        """
+        if api_type == None:
+            self.__get_redcap_metadata_cache__().invalidate()
+        else:
+            self.__get_redcap_metadata_cache__().invalidate(
+                self.__get_redcap_metadata_key__(api_type)
+            )
+
+    def redcap_export_instrument_event_mappings(self, api_type=None):
+        """
+        Cached version of <redcap_project>.export_instrument_event_mappings(format_type='df')
+        """
+        entry = self.get_redcap_metadata(api_type)
+        if entry is None:
+            return None
+        return pd.DataFrame(entry["instrument_event_mappings"])
+
     def get_redcap_version(self):
         api = self.__get_active_redcap_api__()
         if not api:
@@ -1154,6 +1279,51 @@ class Session(object):
     def redcap_export_records(self, time_label, **selectStmt):
         return self.redcap_export_records_from_api(time_label, None, **selectStmt)
 
+    def redcap_export_records_iter(
+        self, time_label, api_type=None, chunk_records=500, max_tries=3, retry_delay=30, **selectStmt
+    ):
+        """
+        Generator that exports records chunk by chunk (chunk_records record ids
+        per request) so that large projects can be processed in constant memory.
+        Each chunk is retried on its own; DataFrame chunks share the same dtypes.
+        """
+        from sibispy import utils as sutils
+
+        if api_type == None:
+            red_api = self.__get_active_redcap_api__()
+        elif api_type in self.api:
+            red_api = self.api[api_type]
+        else:
+            return
+
+        if not red_api:
+            return
+
+        if time_label:
+            slog.startTimer2()
+
+        try:
+            for chunk in sutils.redcap_export_records_chunked(
+                red_api, chunk_records, max_tries, retry_delay, **selectStmt
+            ):
+                slog.count("sibis_redcap_export_chunks_total", api_type=str(api_type or self.__active_redcap_project__))
+                yield chunk
+
+        except Exception as err_msg:
+            slog.count("sibis_redcap_export_failures_total", api_type=str(api_type or self.__active_redcap_project__))
+            slog.info(
+                "session.redcap_export_records_iter",
+                "ERROR: exporting data from REDCap failed at {}".format(time.asctime()),
+                err_msg=str(err_msg),
+                **selectStmt,
+            )
+            raise
+
+        finally:
+            # also if the caller stops early (break, close) or the export fails
+            if time_label:
+                slog.takeTimer2("redcap_export_" + time_label)
+
     def redcap_export_records_from_api(self, time_label, api_type, **selectStmt):
         if api_type == None:
             red_api = self.__get_active_redcap_api__()
@@ -1169,7 +1339,8 @@ class Session(object):
         if time_label:
             slog.startTimer2()
         try:
-            with warnings.catch_warnings(record=True) as w:
+            with warnings.catch_warnings(record=True) as w, \
+                    slog.timer("sibis_redcap_export_seconds", api_type=str(api_type or self.__active_redcap_project__)):
                 redcap_data = red_api.export_records(**selectStmt)
             if len(w):
                 w_str = str(w[-1])
@@ -1187,6 +1358,7 @@ class Session(object):
                     )
 
         except Exception as err_msg:
+            slog.count("sibis_redcap_export_failures_total", api_type=str(api_type or self.__active_redcap_project__))
             slog.info(
                 "session.redcap_export_records",
                 "ERROR: exporting data from REDCap failed at {}".format(time.asctime()),
@@ -1200,6 +1372,178 @@ class Session(object):
 
         return redcap_data
 
+    def redcap_mysql_export_records(
+        self, project_name, fields=None, events=None, records=None, forms=None, api_type=None
+    ):
+        """
+        Read-only fast path of redcap_export_records(format_type='df') that
+        selects the records straight from the REDCap database (requires
+        redcap_mysql_db and the api of the project for its metadata). Dtypes
+        are derived from the metadata as in utils.get_redcap_export_dtypes.
+        See sibispy.redcap_mysql_export for the differences to the API export.
+
+        Returns the records indexed by (record id field, redcap_event_name) or
+        None if the export failed.
+        """
+        from sibispy import utils as sutils
+        from sibispy import redcap_mysql_export
+
+        if api_type == None:
+            api_type = self.__active_redcap_project__
+
+        red_api = self.api.get(api_type)
+        entry = self.get_redcap_metadata(api_type)
+        if not red_api or entry is None:
+            return None
+
+        try:
+            with slog.timer("sibis_redcap_mysql_export_seconds", api_type=str(api_type)):
+                project_id = self.get_redcap_id_resolver().get_project_id(project_name)
+                if fields is not None or forms is not None:
+                    dtype_fields = list(fields or []) + [form + "_complete" for form in forms or []]
+                else:
+                    dtype_fields = None
+                return redcap_mysql_export.export_records(
+                    self.api["redcap_mysql_db"],
+                    self.get_redcap_id_resolver(),
+                    project_id,
+                    entry,
+                    fields=fields,
+                    events=events,
+                    records=records,
+                    forms=forms,
+                    dtypes=sutils.get_redcap_export_dtypes(red_api, dtype_fields),
+                )
+        except Exception as err_msg:
+            slog.count("sibis_redcap_export_failures_total", api_type=str(api_type))
+            slog.info(
+                "session.redcap_mysql_export_records."
+                + hashlib.sha1(str(err_msg).encode("utf-8")).hexdigest()[0:6],
+                "ERROR: exporting data from REDCap database failed at {}".format(time.asctime()),
+                project_name=project_name,
+                err_msg=str(err_msg),
+            )
+            return None
+
+    def __get_redcap_checkpoint_file__(self, checkpoint_name, api_type):
+        return os.path.join(
+            self.get_cache_dir(), "checkpoints", "{0}-{1}.json".format(checkpoint_name, api_type)
+        )
+
+    def get_redcap_checkpoint(self, checkpoint_name, api_type=None):
+        """
+        Time of the last successful incremental export (None if there is none)
+        """
+        if api_type == None:
+            api_type = self.__active_redcap_project__
+
+        checkpoint_file = self.__get_redcap_checkpoint_file__(checkpoint_name, api_type)
+        if not os.path.exists(checkpoint_file):
+            return None
+
+        with open(checkpoint_file, "r") as fd:
+            checkpoint = json.load(fd)
+
+        return datetime.datetime.strptime(checkpoint["since"], "%Y-%m-%d %H:%M:%S")
+
+    def set_redcap_checkpoint(self, checkpoint_name, since, api_type=None):
+        """
+        Atomically store the time of a successful incremental export
+        """
+        import tempfile
+
+        if api_type == None:
+            api_type = self.__active_redcap_project__
+
+        checkpoint_file = self.__get_redcap_checkpoint_file__(checkpoint_name, api_type)
+        checkpoint_dir = os.path.dirname(checkpoint_file)
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        fd, tmp_file = tempfile.mkstemp(dir=checkpoint_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as tmp_fd:
+            json.dump({"since": since.strftime("%Y-%m-%d %H:%M:%S")}, tmp_fd)
+        os.replace(tmp_file, checkpoint_file)
+
+    def advance_redcap_checkpoint(
+        self, checkpoint_name, start_time, api_type=None,
+        overlap_minutes=REDCAP_CHECKPOINT_OVERLAP_MINUTES
+    ):
+        """
+        Store the checkpoint of a successful incremental run that started at
+        start_time: the next run covers all changes since start_time minus
+        overlap_minutes
+        """
+        self.set_redcap_checkpoint(
+            checkpoint_name,
+            start_time - datetime.timedelta(minutes=overlap_minutes),
+            api_type,
+        )
+
+    def redcap_export_changed_records(
+        self, time_label, checkpoint_name, api_type=None, since=None,
+        update_checkpoint=True, overlap_minutes=REDCAP_CHECKPOINT_OVERLAP_MINUTES, **selectStmt
+    ):
+        """
+        Export only those records that were created or modified since the last
+        successful export with the same checkpoint_name (or since the given
+        datetime). Without a checkpoint all records are exported.
+
+        REDCap filters by record (dateRangeBegin), so all events of a changed
+        record are returned. The new checkpoint is the time the export started
+        minus overlap_minutes (to tolerate clock differences with the REDCap
+        server); it is only stored if the export succeeded.
+
+        Returns the exported records in the same format as
+        redcap_export_records or None if the export failed.
+        """
+        if api_type == None:
+            api_type = self.__active_redcap_project__
+
+        if api_type not in self.api or not self.api[api_type]:
+            return None
+
+        red_api = self.api[api_type]
+
+        if since is None:
+            since = self.get_redcap_checkpoint(checkpoint_name, api_type)
+
+        export_start = datetime.datetime.now()
+        if since is not None:
+            # First only determine which records changed as this is cheap
+            changed = self.redcap_export_records_from_api(
+                None, api_type, fields=[red_api.def_field], date_begin=since, format_type="json"
+            )
+            if changed is None:
+                return None
+
+            changed_records = sorted(set(rec[red_api.def_field] for rec in changed))
+            if "records" in selectStmt and selectStmt["records"] is not None:
+                changed_records = [rec for rec in selectStmt["records"] if rec in changed_records]
+
+            if not changed_records:
+                if selectStmt.get("format_type") == "df":
+                    redcap_data = pd.DataFrame()
+                else:
+                    redcap_data = []
+            else:
+                selectStmt["records"] = changed_records
+                redcap_data = self.redcap_export_records_from_api(
+                    time_label, api_type, **selectStmt
+                )
+        else:
+            redcap_data = self.redcap_export_records_from_api(
+                time_label, api_type, **selectStmt
+            )
+
+        if redcap_data is None:
+            return None
+
+        if update_checkpoint:
+            self.advance_redcap_checkpoint(checkpoint_name, export_start, api_type, overlap_minutes)
+
+        return redcap_data
+
     def redcap_import_record_to_api(
         self, records, api_type, error_label, time_label=None
     ):
@@ -1220,9 +1564,11 @@ class Session(object):
         if time_label:
             slog.startTimer2()
         try:
-            import_response = red_api.import_records(records, overwrite="overwrite")
+            with slog.timer("sibis_redcap_import_seconds", api_type=api_type):
+                import_response = red_api.import_records(records, overwrite="overwrite")
 
         except requests.exceptions.RequestException as e:
+            slog.count("sibis_redcap_import_failures_total", api_type=api_type)
             error = "session:redcap_import_record_to_api:Failed to import into REDCap"
             err_list = ast.literal_eval(str(e))["error"].split('","')
             error_label += "-" + hashlib.sha1(str(e).encode("utf-8")).hexdigest()[0:6]
@@ -1235,9 +1581,65 @@ class Session(object):
 
         return import_response
 
+    #
+    # ASYNCHRONOUS REDCAP API CALLS
+    #
+    def __get_redcap_async_limit__(self, api_type):
+        # asyncio semaphores are bound to an event loop, so keep one per loop
+        loop = asyncio.get_running_loop()
+        loop_limits = self.__redcap_async_limits.setdefault(loop, dict())
+        if api_type not in loop_limits:
+            try:
+                cfg = self.__config_usr_data.get_category("redcap") or {}
+            except RuntimeError:
+                # session has not been configured
+                cfg = {}
+            loop_limits[api_type] = asyncio.Semaphore(cfg.get("async_concurrency", 4))
+
+        return loop_limits[api_type]
+
+    async def aredcap_export_records(self, api_type=None, **selectStmt):
+        """
+        Asynchronous version of redcap_export_records_from_api. At most
+        'async_concurrency' (redcap config section, default 4) requests per
+        project are sent at the same time; all of them share the keep-alive
+        connection pool of the REDCap client.
+        """
+        if api_type == None:
+            api_type = self.__active_redcap_project__
+
+        async with self.__get_redcap_async_limit__(api_type):
+            return await asyncio.to_thread(
+                self.redcap_export_records_from_api, None, api_type, **selectStmt
+            )
+
+    async def aredcap_import_records(
+        self, records, api_type=None, error_label="session.aredcap_import_records"
+    ):
+        """
+        Asynchronous version of redcap_import_record_to_api
+        """
+        if api_type == None:
+            api_type = self.__active_redcap_project__
+
+        async with self.__get_redcap_async_limit__(api_type):
+            return await asyncio.to_thread(
+                self.redcap_import_record_to_api, records, api_type, error_label
+            )
+
     def redcap_import_record(
-        self, error_label, subject_label, event, time_label, records, record_id=None, import_format="df"
+        self, error_label, subject_label, event, time_label, records, record_id=None, import_format="df",
+        max_workers=None
     ):
+        """
+        Import records into the active REDCap project.
+
+        DataFrames and lists are sent in batches of 500 records. By default the
+        batches are submitted one after another; setting max_workers > 1 sends
+        them concurrently through a bounded thread pool. Each failing batch is
+        reported separately (including the locked-form diagnostics) and the
+        function returns None if any batch failed.
+        """
         if len(records) == 0:
             return None
 
@@ -1247,220 +1649,265 @@ class Session(object):
 
         if time_label:
             slog.startTimer2()
-        try:
-            # REDCap imports require the record id to be a real column, not only an
-            # index level. Name unnamed index levels before reset_index() so the id
-            # column is preserved correctly.
-            if isinstance(records, pd.DataFrame) and isinstance(records.index, pd.MultiIndex):
-                imp_records = records.copy()
 
-                index_names = list(imp_records.index.names)
-                if index_names[0] is None:
-                    index_names[0] = red_api.def_field
+        # REDCap imports require the record id to be a real column, not only an
+        # index level. Name unnamed index levels before reset_index() so the id
+        # column is preserved correctly.
+        if isinstance(records, pd.DataFrame) and isinstance(records.index, pd.MultiIndex):
+            imp_records = records.copy()
 
-                imp_records.index = imp_records.index.set_names(index_names)
-                imp_records = imp_records.reset_index(drop=False)
+            index_names = list(imp_records.index.names)
+            if index_names[0] is None:
+                index_names[0] = red_api.def_field
 
-            elif isinstance(records, pd.DataFrame) and red_api.def_field not in records.columns:
-                imp_records = records.reset_index(drop=False)
+            imp_records.index = imp_records.index.set_names(index_names)
+            imp_records = imp_records.reset_index(drop=False)
 
-                if red_api.def_field not in imp_records.columns and "index" in imp_records.columns:
-                    imp_records = imp_records.rename(columns={"index": red_api.def_field})
+        elif isinstance(records, pd.DataFrame) and red_api.def_field not in records.columns:
+            imp_records = records.reset_index(drop=False)
 
-            else:
-                imp_records = records
+            if red_api.def_field not in imp_records.columns and "index" in imp_records.columns:
+                imp_records = imp_records.rename(columns={"index": red_api.def_field})
 
-            batch_size = 500
-            batch_responses = []
-
-            if isinstance(imp_records, pd.DataFrame):
-                for start in range(0, len(imp_records), batch_size):
-                    batch = imp_records.iloc[start:start + batch_size]
-                    batch_response = red_api.import_records(
-                        batch,
-                        overwrite="overwrite",
-                        import_format=import_format,
-                        return_format_type="json",
-                    )
-                    batch_responses.append(batch_response)
-
-            elif isinstance(imp_records, list):
-                for start in range(0, len(imp_records), batch_size):
-                    batch = imp_records[start:start + batch_size]
-                    batch_response = red_api.import_records(
-                        batch,
-                        overwrite="overwrite",
-                        import_format=import_format,
-                        return_format_type="json",
-                    )
-                    batch_responses.append(batch_response)
+        else:
+            imp_records = records
 
-            else:
-                import_response = red_api.import_records(
-                    imp_records,
+        def import_batch(batch):
+            with slog.timer("sibis_redcap_import_seconds", api_type=str(self.__active_redcap_project__)):
+                return red_api.import_records(
+                    batch,
                     overwrite="overwrite",
                     import_format=import_format,
                     return_format_type="json",
                 )
 
-            if isinstance(imp_records, (pd.DataFrame, list)):
-                if all(isinstance(resp, dict) and "count" in resp for resp in batch_responses):
-                    import_response = {"count": sum(resp["count"] for resp in batch_responses)}
-                else:
-                    import_response = batch_responses
-
-        except requests.exceptions.RequestException as e:
-            error = "session:redcap_import_record:Failed to import into REDCap"
+        if not isinstance(imp_records, (pd.DataFrame, list)):
             try:
-                err_list = ast.literal_eval(str(e))["error"].split('","')
-            except:
-                err_list = [str(e)]
+                import_response = import_batch(imp_records)
+            except requests.exceptions.RequestException as e:
+                self.__log_redcap_import_error__(
+                    e, records, error_label, subject_label, event, record_id
+                )
+                return None
 
-            error_label += "-" + hashlib.sha1(str(e).encode("utf-8")).hexdigest()[0:6]
+        else:
+            # (batch to import, matching slice of the original records that is
+            # used for error reporting)
+            batch_size = 500
+            batches = []
+            for start in range(0, len(imp_records), batch_size):
+                if isinstance(imp_records, pd.DataFrame):
+                    batches.append((imp_records.iloc[start:start + batch_size],
+                                    records.iloc[start:start + batch_size]))
+                else:
+                    batches.append((imp_records[start:start + batch_size],
+                                    records[start:start + batch_size]))
 
-            if len(records) > 1:
-                slog.info(
-                    error_label,
-                    error,
-                    requestError=str(e),
-                    red_api=self.__active_redcap_project__,
-                )
+            batch_responses = []
+            failed_batches = []
+            if max_workers and max_workers > 1 and len(batches) > 1:
+                from concurrent.futures import ThreadPoolExecutor
 
-            else:
-                if isinstance(records, list):
-                    record = records[0]
-                    record_event = None
-                elif isinstance(records, pd.DataFrame):
-                    record_ser = records.iloc[0]
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+                    futures = [executor.submit(import_batch, batch) for (batch, _) in batches]
 
-                    # MultiIndex now hidden in pd.Series.name
+                # Collect in submission order so that responses line up with batches
+                for future, (_, orig_batch) in zip(futures, batches):
                     try:
-                        subject_label, record_event = record_ser.name
-                    except ValueError:
-                        # fallback if unpacking applied to single-index
-                        # non-longitudinal projects
-                        subject_label = record_ser.name[0]
-                        record_event = None
-
-                    error_label = "_".join(map(str, record_ser.name)) + "_" + error_label
-                    record = record_ser.to_dict()
-                else:
-                    slog.info(
-                        error_label,
-                        "ERROR: session:redcap_import_record: type is not yet implemented",
-                        import_record_id=str(record_id),
-                        requestError=str(e),
-                        red_api=self.__active_redcap_project__,
+                        batch_responses.append(future.result())
+                    except requests.exceptions.RequestException as e:
+                        failed_batches.append((e, orig_batch))
+            else:
+                for (batch, orig_batch) in batches:
+                    try:
+                        batch_responses.append(import_batch(batch))
+                    except requests.exceptions.RequestException as e:
+                        failed_batches.append((e, orig_batch))
+                        break
+
+            if failed_batches:
+                for (e, orig_batch) in failed_batches:
+                    self.__log_redcap_import_error__(
+                        e, orig_batch, error_label, subject_label, event, record_id
                     )
+                return None
 
-                if (
-                    len(err_list) > 3
-                    and "This field is located on a form that is locked. You must first unlock this form for this record."
-                    in err_list[3]
-                ):
-                    red_var = err_list[1]
+            if all(isinstance(resp, dict) and "count" in resp for resp in batch_responses):
+                import_response = {"count": sum(resp["count"] for resp in batch_responses)}
+            else:
+                import_response = batch_responses
 
-                    try:
-                        event = err_list[0].split("(")[1][:-1]
-                    except IndexError:  # Try to obtain event from record if unextractable from error
-                        if record_event is not None:
-                            event = record_event
-                        # otherwise, `event` stays as passed in function args
-
-                    if subject_label and event is not None:
-                        red_value_temp = self.redcap_export_records(
-                            False,
-                            fields=[red_var],
-                            records=[subject_label],
-                            events=[event],
+        if time_label:
+            slog.takeTimer2("redcap_import_" + time_label, str(import_response))
+
+        return import_response
+
+    def __log_redcap_import_error__(
+        self, e, records, error_label, subject_label, event, record_id
+    ):
+        # Report a failed import of records (or a batch of them); if a single
+        # record failed because its form is locked, the current REDCap value is
+        # added to the report
+        slog.count("sibis_redcap_import_failures_total", api_type=str(self.__active_redcap_project__))
+        error = "session:redcap_import_record:Failed to import into REDCap"
+        try:
+            err_list = ast.literal_eval(str(e))["error"].split('","')
+        except:
+            err_list = [str(e)]
+
+        error_label += "-" + hashlib.sha1(str(e).encode("utf-8")).hexdigest()[0:6]
+
+        if len(records) > 1:
+            slog.info(
+                error_label,
+                error,
+                requestError=str(e),
+                red_api=self.__active_redcap_project__,
+            )
+            return
+
+        if isinstance(records, list):
+            record = records[0]
+            record_event = None
+        elif isinstance(records, pd.DataFrame):
+            record_ser = records.iloc[0]
+
+            # MultiIndex now hidden in pd.Series.name
+            try:
+                subject_label, record_event = record_ser.name
+            except ValueError:
+                # fallback if unpacking applied to single-index
+                # non-longitudinal projects
+                subject_label = record_ser.name[0]
+                record_event = None
+
+            error_label = "_".join(map(str, record_ser.name)) + "_" + error_label
+            record = record_ser.to_dict()
+        else:
+            slog.info(
+                error_label,
+                "ERROR: session:redcap_import_record: type is not yet implemented",
+                import_record_id=str(record_id),
+                requestError=str(e),
+                red_api=self.__active_redcap_project__,
+            )
+            return
+
+        if (
+            len(err_list) > 3
+            and "This field is located on a form that is locked. You must first unlock this form for this record."
+            in err_list[3]
+        ):
+            red_var = err_list[1]
+
+            try:
+                event = err_list[0].split("(")[1][:-1]
+            except IndexError:  # Try to obtain event from record if unextractable from error
+                if record_event is not None:
+                    event = record_event
+                # otherwise, `event` stays as passed in function args
+
+            if subject_label and event is not None:
+                red_value_temp = self.redcap_export_records(
+                    False,
+                    fields=[red_var],
+                    records=[subject_label],
+                    events=[event],
+                )
+                if red_value_temp:
+                    red_value = red_value_temp[0][red_var]
+                    if (
+                        "mri_xnat_sid" not in record
+                        or "mri_xnat_eids" not in record
+                    ):
+                        slog.info(
+                            error_label,
+                            error,
+                            redcap_variable=red_var,
+                            redcap_event=event,
+                            redcap_value="'" + str(red_value) + "'",
+                            new_value="'" + str(err_list[2]) + "'",
+                            import_record_id=str(record_id),
+                            requestError=str(e),
+                            red_api=self.__active_redcap_project__,
                         )
-                        if red_value_temp:
-                            red_value = red_value_temp[0][red_var]
-                            if (
-                                "mri_xnat_sid" not in record
-                                or "mri_xnat_eids" not in record
-                            ):
-                                slog.info(
-                                    error_label,
-                                    error,
-                                    redcap_variable=red_var,
-                                    redcap_event=event,
-                                    redcap_value="'" + str(red_value) + "'",
-                                    new_value="'" + str(err_list[2]) + "'",
-                                    import_record_id=str(record_id),
-                                    requestError=str(e),
-                                    red_api=self.__active_redcap_project__,
-                                )
-                            else:
-                                slog.info(
-                                    error_label,
-                                    error,
-                                    redcap_value="'" + str(red_value) + "'",
-                                    redcap_variable=red_var,
-                                    redcap_event=event,
-                                    new_value="'" + str(err_list[2]) + "'",
-                                    xnat_sid=record["mri_xnat_sid"],
-                                    xnat_eid=record["mri_xnat_eids"],
-                                    requestError=str(e),
-                                    red_api=self.__active_redcap_project__,
-                                )
-                        else:
-                            slog.info(
-                                error_label,
-                                error,
-                                redcap_variable=red_var,
-                                redcap_event=event,
-                                new_value="'" + str(err_list[2]) + "'",
-                                import_record_id=str(record_id),
-                                requestError=str(e),
-                                red_api=self.__active_redcap_project__,
-                            )
                     else:
                         slog.info(
                             error_label,
                             error,
+                            redcap_value="'" + str(red_value) + "'",
                             redcap_variable=red_var,
                             redcap_event=event,
                             new_value="'" + str(err_list[2]) + "'",
-                            import_record_id=str(record_id),
+                            xnat_sid=record["mri_xnat_sid"],
+                            xnat_eid=record["mri_xnat_eids"],
                             requestError=str(e),
                             red_api=self.__active_redcap_project__,
                         )
-
-                elif "mri_xnat_sid" not in record or "mri_xnat_eids" not in record:
-                    slog.info(
-                        error_label,
-                        error,
-                        import_record_id=str(record_id),
-                        requestError=str(e),
-                        red_api=self.__active_redcap_project__,
-                    )
                 else:
                     slog.info(
                         error_label,
                         error,
-                        xnat_sid=record["mri_xnat_sid"],
-                        xnat_eid=record["mri_xnat_eids"],
+                        redcap_variable=red_var,
+                        redcap_event=event,
+                        new_value="'" + str(err_list[2]) + "'",
+                        import_record_id=str(record_id),
                         requestError=str(e),
                         red_api=self.__active_redcap_project__,
                     )
-            return None
+            else:
+                slog.info(
+                    error_label,
+                    error,
+                    redcap_variable=red_var,
+                    redcap_event=event,
+                    new_value="'" + str(err_list[2]) + "'",
+                    import_record_id=str(record_id),
+                    requestError=str(e),
+                    red_api=self.__active_redcap_project__,
+                )
 
-        if time_label:
-            slog.takeTimer2("redcap_import_" + time_label, str(import_response))
+        elif "mri_xnat_sid" not in record or "mri_xnat_eids" not in record:
+            slog.info(
+                error_label,
+                error,
+                import_record_id=str(record_id),
+                requestError=str(e),
+                red_api=self.__active_redcap_project__,
+            )
+        else:
+            slog.info(
+                error_label,
+                error,
+                xnat_sid=record["mri_xnat_sid"],
+                xnat_eid=record["mri_xnat_eids"],
+                requestError=str(e),
+                red_api=self.__active_redcap_project__,
+            )
 
-        return import_response
+    def get_redcap_id_resolver(self):
+        """
+        Resolver of project, arm and event ids of the REDCap MySQL database;
+        the lookup tables are read once - call refresh() on the resolver to
+        pick up changes
+
+        :return: RedcapIdResolver
+        """
+        if self.__redcap_id_resolver is None:
+            self.__redcap_id_resolver = RedcapIdResolver(self.api["redcap_mysql_db"])
+
+        return self.__redcap_id_resolver
 
     def get_mysql_project_id(self, project_name):
         """
         Get the project ID from a project_name
 
         :param project_name: str
-        :param engine: sqlalchemy.Engine
         :return: int
         """
+        resolver = self.get_redcap_id_resolver()
         try:
-            projects = pd.read_sql_table("redcap_projects", self.api["redcap_mysql_db"])
+            resolver.load()
         except Exception as err_msg:
             slog.info(
                 "session.get_mysql_project_id."
@@ -1471,8 +1918,8 @@ class Session(object):
             )
             return None
 
-        project_id = projects[projects.project_name == project_name].project_id
-        return int(project_id.iloc[0])
+        # an unknown project raises KeyError
+        return resolver.get_project_id(project_name)
 
     def get_mysql_arm_id(self, arm_name, project_id):
         """
@@ -1482,25 +1929,17 @@ class Session(object):
         :param project_id: int
         :return: int
         """
-        arms = pd.read_sql_table("redcap_events_arms", self.api["redcap_mysql_db"])
-        arm_id = arms[
-            (arms.arm_name == arm_name) & (arms.project_id == project_id)
-        ].arm_id
-        return int(arm_id.iloc[0])
+        return self.get_redcap_id_resolver().get_arm_id(arm_name, project_id)
 
     def get_mysql_arm_id_from_arm_num(self, arm_num, project_id):
         """
-        Get an arm_id using the arm name and project_id
+        Get an arm_id using the arm number and project_id
 
-        :param arm_name: int
+        :param arm_num: int
         :param project_id: int
         :return: int
         """
-        arms = pd.read_sql_table("redcap_events_arms", self.api["redcap_mysql_db"])
-        arm_id = arms[
-            (arms.arm_num == arm_num) & (arms.project_id == project_id)
-        ].arm_id
-        return int(arm_id.iloc[0])
+        return self.get_redcap_id_resolver().get_arm_id_from_arm_num(arm_num, project_id)
 
     def get_mysql_event_id(self, event_descrip, arm_id):
         """
@@ -1510,13 +1949,7 @@ class Session(object):
         :param arm_id: int
         :return: int
         """
-        events = pd.read_sql_table(
-            "redcap_events_metadata", self.api["redcap_mysql_db"]
-        )
-        event_id = events[
-            (events.descrip == event_descrip) & (events.arm_id == arm_id)
-        ].event_id
-        return int(event_id.iloc[0])
+        return self.get_redcap_id_resolver().get_event_id(event_descrip, arm_id)
 
     # 'redcap_locking_data'
     def get_mysql_table_records(
@@ -1527,24 +1960,48 @@ class Session(object):
         event_descrip=None,
         name_of_form=None,
         subject_id=None,
+        columns=None,
     ):
         """
-        Get a dataframe of forms for a specific event
+        Get a dataframe of forms for a specific event; the filters are
+        evaluated by the database
 
+        :param table_name: str
         :param project_name: str
         :param arm_name: str
         :param event_descrip: str
+        :param name_of_form: str
+        :param subject_id: str or list of str
+        :param columns: list of columns to return (default: all)
         :return: pandas.DataFrame`
         """
-        table_record_df = pd.read_sql_table(table_name, self.api["redcap_mysql_db"])
-        return self.get_mysql_table_records_from_dataframe(
-            table_record_df,
-            project_name,
-            arm_name=arm_name,
-            event_descrip=event_descrip,
-            name_of_form=name_of_form,
-            subject_id=subject_id,
-        )
+        from sqlalchemy import select, table, column, literal_column
+
+        project_id = self.get_mysql_project_id(project_name)
+        if not project_id:
+            return pd.DataFrame()
+
+        if columns:
+            stmt = select(*[column(col) for col in columns])
+        else:
+            stmt = select(literal_column("*"))
+        stmt = stmt.select_from(table(table_name)).where(column("project_id") == project_id)
+
+        if event_descrip and arm_name:
+            arm_id = self.get_mysql_arm_id(arm_name, project_id)
+            event_id = self.get_mysql_event_id(event_descrip, arm_id)
+            stmt = stmt.where(column("event_id") == event_id)
+
+        if name_of_form:
+            stmt = stmt.where(column("form_name") == name_of_form)
+
+        if subject_id:
+            if isinstance(subject_id, str):
+                stmt = stmt.where(column("record") == subject_id)
+            else:
+                stmt = stmt.where(column("record").in_(list(subject_id)))
+
+        return pd.read_sql_query(stmt, self.api["redcap_mysql_db"])
 
     def get_mysql_table_records_from_dataframe(
         self,
@@ -1597,24 +2054,26 @@ class Session(object):
         :param engine: `sqlalchemy.Engine`
         :return: `pandas.DataFrame`
         """
+        from sqlalchemy import text
+
         project_id = self.get_mysql_project_id(project_name)
         if not project_id:
-            return pandas.DataFrame()
+            return pd.DataFrame()
 
         arm_id = self.get_mysql_arm_id(arm_name, project_id)
         event_id = self.get_mysql_event_id(event_descrip, arm_id)
         sql = (
             "SELECT DISTINCT record "
             "FROM redcap.redcap_data AS rd "
-            "WHERE rd.project_id = {0} "
-            "AND rd.event_id = {1}".format(project_id, event_id)
+            "WHERE rd.project_id = :project_id "
+            "AND rd.event_id = :event_id"
         )
+        params = dict(project_id=project_id, event_id=event_id)
         if subject_id:
-            sql += " AND rd.record = '{0}';".format(subject_id)
-        else:
-            sql += ";"
+            sql += " AND rd.record = :subject_id"
+            params["subject_id"] = subject_id
 
-        return pd.read_sql_query(sql, self.api["redcap_mysql_db"])
+        return pd.read_sql_query(text(sql), self.api["redcap_mysql_db"], params=params)
 
     def delete_mysql_table_records(self, table_name, record_list):
         sql = (
@@ -1624,8 +2083,10 @@ class Session(object):
             + table_name
             + ".ld_id IN ({0});".format(record_list)
         )
-        with self.api["redcap_mysql_db"].connect() as conn:
-            execute(sql, conn)
+        from sqlalchemy import text
+
+        with self.api["redcap_mysql_db"].begin() as conn:
+            conn.execute(text(sql))
 
         return len(record_list)
 
@@ -16,6 +16,11 @@ import logging as log
 import collections
 import time 
 import os
+import atexit
+import random
+import tempfile
+import threading
+import functools
 from . import post_issues_to_github as pig
 # set logger of python packages to warning so that we avoid info messages being printed out 
 #logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -121,18 +126,14 @@ class sibisLogging(object):
         else : 
             self.fileTime = timerFile
 
+    # timers always feed the metrics registry, the time log only if initiated
     def startTimer1(self):
-        if self.fileTime  :
-            self.startTime1 = time.time()
+        self.startTime1 = time.time()
 
     def startTimer2(self):
-        if self.fileTime  :
-            self.startTime2 = time.time()
+        self.startTime2 = time.time()
 
     def _stopTimerGeneral(self,timerID,label=None,info=None):
-        if not self.fileTime : 
-            return 
-            
         if timerID == 1: 
             startTimer= self.startTime1
         else :
@@ -142,6 +143,17 @@ class sibisLogging(object):
             return
 
         endTimer=time.time()
+        metrics.observe("sibis_timer_seconds", endTimer - startTimer, label=str(label))
+        self.logTiming(startTimer, endTimer, label, info)
+
+    def logTiming(self,startTimer,endTimer,label=None,info=None):
+        """
+        Append a line with start and end time (in seconds since the epoch)
+        to the time log
+        """
+        if not self.fileTime :
+            return
+
         time_date_format = '%Y-%m-%d %H:%M:%S'
         time_diff = int(1000*(endTimer - startTimer))
         time_diff_sec = int(old_div(time_diff, 1000))
@@ -178,6 +190,212 @@ class sibisLogging(object):
         self._stopTimerGeneral(2,label,info)
 
 
+class MetricsRegistry(object):
+    """
+    Collects counters and latency histograms (e.g., of timers) in memory.
+    Each series is identified by its name and labels (e.g., api_type,
+    instrument). Timers can be nested: a timer started while another one is
+    running in the same thread is recorded with the name of the outer timer
+    as additional label 'parent'.
+    """
+    # number of observations kept per histogram to compute percentiles
+    max_samples = 10000
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__flush_file = None
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__counters = collections.OrderedDict()
+            self.__histograms = collections.OrderedDict()
+
+    @staticmethod
+    def __key__(name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def count(self, name, value=1, **labels):
+        key = self.__key__(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self.__key__(name, labels)
+        with self.__lock:
+            hist = self.__histograms.setdefault(key, dict(count=0, sum=0.0, samples=[]))
+            hist["count"] += 1
+            hist["sum"] += value
+            # reservoir sampling keeps the percentiles representative for long runs
+            if len(hist["samples"]) < self.max_samples:
+                hist["samples"].append(value)
+            else:
+                idx = random.randrange(hist["count"])
+                if idx < self.max_samples:
+                    hist["samples"][idx] = value
+
+    def timer(self, name, **labels):
+        return MetricsTimer(self, name, labels)
+
+    def _get_timer_stack(self):
+        if not hasattr(self.__local, "stack"):
+            self.__local.stack = []
+        return self.__local.stack
+
+    def get_counter(self, name, **labels):
+        with self.__lock:
+            return self.__counters.get(self.__key__(name, labels), 0)
+
+    def get_histogram(self, name, **labels):
+        """
+        Summary of a histogram: count, sum, p50, p95 and p99 (None if the
+        series does not exist)
+        """
+        with self.__lock:
+            hist = self.__histograms.get(self.__key__(name, labels))
+            if hist is None:
+                return None
+            return self.__summarize__(hist)
+
+    @staticmethod
+    def __summarize__(hist):
+        samples = sorted(hist["samples"])
+        summary = collections.OrderedDict(count=hist["count"], sum=hist["sum"])
+        for quantile in [50, 95, 99]:
+            # nearest-rank percentile
+            idx = max(0, -(-quantile * len(samples) // 100) - 1)
+            summary["p" + str(quantile)] = samples[idx]
+        return summary
+
+    def to_prometheus(self):
+        """
+        Metrics in the Prometheus text exposition format (counters as
+        counter, histograms as summary)
+        """
+        def format_labels(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            if not labels:
+                return ""
+            return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                  for k, v in labels) + "}"
+
+        lines = []
+        with self.__lock:
+            typed = set()
+            for (name, labels), value in self.__counters.items():
+                if name not in typed:
+                    lines.append("# TYPE %s counter" % name)
+                    typed.add(name)
+                lines.append("%s%s %s" % (name, format_labels(labels), value))
+
+            for (name, labels), hist in self.__histograms.items():
+                if name not in typed:
+                    lines.append("# TYPE %s summary" % name)
+                    typed.add(name)
+                summary = self.__summarize__(hist)
+                for quantile, pkey in [("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")]:
+                    lines.append("%s%s %s" % (name, format_labels(labels, quantile=quantile), summary[pkey]))
+                lines.append("%s_sum%s %s" % (name, format_labels(labels), summary["sum"]))
+                lines.append("%s_count%s %s" % (name, format_labels(labels), summary["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    def to_json_lines(self):
+        """
+        One json object per series
+        """
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        lines = []
+        with self.__lock:
+            for (name, labels), value in self.__counters.items():
+                lines.append(json.dumps(collections.OrderedDict(
+                    time=stamp, name=name, type="counter", labels=dict(labels), value=value)))
+            for (name, labels), hist in self.__histograms.items():
+                entry = collections.OrderedDict(time=stamp, name=name, type="histogram", labels=dict(labels))
+                entry.update(self.__summarize__(hist))
+                lines.append(json.dumps(entry))
+
+        return lines
+
+    def flush(self, metrics_file=None):
+        """
+        Write the metrics to metrics_file (or the file defined via
+        set_flush_file): files ending on '.prom' are (re)written as Prometheus
+        textfile, all others are appended to as json lines
+        """
+        metrics_file = metrics_file or self.__flush_file
+        if not metrics_file:
+            return
+
+        try:
+            if metrics_file.endswith(".prom"):
+                # the textfile collector must never see a partially written file
+                fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(metrics_file)), suffix=".tmp")
+                with os.fdopen(fd, "w") as tmp_fd:
+                    tmp_fd.write(self.to_prometheus())
+                os.replace(tmp_file, metrics_file)
+            else:
+                lines = self.to_json_lines()
+                if lines:
+                    with open(metrics_file, "a") as fd:
+                        fd.write("\n".join(lines) + "\n")
+
+        except Exception as err_msg:
+            print(json.dumps(collections.OrderedDict(
+                experiment_site_id="sibislogger.MetricsRegistry.flush",
+                error="Error: Failed to write metrics to file",
+                metrics_file=metrics_file, err_msg=str(err_msg))))
+
+    def set_flush_file(self, metrics_file):
+        """
+        Flush the metrics to metrics_file when the program exits
+        """
+        if self.__flush_file is None:
+            atexit.register(self.flush)
+        self.__flush_file = metrics_file
+
+
+class MetricsTimer(object):
+    """
+    Records the elapsed seconds of a code block (with metrics.timer(...):) or
+    of each call of a function (@metrics.timer(...)) in a histogram
+    """
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        stack = self.registry._get_timer_stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+        stack = self.registry._get_timer_stack()
+        # generators may finish their timers out of order
+        if self in stack:
+            stack.remove(self)
+
+        labels = dict(self.labels)
+        if self.parent:
+            labels["parent"] = self.parent
+        self.registry.observe(self.name, self.elapsed, **labels)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with MetricsTimer(self.registry, self.name, self.labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
 #
 # Specifically to raise an error that then can be easily posted to slgo.info ! 
 #
@@ -203,7 +421,12 @@ class sibisExecutionError(Exception):
             return str(log.create_log(self.uid, self.msg))
 
 
-def init_log(verbose=False,post_to_github=False,github_issue_title="",github_issue_label="",timerDir=None):
+# registry shared by all modules - does not require init_log
+metrics = MetricsRegistry()
+if os.environ.get("SIBIS_METRICS_FILE"):
+    metrics.set_flush_file(os.environ["SIBIS_METRICS_FILE"])
+
+def init_log(verbose=False,post_to_github=False,github_issue_title="",github_issue_label="",timerDir=None,metricsFile=None):
     global log
     log = sibisLogging()
     log.verbose = verbose
@@ -213,6 +436,9 @@ def init_log(verbose=False,post_to_github=False,github_issue_title="",github_iss
     if timerDir : 
         log.initiateTimer(os.path.join(timerDir,github_issue_label + "-time_log.csv"))
 
+    if metricsFile :
+        metrics.set_flush_file(metricsFile)
+
 # if this fails bc it cannot find log, please make sure init_log is called first 
 def info(uid, message, **kwargs):
     return log.info(uid,message,**kwargs)
@@ -229,3 +455,19 @@ def takeTimer1(label=None,info=None):
 def takeTimer2(label=None,info=None):
     log.takeTimer2(label,info)
 
+def logTiming(startTime, endTime, label=None, info=None):
+    # also called by library code (e.g., query instrumentation) before init_log
+    if isinstance(log, sibisLogging):
+        log.logTiming(startTime, endTime, label, info)
+
+def timer(name, **labels):
+    return metrics.timer(name, **labels)
+
+def count(name, value=1, **labels):
+    metrics.count(name, value, **labels)
+
+def observe(name, value, **labels):
+    metrics.observe(name, value, **labels)
+
+def flush_metrics(metrics_file=None):
+    metrics.flush(metrics_file)
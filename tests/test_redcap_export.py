@@ -72,4 +72,115 @@ def test_try_export_records(session, logger, project, max_tries, timeout_secs, k
             assert None is not error.__notes__
 
         traceback.print_exception(ex_info.value)
-       
\ No newline at end of file
+       
+
+class MockChangeLogProject():
+    def __init__(self, records):
+        self.def_field = 'study_id'
+        self.records = records
+        self.calls = []
+
+    def export_records(self, fields=None, records=None, date_begin=None, format_type='json', **kwargs):
+        self.calls.append(dict(fields=fields, records=records, date_begin=date_begin))
+        rows = [rec for rec in self.records
+                if (date_begin is None or rec['modified'] >= date_begin)
+                and (records is None or rec['study_id'] in records)]
+        return [{'study_id': rec['study_id']} for rec in rows]
+
+
+def test_export_changed_records(tmp_path, monkeypatch):
+    import datetime
+    from sibispy.session import Session, REDCAP_CHECKPOINT_OVERLAP_MINUTES
+
+    slog.init_log(False, False, 'test_export_changed_records', 'testing', None)
+    now = datetime.datetime.now()
+    project = MockChangeLogProject([
+        {'study_id': 'A', 'modified': now - datetime.timedelta(days=3)},
+        {'study_id': 'B', 'modified': now - datetime.timedelta(hours=1)},
+    ])
+    session = Session()
+    session.api['data_entry'] = project
+    session.__active_redcap_project__ = 'data_entry'
+    monkeypatch.setattr(session, 'get_cache_dir', lambda: str(tmp_path))
+
+    # without checkpoint everything is exported
+    assert session.redcap_export_changed_records(None, 'test') == [{'study_id': 'A'}, {'study_id': 'B'}]
+    checkpoint = session.get_redcap_checkpoint('test')
+    assert checkpoint is not None
+    assert checkpoint <= now - datetime.timedelta(minutes=REDCAP_CHECKPOINT_OVERLAP_MINUTES)
+
+    # runs that filter records themselves store their checkpoint the same way
+    session.advance_redcap_checkpoint('run', now)
+    assert session.get_redcap_checkpoint('run') == (
+        now - datetime.timedelta(minutes=REDCAP_CHECKPOINT_OVERLAP_MINUTES)).replace(microsecond=0)
+
+    # afterwards only records changed since the checkpoint
+    since = now - datetime.timedelta(days=1)
+    session.set_redcap_checkpoint('test', since)
+    assert session.redcap_export_changed_records(None, 'test', update_checkpoint=False) == [{'study_id': 'B'}]
+    assert project.calls[-1]['records'] == ['B']
+    assert session.get_redcap_checkpoint('test') == since.replace(microsecond=0)
+
+
+class MockChunkedProject():
+    def __init__(self):
+        self.def_field = 'study_id'
+        self.metadata = [
+            {'field_name': 'study_id', 'form_name': 'visit', 'field_type': 'text',
+             'text_validation_type_or_show_slider_number': '', 'select_choices_or_calculations': ''},
+            {'field_name': 'visit_notes', 'form_name': 'visit', 'field_type': 'notes',
+             'text_validation_type_or_show_slider_number': '', 'select_choices_or_calculations': ''},
+            {'field_name': 'visit_score', 'form_name': 'visit', 'field_type': 'text',
+             'text_validation_type_or_show_slider_number': 'integer', 'select_choices_or_calculations': ''},
+        ]
+        # 'visit_notes' are numbers in the first chunk and text in the second
+        self.rows = [('A', '1', '2'), ('B', '3', ''), ('C', 'text', '4')]
+        self.requests = []
+
+    def export_records(self, records=None, fields=None, format_type='json', df_kwargs=None, **kwargs):
+        self.requests.append(records)
+        rows = [row for row in self.rows if records is None or row[0] in records]
+        if format_type == 'json':
+            return [{'study_id': row[0]} for row in rows]
+
+        import io
+        import pandas as pd
+        csv = 'study_id,visit_notes,visit_score,visit_complete\n'
+        csv += ''.join('{},{},{},2\n'.format(*row) for row in rows)
+        return pd.read_csv(io.StringIO(csv), index_col='study_id', **(df_kwargs or {}))
+
+
+def test_export_records_chunked():
+    project = MockChunkedProject()
+    chunks = list(utils.redcap_export_records_chunked(project, chunk_records=2, format_type='df'))
+
+    assert project.requests == [None, ['A', 'B'], ['C']]
+    assert len(chunks) == 2
+    for chunk in chunks:
+        assert chunk.dtypes.to_dict() == {'visit_notes': object,
+                                          'visit_score': 'float64',
+                                          'visit_complete': 'float64'}
+
+
+def test_export_records_iter_timer():
+    from sibispy.session import Session
+
+    slog.init_log(False, False, 'test_export_records_iter_timer', 'testing', None)
+    session = Session()
+    session.api['data_entry'] = MockChunkedProject()
+    session.__active_redcap_project__ = 'data_entry'
+
+    def get_timer_count(label):
+        summary = slog.metrics.get_histogram('sibis_timer_seconds', label='redcap_export_' + label)
+        return summary['count'] if summary else 0
+
+    # the timer is taken even if the caller stops early ...
+    for chunk in session.redcap_export_records_iter('iter_break', chunk_records=2, format_type='df'):
+        break
+    assert get_timer_count('iter_break') == 1
+
+    # ... or the export fails
+    session.api['data_entry'].metadata = None
+    with pytest.raises(TypeError):
+        list(session.redcap_export_records_iter('iter_error', chunk_records=2, format_type='df'))
+    assert get_timer_count('iter_error') == 1
@@ -0,0 +1,85 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, event
+
+from sibispy import sibislogger as slog
+from sibispy.redcap_id_resolver import RedcapIdResolver
+from sibispy.session import Session
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    pd.DataFrame({
+        'project_id': [19, 20],
+        'project_name': ['ncanda_subject_visit_log', 'ncanda_import_laptops'],
+    }).to_sql('redcap_projects', engine, index=False)
+    pd.DataFrame({
+        'arm_id': [30, 31, 40],
+        'project_id': [19, 19, 20],
+        'arm_num': [1, 2, 1],
+        'arm_name': ['Standard Protocol', 'Recovery Protocol', 'Arm 1'],
+    }).to_sql('redcap_events_arms', engine, index=False)
+    pd.DataFrame({
+        'event_id': [100, 101, 200],
+        'arm_id': [30, 30, 31],
+        'descrip': ['Baseline visit', '1y visit', 'Recovery day 1'],
+    }).to_sql('redcap_events_metadata', engine, index=False)
+
+    engine.queries = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: engine.queries.append(statement))
+    return engine
+
+
+def test_resolver_lookups(engine):
+    resolver = RedcapIdResolver(engine)
+    assert resolver.get_project_id('ncanda_subject_visit_log') == 19
+    assert resolver.get_arm_id('Recovery Protocol', 19) == 31
+    assert resolver.get_arm_id_from_arm_num(1, 20) == 40
+    assert resolver.get_event_id('1y visit', 30) == 101
+    with pytest.raises(KeyError):
+        resolver.get_event_id('1y visit', 31)
+
+    # the tables are read once
+    assert len(engine.queries) == 3
+
+    pd.DataFrame({'event_id': [102], 'arm_id': [30], 'descrip': ['2y visit']}).to_sql(
+        'redcap_events_metadata', engine, index=False, if_exists='append')
+    with pytest.raises(KeyError):
+        resolver.get_event_id('2y visit', 30)
+    resolver.refresh()
+    assert resolver.get_event_id('2y visit', 30) == 102
+
+
+def test_session_uses_resolver(engine):
+    slog.init_log(False, False, 'test_redcap_id_resolver', 'test_redcap_id_resolver', None)
+    session = Session()
+    session.api['redcap_mysql_db'] = engine
+
+    for _ in range(10):
+        project_id = session.get_mysql_project_id('ncanda_subject_visit_log')
+        arm_id = session.get_mysql_arm_id('Standard Protocol', project_id)
+        assert session.get_mysql_event_id('Baseline visit', arm_id) == 100
+        assert session.get_mysql_arm_id_from_arm_num(2, project_id) == 31
+    assert len(engine.queries) == 3
+
+    with pytest.raises(KeyError):
+        session.get_mysql_project_id('unknown_project')
+
+    # tables that cannot be read are logged
+    session = Session()
+    session.api['redcap_mysql_db'] = create_engine("sqlite://")
+    assert session.get_mysql_project_id('ncanda_subject_visit_log') is None
+
+
+def test_resolver_first_match(engine):
+    # repeated names resolve to the first matching row
+    pd.DataFrame({'project_id': [21], 'project_name': ['ncanda_subject_visit_log']}).to_sql(
+        'redcap_projects', engine, index=False, if_exists='append')
+    pd.DataFrame({'event_id': [103], 'arm_id': [30], 'descrip': ['Baseline visit']}).to_sql(
+        'redcap_events_metadata', engine, index=False, if_exists='append')
+
+    resolver = RedcapIdResolver(engine)
+    assert resolver.get_project_id('ncanda_subject_visit_log') == 19
+    assert resolver.get_event_id('Baseline visit', 30) == 100
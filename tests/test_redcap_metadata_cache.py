@@ -0,0 +1,131 @@
+import datetime
+
+import pytest
+import requests
+from redcap import RedcapError
+
+from sibispy.redcap_metadata_cache import RedcapMetadataCache, prime_project
+
+
+class MockRedcapProject():
+    def __init__(self):
+        self._metadata = None
+        self.design_changes = []
+        self.version = '13.1.0'
+        self.calls = []
+        self.events_error = None
+        self.logging_error = None
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self.calls.append('metadata')
+            self._metadata = [{'field_name': 'study_id', 'form_name': 'demographics'}]
+        return self._metadata
+
+    def export_version(self):
+        return self.version
+
+    def export_project_info(self):
+        return {'project_id': 20, 'is_longitudinal': 1}
+
+    def export_logging(self, log_type=None, begin_time=None):
+        assert isinstance(begin_time, datetime.datetime)
+        if self.logging_error:
+            raise self.logging_error
+        return self.design_changes
+
+    def export_field_names(self):
+        self.calls.append('field_names')
+        return [{'original_field_name': 'study_id', 'export_field_name': 'study_id'}]
+
+    def export_events(self):
+        if self.events_error:
+            raise self.events_error
+        return [{'unique_event_name': 'baseline_visit_arm_1'}]
+
+    def export_arms(self):
+        return [{'arm_num': 1, 'name': 'Standard Protocol'}]
+
+    def export_instrument_event_mappings(self):
+        return [{'arm_num': 1, 'unique_event_name': 'baseline_visit_arm_1', 'form': 'demographics'}]
+
+
+def test_metadata_cache(tmp_path):
+    cache = RedcapMetadataCache(str(tmp_path))
+    project = MockRedcapProject()
+
+    entry = cache.get('server:data_entry', project)
+    assert entry['redcap_version'] == '13.1.0'
+    assert project.calls == ['metadata', 'field_names']
+
+    # unchanged project is served from the cache
+    assert cache.get('server:data_entry', MockRedcapProject()) == entry
+
+    # design changes and version upgrades invalidate the entry
+    changed = MockRedcapProject()
+    changed.design_changes = [{'action': 'Manage/Design'}]
+    cache.get('server:data_entry', changed)
+    assert changed.calls == ['metadata', 'field_names']
+
+    # without access to the project log, the signature decides
+    no_log = MockRedcapProject()
+    no_log.logging_error = RedcapError('{"error":"You do not have API Logging privileges"}')
+    cache.get('server:data_entry', no_log)
+    assert no_log.calls == []
+    no_log.version = '13.2.0'
+    cache.get('server:data_entry', no_log)
+    assert no_log.calls == ['metadata', 'field_names']
+
+    # other failures of the log are not hidden
+    broken = MockRedcapProject()
+    broken.version = '13.2.0'
+    broken.logging_error = KeyError('data')
+    with pytest.raises(KeyError):
+        cache.get('server:data_entry', broken)
+
+    upgraded = MockRedcapProject()
+    upgraded.version = '14.0.0'
+    assert cache.get('server:data_entry', upgraded)['redcap_version'] == '14.0.0'
+
+    # explicit invalidation
+    cache.invalidate('server:data_entry')
+    assert cache.load('server:data_entry') is None
+
+
+def test_prime_project(tmp_path):
+    entry = RedcapMetadataCache(str(tmp_path)).get('server:data_entry', MockRedcapProject())
+    project = prime_project(MockRedcapProject(), entry)
+    assert project.metadata == entry['metadata']
+    assert project.calls == []
+    assert project._is_longitudinal
+    assert str(project._redcap_version) == '13.1.0'
+
+
+def test_classic_project(tmp_path):
+    cache = RedcapMetadataCache(str(tmp_path))
+    project = MockRedcapProject()
+    project.events_error = RedcapError('{"error":"You cannot export events for classic projects"}')
+    entry = cache.get('server:classic', project)
+    assert entry['events'] == entry['arms'] == entry['instrument_event_mappings'] == []
+    assert not prime_project(MockRedcapProject(), entry)._is_longitudinal
+
+    # other errors are not mistaken for a classic project (nor cached)
+    project = MockRedcapProject()
+    project.events_error = requests.exceptions.ConnectionError('Connection reset by peer')
+    with pytest.raises(requests.exceptions.ConnectionError):
+        cache.get('server:data_entry', project, refresh=True)
+    assert cache.load('server:data_entry') is None
+
+
+def test_refresh_resets_project(tmp_path):
+    project = MockRedcapProject()
+    project._forms = ['old_form']
+    project._field_names = ['old_field']
+    project._def_field = 'old_field'
+    entry = RedcapMetadataCache(str(tmp_path)).get('server:data_entry', project)
+    assert project._forms is None and project._field_names is None and project._def_field is None
+
+    project._forms = ['old_form']
+    prime_project(project, entry)
+    assert project._forms is None
@@ -0,0 +1,41 @@
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from sibispy import sibislogger as slog
+from sibispy.redcap_mysql_engine import get_engine_options, get_statement_label, instrument_engine
+
+
+def test_engine_options():
+    options = get_engine_options(dict(hostname='localhost', pool_size=2, pool_pre_ping=False))
+    assert options['pool_size'] == 2 and not options['pool_pre_ping']
+    assert options['pool_recycle'] == 3600 and options['max_overflow'] == 10
+
+
+def test_statement_label():
+    assert get_statement_label('SELECT record FROM redcap.redcap_data WHERE 1') == 'select redcap_data'
+    assert get_statement_label('\n  DELETE FROM `redcap_locking_data` WHERE ld_id IN (1)') \
+        == 'delete redcap_locking_data'
+    assert get_statement_label('INSERT INTO redcap_locking_data (record) VALUES (?)') \
+        == 'insert redcap_locking_data'
+    assert get_statement_label('SET SESSION max_statement_time = 1') == 'set'
+
+
+def test_instrumented_engine(tmpdir):
+    slog.init_log(False, False, 'test_redcap_mysql_engine', 'test_redcap_mysql_engine', str(tmpdir))
+    engine = instrument_engine(create_engine('sqlite://'), slow_statement_seconds=0)
+    pd.DataFrame({'ld_id': [1, 2, 3]}).to_sql('sibis_test_locks', engine, index=False)
+
+    label = dict(statement='delete sibis_test_locks')
+    num_rows = slog.metrics.get_counter('sibis_mysql_statement_rows_total', **label)
+    summary = slog.metrics.get_histogram('sibis_mysql_statement_seconds', **label)
+    num_statements = summary['count'] if summary else 0
+    with engine.begin() as conn:
+        conn.execute(text('DELETE FROM sibis_test_locks WHERE ld_id > 1'))
+
+    assert slog.metrics.get_counter('sibis_mysql_statement_rows_total', **label) == num_rows + 2
+    assert slog.metrics.get_histogram('sibis_mysql_statement_seconds', **label)['count'] \
+        == num_statements + 1
+
+    with open(str(tmpdir.join('test_redcap_mysql_engine-time_log.csv'))) as fd:
+        time_log = fd.read()
+    assert 'mysql delete sibis_test_locks,"rows: 2"' in time_log
@@ -0,0 +1,565 @@
+import calendar
+import filecmp
+import os
+import pickle
+from io import StringIO
+
+import pandas
+import pytest
+
+from sibispy import sibislogger as slog
+from sibispy import redcap_to_casesdir as r2c
+from sibispy.cases_manifest import CasesManifest
+from sibispy.session import Session
+
+SYS_CONFIG = """
+redcap_to_casesdir:
+  scanner_dict:
+    SIEMENS: "SIEMENS,TrioTim"
+  event_dictionary:
+    baseline_visit_arm_1: "'standard', 'baseline'"
+    1y_visit_arm_1: "'standard', 'followup_1y'"
+  skip_demographics_for: []
+  general_datadict:
+    subject: "'text', '', 'Subject ID', '', '', ''"
+    arm: "'text', '', 'Study arm', '', '', ''"
+    visit: "'text', '', 'Visit', '', '', ''"
+  demographic_datadict:
+    visit_age: "'text', 'number', 'Age at visit', '', '', ''"
+"""
+
+METADATA = [
+    dict(field_name='study_id', form_name='visit', field_type='text', field_label='Study ID'),
+    dict(field_name='dob', form_name='visit', field_type='text', field_label='Date of birth',
+         text_validation_type_or_show_slider_number='date_ymd'),
+    dict(field_name='visit_date', form_name='visit', field_type='text', field_label='Visit date',
+         text_validation_type_or_show_slider_number='date_ymd'),
+    dict(field_name='stroop_age', form_name='stroop', field_type='text', field_label='Age',
+         text_validation_type_or_show_slider_number='integer'),
+    dict(field_name='stroop_total', form_name='stroop', field_type='calc', field_label='Total'),
+    dict(field_name='stroop_cond', form_name='stroop', field_type='radio', field_label='Condition',
+         select_choices_or_calculations='1, Congruent | 2, Incongruent, mixed'),
+    dict(field_name='stroop_flags', form_name='stroop', field_type='checkbox', field_label='Flags',
+         select_choices_or_calculations='1, Fast | 2, Slow'),
+]
+for field in METADATA:
+    for key in ['text_validation_type_or_show_slider_number', 'text_validation_min',
+                'text_validation_max', 'select_choices_or_calculations']:
+        field.setdefault(key, '')
+
+SUBJECTS = ['A-00001-F-1', 'A-00002-M-2', 'A-00003-F-3']
+EVENTS = ['baseline_visit_arm_1', '1y_visit_arm_1']
+
+
+def make_records():
+    """
+    Raw (csv) values of the REDCap project as the API exports them
+    """
+    rows = []
+    for num, subject in enumerate(SUBJECTS):
+        for visit, event in enumerate(EVENTS):
+            rows.append(dict(
+                study_id=subject,
+                redcap_event_name=event,
+                dob='200{}-0{}-1{}'.format(num, num + 1, num) if event == EVENTS[0] else '',
+                visit_date='201{}-0{}-2{}'.format(5 + visit, num + 2, visit) if num != 2 or visit else '',
+                stroop_age=str(15 + visit) if num != 1 else '',
+                stroop_total='{}.5'.format(num * 10 + visit) if num else ['12', '007'][visit],
+                stroop_cond=str(1 + (num + visit) % 2) if num != 2 else '',
+                stroop_flags___1=str((num + visit) % 2),
+                stroop_flags___2='1' if num == 1 else '0',
+                stroop_complete=str(2 * ((num + visit) % 2)),
+            ))
+    return pandas.DataFrame(rows).astype(str)
+
+
+class FakeRedcapProject(object):
+    """
+    Serves export_records from the raw values of make_records
+    """
+    def_field = 'study_id'
+    metadata = METADATA
+
+    def __init__(self, records):
+        self.records = records
+        self.calls = []
+
+    def export_records(self, fields=None, records=None, events=None, format_type='json',
+                       df_kwargs=None, **kwargs):
+        self.calls.append(dict(fields=fields, records=records, events=events))
+        data = self.records
+        if records is not None:
+            data = data[data.study_id.isin(records)]
+        if events is not None:
+            data = data[data.redcap_event_name.isin(events)]
+        if fields is not None:
+            columns = [column for column in data.columns
+                       if column.split('___')[0] in fields and column != 'redcap_event_name']
+            data = data[['study_id', 'redcap_event_name'] + [col for col in columns if col != 'study_id']]
+
+        if format_type == 'json':
+            return data.to_dict('records')
+        csv = data.to_csv(index=False)
+        if format_type == 'csv':
+            return csv
+        return pandas.read_csv(StringIO(csv), index_col=['study_id', 'redcap_event_name'],
+                               **(df_kwargs or {}))
+
+
+@pytest.fixture
+def red2cas(tmpdir):
+    slog.init_log(False, False, 'test_redcap_to_casesdir_export', 'test_redcap_to_casesdir_export', None)
+    operations_dir = tmpdir.mkdir('operations')
+    operations_dir.join('sibis_sys_config.yml').write(SYS_CONFIG)
+    operations_dir.mkdir('redcap_to_casesdir').join('stroop.txt').write(
+        'stroop\nstroop_age\nstroop_total\nstroop_cond[stroop_condition]\n'
+        'stroop_flags___1\nstroop_flags___2\n')
+    config_file = tmpdir.join('.sibis-general-config.yml')
+    config_file.write('analysis_dir: {0}\n'.format(tmpdir))
+
+    session = Session()
+    assert session.configure(str(config_file), ordered_config_load_flag=True)
+    red2cas = r2c.redcap_to_casesdir()
+    assert red2cas.configure(session, METADATA)
+    return red2cas
+
+
+def export_all(red2cas, redcap_project, outdir, prefetch_store=None):
+    """
+    Export the stroop form of all subject-visits the way the cases-dir
+    export scripts call export_subject_all_forms
+    """
+    for subject in SUBJECTS:
+        for event in EVENTS:
+            (arm_code, visit_code, subject_dir) = red2cas.translate_subject_and_event(subject, event)
+            red2cas.export_subject_all_forms(
+                redcap_project, 'A', subject, event, None, None, None, arm_code, visit_code,
+                subject, os.path.join(str(outdir), subject_dir), ['stroop'], -1, -1, None,
+                select_exports=['stroop'], prefetch_store=prefetch_store)
+
+
+def assert_same_tree(expected_dir, actual_dir):
+    expected_dir, actual_dir = str(expected_dir), str(actual_dir)
+    files = []
+    for root, dirs, names in os.walk(expected_dir):
+        files += [os.path.relpath(os.path.join(root, name), expected_dir) for name in names
+                  if name != 'export_measures.log']
+    assert files
+    for root, dirs, names in os.walk(actual_dir):
+        for name in names:
+            if name != 'export_measures.log':
+                assert os.path.relpath(os.path.join(root, name), actual_dir) in files
+    match, mismatch, errors = filecmp.cmpfiles(expected_dir, actual_dir, files, shallow=False)
+    assert not mismatch and not errors
+
+
+def test_prefetch_matches_subject_export(red2cas, tmpdir):
+    redcap_project = FakeRedcapProject(make_records())
+    export_all(red2cas, redcap_project, tmpdir.join('per_subject'))
+    # two calls per subject and event
+    assert len(redcap_project.calls) == 2 * len(SUBJECTS) * len(EVENTS)
+
+    redcap_project.calls = []
+    prefetch_store = red2cas.prefetch_records(
+        redcap_project, {event: ['stroop'] for event in EVENTS}, chunk_records=2)
+    assert prefetch_store.get_subjects(EVENTS[1]) == SUBJECTS
+    export_all(red2cas, redcap_project, tmpdir.join('prefetched'), prefetch_store)
+    # record ids and two chunks for each event and the date of birth
+    assert len(redcap_project.calls) == 3 * (len(EVENTS) + 1)
+
+    assert_same_tree(tmpdir.join('per_subject'), tmpdir.join('prefetched'))
+    with open(str(tmpdir.join('prefetched', SUBJECTS[0], 'standard', 'followup_1y',
+                              'measures', 'stroop.csv'))) as fd:
+        assert fd.read().splitlines()[1].startswith('A-00001-F-1,standard,followup_1y,194,')
+
+
+def get_visits(red2cas, outdir):
+    visits = []
+    for subject in SUBJECTS:
+        for event in EVENTS:
+            (arm_code, visit_code, subject_dir) = red2cas.translate_subject_and_event(subject, event)
+            visits.append(dict(
+                site='A', subject=subject, event=event, subject_data=None, visit_age=None,
+                visit_data=None, arm_code=arm_code, visit_code=visit_code, subject_code=subject,
+                subject_datadir=os.path.join(str(outdir), subject_dir), forms_this_event=['stroop'],
+                exceeds_criteria_baseline=-1, siblings_enrolled_yn_corrected=-1,
+                siblings_id_first_corrected=None))
+    return visits
+
+
+def test_parallel_export(red2cas, tmpdir):
+    redcap_project = FakeRedcapProject(make_records())
+    export_all(red2cas, redcap_project, tmpdir.join('per_subject'))
+    prefetch_store = red2cas.prefetch_records(redcap_project, {event: ['stroop'] for event in EVENTS})
+
+    results = red2cas.export_all_subjects_parallel(
+        get_visits(red2cas, tmpdir.join('parallel')), prefetch_store, max_workers=2,
+        select_exports=['stroop'])
+    assert [result['status'] for result in results] == ['ok'] * len(SUBJECTS) * len(EVENTS)
+    assert all(result['seconds'] >= 0 for result in results)
+    assert_same_tree(tmpdir.join('per_subject'), tmpdir.join('parallel'))
+
+    # failures are reported per subject-visit
+    visits = get_visits(red2cas, tmpdir.join('failing'))
+    visits[0]['forms_this_event'] = None
+    results = red2cas.export_all_subjects_parallel(visits, prefetch_store, max_workers=1,
+                                                   select_exports=['stroop'])
+    assert results[0]['status'] == 'error' and results[0]['err_msg']
+    assert [result['status'] for result in results[1:]] == ['ok'] * (len(results) - 1)
+
+
+def test_vectorized_form_export(red2cas, tmpdir):
+    redcap_project = FakeRedcapProject(make_records())
+    export_all(red2cas, redcap_project, tmpdir.join('per_subject'))
+    prefetch_store = red2cas.prefetch_records(redcap_project, {event: ['stroop'] for event in EVENTS})
+
+    visits = pandas.DataFrame(get_visits(red2cas, tmpdir.join('vectorized')))
+    visits = visits.set_index(['subject', 'event'])
+    visits['measures_dir'] = [os.path.join(subject_dir, 'measures') for subject_dir in visits.subject_datadir]
+    for event in EVENTS:
+        records = prefetch_store.get_event_records(event)
+        assert red2cas.export_form_all_visits('stroop', records, visits) == len(SUBJECTS)
+
+    assert_same_tree(tmpdir.join('per_subject'), tmpdir.join('vectorized'))
+
+    # a subject-visit with several records is skipped, the others are written to their own files
+    records = make_records()
+    records = pandas.concat([records, records.iloc[[0]].assign(stroop_total='99')], ignore_index=True)
+    prefetch_store = red2cas.prefetch_records(FakeRedcapProject(records), {event: ['stroop'] for event in EVENTS})
+    visits['measures_dir'] = [str(tmpdir.join('duplicated', os.path.relpath(measures_dir, str(tmpdir.join('vectorized')))))
+                              for measures_dir in visits.measures_dir]
+    # the duplicated visit first, so that rows would shift when paired by position
+    visits = visits.iloc[::-1]
+    assert red2cas.export_form_all_visits('stroop', prefetch_store.get_event_records(EVENTS[0]), visits) \
+        == len(SUBJECTS) - 1
+    assert not tmpdir.join('duplicated', SUBJECTS[0]).check()
+    for subject in SUBJECTS[1:]:
+        path = os.path.join(subject, 'standard', 'baseline', 'measures', 'stroop.csv')
+        assert filecmp.cmp(str(tmpdir.join('per_subject', path)), str(tmpdir.join('duplicated', path)), shallow=False)
+
+
+def test_read_csv_rows():
+    values = ['007', '+5', '1e3', '.5', '5.', 'inf', 'TRUE', 'NA', '', 'text', '1_000',
+              '18446744073709551616', '1e400', '-0']
+    records = pandas.DataFrame({'a': values, 'b': ['1'] * len(values)}, index=list(range(10, 10 + len(values))))
+    parsed = r2c._read_csv_rows(records)
+    assert list(parsed.index) == list(records.index)
+    for value, parsed_value in zip(values, parsed['a']):
+        expected = pandas.read_csv(StringIO('a\n"{}"\n'.format(value)), skip_blank_lines=False).a.iloc[0]
+        if pandas.isnull(expected):
+            assert pandas.isnull(parsed_value)
+        else:
+            assert type(parsed_value) is type(expected.item() if hasattr(expected, 'item') else expected)
+            assert parsed_value == expected
+    assert all(type(value) is int for value in parsed['b'])
+
+
+def test_export_plan(red2cas, tmpdir):
+    plan = red2cas.get_export_plans()['stroop']
+    assert plan.fields == ('stroop_age', 'stroop_total', 'stroop_cond', 'stroop_flags___1', 'stroop_flags___2')
+    assert plan.request_fields == ('stroop_age', 'stroop_total', 'stroop_cond', 'stroop_flags',
+                                   'stroop_flags', 'stroop_complete')
+    assert plan.output_names['stroop_cond'] == 'stroop_condition'
+    assert plan.output_names['stroop_age'] == 'stroop_age_months'
+    assert plan.dtypes == {'stroop_age_months': 'Int64'}
+    assert list(plan.label_maps) == ['stroop_cond']
+
+    # plans are immutable and hashable
+    assert hash(plan) == hash(red2cas.get_export_plans()['stroop'])
+    with pytest.raises(TypeError):
+        plan.output_names['stroop_cond'] = 'stroop_cond'
+    with pytest.raises(TypeError):
+        plan.label_maps['stroop_cond']['1'] = 'changed'
+    assert pickle.loads(pickle.dumps(plan)) == plan
+
+    plans_file = str(tmpdir.join('export_plans.json'))
+    r2c.save_export_plans(red2cas.get_export_plans(), plans_file)
+    loaded = r2c.load_export_plans(plans_file)
+    assert loaded == red2cas.get_export_plans()
+    assert loaded['stroop'].version == plan.version
+
+    # exporting with loaded plans results in the same files
+    redcap_project = FakeRedcapProject(make_records())
+    export_all(red2cas, redcap_project, tmpdir.join('compiled'))
+    red2cas.use_export_plans(loaded)
+    export_all(red2cas, redcap_project, tmpdir.join('loaded'))
+    assert_same_tree(tmpdir.join('compiled'), tmpdir.join('loaded'))
+
+    # configuring from saved plans does not read the form files
+    red2cas.create_datadict('stroop', str(tmpdir.join('compiled_datadict')))
+    tmpdir.join('operations', 'redcap_to_casesdir', 'stroop.txt').remove()
+    session = Session()
+    assert session.configure(str(tmpdir.join('.sibis-general-config.yml')), ordered_config_load_flag=True)
+    red2cas_saved = r2c.redcap_to_casesdir()
+    assert red2cas_saved.configure(session, METADATA)
+    assert red2cas_saved.get_export_plans() == {}
+    red2cas_saved = r2c.redcap_to_casesdir()
+    assert red2cas_saved.configure(session, METADATA, export_plans=r2c.load_export_plans(plans_file))
+    assert red2cas_saved.get_export_plans() == red2cas.get_export_plans()
+    assert red2cas_saved.get_export_names_of_forms() == ['stroop']
+    export_all(red2cas_saved, redcap_project, tmpdir.join('saved'))
+    assert_same_tree(tmpdir.join('compiled'), tmpdir.join('saved'))
+    red2cas_saved.create_datadict('stroop', str(tmpdir.join('saved_datadict')))
+    assert_same_tree(tmpdir.join('compiled_datadict'), tmpdir.join('saved_datadict'))
+
+
+def test_ndar_months(red2cas):
+    # month ends, leap days (2000 is a leap year, 1900 and 2023 are not) and
+    # the 15th/16th around the rounding threshold; zero padded as exported by
+    # REDCap or not padded as typed by hand; blanks stay blank
+    dates = [None, float('nan')]
+    for year in [1900, 2000, 2023, 2024]:
+        for month in range(1, 13):
+            days = [1, 15, 16, calendar.monthrange(year, month)[1]]
+            dates += ['{0:04d}-{1:02d}-{2:02d}'.format(year, month, day) for day in days]
+    dates += ['2000-2-29', '2024-1-5', '2024-12-31', '0001-01-01', '9999-12-31']
+
+    pairs = [(dob, ref) for dob in dates for ref in dates]
+    months = r2c.ndar_months(pandas.Series([pair[0] for pair in pairs], dtype=object),
+                             pandas.Series([pair[1] for pair in pairs], dtype=object))
+    expected = [red2cas.__ndar_months__(*pair) for pair in pairs]
+    assert [type(value) for value in months] == [type(value) for value in expected]
+    assert list(months) == expected
+
+    # the index of the dates of birth is kept
+    dob = pandas.Series(['2000-02-29', None], index=[7, 3], dtype=object)
+    months = r2c.ndar_months(dob, pandas.Series(['2001-02-28', '2001-02-28'], dtype=object))
+    assert list(months.index) == [7, 3]
+    assert list(months) == [13, '']
+
+    # invalid dates fail as they do in __ndar_months__
+    for invalid in ['2023-02-29', '1900-02-29', '2000-04-31', '2000-13-01', '2000-00-10', '0000-01-01',
+                    '2000/01/01', '', 'n/a']:
+        for dob, ref in [(invalid, '2010-01-01'), ('2000-01-01', invalid)]:
+            with pytest.raises(ValueError):
+                red2cas.__ndar_months__(dob, ref)
+            with pytest.raises(ValueError):
+                r2c.ndar_months(pandas.Series([dob]), pandas.Series([ref]))
+
+
+def test_cases_manifest(red2cas, tmpdir):
+    redcap_project = FakeRedcapProject(make_records())
+    export_all(red2cas, redcap_project, tmpdir.join('per_subject'))
+
+    cases_dir = tmpdir.join('cases')
+    manifest = CasesManifest(str(tmpdir.join('manifest.sqlite')), str(cases_dir))
+    red2cas.use_manifest(manifest)
+    prefetch_store = red2cas.prefetch_records(redcap_project, {event: ['stroop'] for event in EVENTS})
+    results = red2cas.export_all_subjects_parallel(get_visits(red2cas, cases_dir), prefetch_store,
+                                                   max_workers=2, select_exports=['stroop'])
+    assert [result['status'] for result in results] == ['ok'] * len(SUBJECTS) * len(EVENTS)
+    assert_same_tree(tmpdir.join('per_subject'), cases_dir)
+
+    # the workers recorded their files
+    version = red2cas.get_export_plans()['stroop'].version
+    paths = manifest.get_paths()
+    assert len(paths) == len(SUBJECTS) * len(EVENTS)
+    entry = manifest.get_entry(cases_dir.join(paths[0]))
+    assert entry['plan_version'] == version and entry['export_name'] == 'stroop'
+    assert entry['size'] == cases_dir.join(paths[0]).size()
+    assert manifest.get_paths(SUBJECTS[0] + '/standard/baseline') == [paths[0]]
+    assert manifest.get_modified() == [] and manifest.get_outdated({'stroop': version}) == []
+    assert manifest.get_outdated({'stroop': 'other'}) == paths
+
+    # unchanged files are skipped, changed ones rewritten and recorded
+    mtimes = {path: os.stat(str(cases_dir.join(path))).st_mtime_ns for path in paths}
+    records = make_records()
+    records.loc[0, 'stroop_total'] = '13'
+    export_all(red2cas, FakeRedcapProject(records), cases_dir)
+    changed = [path for path in paths if os.stat(str(cases_dir.join(path))).st_mtime_ns != mtimes[path]]
+    assert changed == [paths[0]]
+    assert manifest.get_entry(cases_dir.join(paths[0]))['sha1'] != entry['sha1']
+    assert manifest.get_modified() == []
+
+    # deleted and edited files are written again although their entries are unchanged
+    os.remove(str(cases_dir.join(paths[1])))
+    cases_dir.join(paths[2]).write('edited')
+    assert manifest.get_modified() == paths[1:3]
+    export_all(red2cas, FakeRedcapProject(records), cases_dir)
+    assert manifest.get_modified() == []
+    red2cas.use_manifest(None)
+    manifest.close()
+    export_all(red2cas, FakeRedcapProject(records), tmpdir.join('changed'))
+    assert_same_tree(tmpdir.join('changed'), cases_dir)
+
+
+def test_datadict_cache(red2cas, tmpdir):
+    datadict_dir = str(tmpdir.join('datadict'))
+    dict_file = red2cas.create_datadict('stroop', datadict_dir)
+    with open(dict_file) as fd:
+        lines = fd.read().splitlines()
+    assert lines[1:] == [
+        'subject,stroop,,text,Subject ID,,,,,,,,,,,,',
+        'arm,stroop,,text,Study arm,,,,,,,,,,,,',
+        'visit,stroop,,text,Visit,,,,,,,,,,,,',
+        'stroop_age_months,stroop,,text,Age,,,integer,,,,,,,,,',
+        'stroop_total,stroop,,calc,Total,,,,,,,,,,,,',
+        'stroop_cond,stroop,,radio,Condition,"1, Congruent | 2, Incongruent, mixed",,,,,,,,,,,',
+        'stroop_flags,stroop,,checkbox,Flags,"1, Fast | 2, Slow",,,,,,,,,,,',
+        'stroop_flags,stroop,,checkbox,Flags,"1, Fast | 2, Slow",,,,,,,,,,,',
+        'stroop_complete,stroop,,,,,,,,,,,,,,,']
+
+    # unchanged metadata - the datadict is not written again
+    mtime = os.stat(dict_file).st_mtime_ns
+    assert red2cas.create_datadict('stroop', datadict_dir) == dict_file
+    assert os.stat(dict_file).st_mtime_ns == mtime
+
+    # with a manifest the hash is kept across exporters
+    manifest = CasesManifest(str(tmpdir.join('manifest.sqlite')), str(tmpdir))
+    red2cas.use_manifest(manifest)
+    os.remove(dict_file)
+    red2cas.create_datadict('stroop', datadict_dir)
+    mtime = os.stat(dict_file).st_mtime_ns
+    entry = manifest.get_entry(dict_file)
+    version = red2cas.get_export_plans()['stroop'].version
+    assert entry['plan_version'] == version and entry['source_hash'] not in (None, version)
+    assert manifest.get_outdated({'stroop_datadict': version}) == []
+
+    red2cas_changed = r2c.redcap_to_casesdir()
+    metadata = [dict(field, field_label='Total score') if field['field_name'] == 'stroop_total' else field
+                for field in METADATA]
+    session = Session()
+    assert session.configure(str(tmpdir.join('.sibis-general-config.yml')), ordered_config_load_flag=True)
+    assert red2cas_changed.configure(session, metadata)
+    red2cas_changed.use_manifest(manifest)
+    red2cas.create_datadict('stroop', datadict_dir)
+    assert os.stat(dict_file).st_mtime_ns == mtime
+    red2cas_changed.create_datadict('stroop', datadict_dir)
+    with open(dict_file) as fd:
+        assert 'stroop_total,stroop,,calc,Total score,' in fd.read()
+    manifest.close()
+
+
+def get_changed_keys(old_records, new_records):
+    old = old_records.set_index(['study_id', 'redcap_event_name'])
+    new = new_records.set_index(['study_id', 'redcap_event_name'])
+    return [key for key in new.index if key not in old.index or not old.loc[key].equals(new.loc[key])]
+
+
+def test_incremental_export(red2cas, tmpdir):
+    cases_dir = tmpdir.join('incremental')
+    manifest = CasesManifest(str(tmpdir.join('manifest.sqlite')), str(cases_dir))
+    red2cas.use_manifest(manifest)
+    records = make_records()
+    prefetch_store = red2cas.prefetch_records(FakeRedcapProject(records), {event: ['stroop'] for event in EVENTS})
+    red2cas.export_all_subjects_parallel(get_visits(red2cas, cases_dir), prefetch_store, max_workers=1,
+                                         select_exports=['stroop'])
+
+    visit_of_dir = {os.path.relpath(visit['subject_datadir'], str(cases_dir)): visit
+                    for visit in get_visits(red2cas, cases_dir)}
+
+    # a sequence of edits, each followed by an incremental export
+    edits = [
+        [(0, 'stroop_total', '14.5'), (3, 'stroop_cond', '')],
+        [(5, 'stroop_flags___2', '1'), (5, 'stroop_complete', '2'), (4, 'visit_date', '2016-05-21')],
+        [(0, 'dob', '2000-02-10'), (3, 'stroop_total', '007')],
+    ]
+    for edit in edits:
+        new_records = records.copy()
+        for (row, column, value) in edit:
+            new_records.loc[row, column] = value
+        changed_keys = get_changed_keys(records, new_records)
+        records = new_records
+
+        entries = {path: manifest.get_entry(cases_dir.join(path)) for path in manifest.get_paths()}
+        log_files = {path: cases_dir.join(os.path.dirname(path), 'export_measures.log') for path in entries}
+        log_mtimes = {path: log_file.check() and log_file.mtime() for path, log_file in log_files.items()}
+        redcap_project = FakeRedcapProject(records)
+        results = red2cas.export_changed_visits(redcap_project, get_visits(red2cas, cases_dir), changed_keys,
+                                                max_workers=1, select_exports=['stroop'])
+        exported_keys = [(result['subject'], result['event']) for result in results]
+        # changes of the baseline (date of birth) are exported to all visits of the subject
+        assert exported_keys == [(subject, event) for subject in SUBJECTS for event in EVENTS
+                                 if (subject, event) in changed_keys or (subject, EVENTS[0]) in changed_keys]
+        assert all(result['status'] == 'ok' for result in results)
+        # only the records of changed subjects were requested
+        assert all(set(call['records']) == {key[0] for key in changed_keys} for call in redcap_project.calls)
+
+        # the export log and manifest entries of unchanged visits are untouched
+        for path, entry in entries.items():
+            visit = visit_of_dir[os.path.dirname(os.path.dirname(path))]
+            log_file = log_files[path]
+            if (visit['subject'], visit['event']) not in exported_keys:
+                assert manifest.get_entry(cases_dir.join(path)) == entry
+                assert (log_file.check() and log_file.mtime()) == log_mtimes[path]
+            else:
+                assert log_file.check()
+
+    assert manifest.get_modified() == []
+    red2cas.use_manifest(None)
+    manifest.close()
+
+    # same files as a full export of the final records
+    export_all(red2cas, FakeRedcapProject(records), tmpdir.join('full'))
+    assert_same_tree(tmpdir.join('full'), cases_dir)
+
+
+def test_incremental_export_baseline_event(red2cas, tmpdir):
+    assert red2cas.get_baseline_event() == 'baseline_visit_arm_1'
+    # a project whose date of birth is recorded in another event
+    tmpdir.join('operations', 'sibis_sys_config.yml').write(
+        SYS_CONFIG.replace('  skip_demographics_for', '  baseline_event: 1y_visit_arm_1\n  skip_demographics_for'))
+    session = Session()
+    assert session.configure(str(tmpdir.join('.sibis-general-config.yml')), ordered_config_load_flag=True)
+    red2cas = r2c.redcap_to_casesdir()
+    assert red2cas.configure(session, METADATA)
+    assert red2cas.get_baseline_event() == '1y_visit_arm_1'
+
+    cases_dir = tmpdir.join('cases')
+    redcap_project = FakeRedcapProject(make_records())
+    changed_keys = [(SUBJECTS[0], '1y_visit_arm_1'), (SUBJECTS[1], 'baseline_visit_arm_1')]
+    results = red2cas.export_changed_visits(redcap_project, get_visits(red2cas, cases_dir), changed_keys,
+                                            max_workers=1, select_exports=['stroop'])
+    assert [(result['subject'], result['event']) for result in results] == [
+        (SUBJECTS[0], 'baseline_visit_arm_1'), (SUBJECTS[0], '1y_visit_arm_1'), (SUBJECTS[1], 'baseline_visit_arm_1')]
+    # the date of birth is exported from that event
+    assert [call['events'] for call in redcap_project.calls if call['fields'] == ['study_id', 'dob']] \
+        == [['1y_visit_arm_1']]
+
+
+@pytest.mark.filterwarnings('ignore:This process')
+def test_cases_manifest_parallel(red2cas, tmpdir):
+    cases_dir = tmpdir.join('cases')
+    manifest = CasesManifest(str(tmpdir.join('manifest.sqlite')), str(cases_dir))
+    red2cas.use_manifest(manifest)
+    # the parent opens the manifest before the workers are forked
+    red2cas.create_datadict('stroop', str(cases_dir.join('datadict')))
+    assert manifest.get_paths() == ['datadict/stroop_datadict.csv']
+    connection = manifest.__connection__()
+
+    redcap_project = FakeRedcapProject(make_records())
+    prefetch_store = red2cas.prefetch_records(redcap_project, {event: ['stroop'] for event in EVENTS})
+    results = red2cas.export_all_subjects_parallel(get_visits(red2cas, cases_dir), prefetch_store,
+                                                   max_workers=2, select_exports=['stroop'])
+    assert [result['status'] for result in results] == ['ok'] * len(SUBJECTS) * len(EVENTS)
+    assert len(manifest.get_paths()) == 1 + len(SUBJECTS) * len(EVENTS)
+    assert manifest.__connection__() is connection
+    assert connection.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+
+    # a forked process does not use the connection of its parent
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if manifest.__connection__() is not connection
+                 and manifest.get_paths() == sorted(manifest.get_paths()) else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert manifest.__connection__() is connection
+    red2cas.use_manifest(None)
+    manifest.close()
+
+
+def test_cases_manifest_upgrade(tmpdir):
+    import sqlite3
+    manifest_file = str(tmpdir.join('manifest.sqlite'))
+    conn = sqlite3.connect(manifest_file)
+    conn.execute("CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                 "sha1 TEXT NOT NULL, plan_version TEXT, export_name TEXT, updated TEXT NOT NULL)")
+    conn.execute("INSERT INTO files VALUES ('a.csv', 1, 1, 'sha1', 'v1', 'a', '2024-01-01 00:00:00')")
+    conn.commit()
+    conn.close()
+
+    manifest = CasesManifest(manifest_file, str(tmpdir))
+    assert manifest.get_entry(tmpdir.join('a.csv'))['source_hash'] is None
+    tmpdir.join('b.csv').write('b\n')
+    manifest.record(tmpdir.join('b.csv'), source_hash='hash')
+    assert manifest.get_entry(tmpdir.join('b.csv'))['source_hash'] == 'hash'
+    manifest.close()
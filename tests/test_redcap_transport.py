@@ -0,0 +1,157 @@
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import redcap
+import requests
+
+from sibispy.redcap_transport import (RedcapTransport, get_backoff_delay, get_mounted_transport,
+                                     unmount_transport)
+from sibispy.session import Session
+
+TOKEN = 'A' * 32
+
+
+class FlakyRedcapHandler(BaseHTTPRequestHandler):
+    """
+    Answers the first server.failures calls with 503, then returns the
+    number of the call
+    """
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.calls += 1
+            status = 503 if self.server.calls <= self.server.failures else 200
+            body = json.dumps({'count': self.server.calls} if status == 200 else {}).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def redcap_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyRedcapHandler)
+    server.lock = threading.Lock()
+    server.calls = 0
+    server.failures = 2
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_http_session(url, transport):
+    http_session = requests.Session()
+    http_session.mount(url, transport)
+    return http_session
+
+
+def test_backoff_delay():
+    for attempt in range(8):
+        delay = get_backoff_delay(attempt, backoff_factor=2, backoff_max=60)
+        bound = min(60, 2 * 2 ** attempt)
+        assert bound / 2 <= delay <= bound
+
+
+def test_export_is_retried(redcap_server):
+    url = 'http://127.0.0.1:{}/api/'.format(redcap_server.server_address[1])
+    transport = RedcapTransport(max_retries=3, backoff_factor=0.001)
+    response = get_http_session(url, transport).post(
+        url, data={'token': TOKEN, 'content': 'record', 'format': 'json'})
+
+    assert response.status_code == 200
+    assert response.json() == {'count': 3}
+    stats = transport.get_stats()
+    assert (stats['requests'], stats['retries'], stats['failures']) == (1, 2, 0)
+
+
+def test_import_is_not_retried(redcap_server):
+    url = 'http://127.0.0.1:{}/api/'.format(redcap_server.server_address[1])
+    transport = RedcapTransport(max_retries=3, backoff_factor=0.001)
+    response = get_http_session(url, transport).post(
+        url, data={'token': TOKEN, 'content': 'record', 'format': 'json', 'data': '[]'})
+
+    # the server may have applied the import, so the call must not be repeated
+    assert response.status_code == 503
+    assert redcap_server.calls == 1
+    stats = transport.get_stats()
+    assert (stats['requests'], stats['retries'], stats['failures']) == (1, 0, 1)
+
+
+def test_import_is_retried_on_connect_error():
+    # a port nobody listens on
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    url = 'http://127.0.0.1:{}/api/'.format(port)
+
+    transport = RedcapTransport(max_retries=2, backoff_factor=0.001)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        get_http_session(url, transport).post(url, data={'token': TOKEN, 'content': 'record', 'data': '[]'})
+    stats = transport.get_stats()
+    assert (stats['requests'], stats['retries'], stats['failures']) == (1, 2, 1)
+
+
+@pytest.fixture
+def mounted_url(redcap_server):
+    url = 'http://127.0.0.1:{}/api/'.format(redcap_server.server_address[1])
+    yield url
+    # the transport is process-wide, so it must not leak into other tests
+    unmount_transport(url)
+    assert get_mounted_transport(url) is None
+
+
+def test_session_projects_share_transport(redcap_server, mounted_url):
+    url = mounted_url
+    session = Session()
+    transport = session.__get_redcap_transport__({'server': url, 'retry_backoff': 0.001})
+    assert get_mounted_transport(url) is transport
+
+    # PyCap projects send their calls through the transport of the session
+    for token in ['A' * 32, 'B' * 32]:
+        project = redcap.Project(url, token)
+        assert project.export_project_info() == {'count': redcap_server.calls}
+
+    stats = session.get_redcap_transport_stats()
+    assert (stats['requests'], stats['retries'], stats['failures']) == (2, 2, 0)
+
+    # the transport is process-wide: another session of the server reuses it
+    # (with the settings of the first session) and shares its stats
+    other = Session()
+    assert other.__get_redcap_transport__({'server': url, 'max_retries': 0}) is transport
+    assert redcap.Project(url, TOKEN).export_project_info() == {'count': 5}
+    assert other.get_redcap_transport_stats() == session.get_redcap_transport_stats()
+    assert session.get_redcap_transport_stats()['requests'] == 3
+
+
+def test_failed_batch_is_reported(monkeypatch):
+    from sibispy import sibislogger as slog
+    from sibispy import redcap_compute_summary_scores as red_scores
+    import pandas
+
+    class FailingProject(object):
+        def export_records(self, **kwargs):
+            raise requests.exceptions.ConnectionError('Connection reset by peer')
+
+    slog.init_log(False, False, 'test_redcap_transport', 'test_redcap_transport', None)
+    messages = []
+    monkeypatch.setattr(slog, 'info', lambda uid, message, **kwargs: messages.append(message))
+    scores = red_scores.redcap_compute_summary_scores()
+    scores._redcap_compute_summary_scores__rc_summary = FailingProject()
+    record_ids = pandas.DataFrame(
+        {'x_complete': [2, 2]},
+        index=pandas.MultiIndex.from_tuples([('A-00001-F-1', 'baseline_visit_arm_1'),
+                                             ('A-00002-M-2', 'baseline_visit_arm_1')]))
+
+    # the batch is not dropped silently: the fetch fails and the error is logged
+    assert scores.__fetch_records__(record_ids, ['study_id']) is None
+    assert messages == ["ERROR: failed to export records from REDCap"]
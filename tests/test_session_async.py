@@ -0,0 +1,122 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import redcap
+
+from sibispy import sibislogger as slog
+from sibispy.session import Session
+
+TOKEN = 'A' * 32
+METADATA = [
+    {'field_name': 'study_id', 'form_name': 'visit', 'field_type': 'text'},
+    {'field_name': 'visit_date', 'form_name': 'visit', 'field_type': 'text'},
+]
+
+
+class StandInRedcapHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the REDCap api: exports and imports records of a
+    single, non-longitudinal project
+    """
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers['Content-Length'])
+        payload = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(server.delay)
+
+        status = 200
+        if payload.get('token') != TOKEN:
+            status, content = 403, {'error': 'You do not have permissions to use the API'}
+        elif payload['content'] == 'metadata':
+            content = METADATA
+        elif payload['content'] == 'record' and 'data' in payload:
+            records = json.loads(payload['data'])
+            if any('bad_field' in rec for rec in records):
+                status, content = 400, {'error': 'The following fields were not found in the project: bad_field'}
+            else:
+                server.records.update({rec['study_id']: rec for rec in records})
+                content = {'count': len(records)}
+        elif payload['content'] == 'record':
+            ids = [value for key, value in payload.items() if key.startswith('records[')]
+            content = [rec for key, rec in sorted(server.records.items()) if not ids or key in ids]
+        else:
+            status, content = 400, {'error': 'unsupported content'}
+
+        with server.lock:
+            server.active -= 1
+
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def redcap_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInRedcapHandler)
+    server.lock = threading.Lock()
+    server.active = 0
+    server.max_active = 0
+    server.delay = 0.05
+    server.records = {'A-00000-F-0': {'study_id': 'A-00000-F-0', 'visit_date': '2020-01-01'}}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def session(redcap_server):
+    slog.init_log(False, False, 'test_session_async', 'test_session_async', None)
+    url = 'http://127.0.0.1:{}/api/'.format(redcap_server.server_address[1])
+    session = Session()
+    session.api['data_entry'] = redcap.Project(url, TOKEN)
+    session.api['import_laptops'] = redcap.Project(url, 'B' * 32)
+    session.__active_redcap_project__ = 'data_entry'
+    return session
+
+
+def test_async_export_and_import(session, redcap_server):
+    async def run():
+        records = [{'study_id': 'B-{:05d}-F-0'.format(i), 'visit_date': '2021-01-01'} for i in range(12)]
+        imports = await asyncio.gather(*[session.aredcap_import_records([rec]) for rec in records])
+        exports = await asyncio.gather(*[
+            session.aredcap_export_records(records=[rec['study_id']]) for rec in records
+        ])
+        return imports, exports
+
+    imports, exports = asyncio.run(run())
+    assert imports == [{'count': 1}] * 12
+    assert [export[0]['study_id'] for export in exports] == ['B-{:05d}-F-0'.format(i) for i in range(12)]
+    # requests overlapped but stayed within the per-project limit
+    assert 1 < redcap_server.max_active <= 4
+
+
+def test_async_errors_are_logged(session, capsys):
+    async def run():
+        return await asyncio.gather(
+            session.aredcap_export_records('import_laptops'),
+            session.aredcap_import_records([{'study_id': 'C', 'bad_field': 1}], error_label='test_async_import'),
+        )
+
+    export, imported = asyncio.run(run())
+    assert export is None
+    assert imported is None
+    out = capsys.readouterr().out
+    assert 'ERROR: exporting data from REDCap failed' in out
+    assert 'test_async_import' in out
@@ -0,0 +1,83 @@
+import threading
+
+import pandas as pd
+import pytest
+import requests
+
+from sibispy import sibislogger as slog
+from sibispy.session import Session
+
+
+class MockRedcapProject():
+    def __init__(self, fail_batches=()):
+        self.def_field = 'study_id'
+        self.fail_batches = set(fail_batches)
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def import_records(self, batch, **kwargs):
+        first = batch.iloc[0]['study_id'] if isinstance(batch, pd.DataFrame) else batch[0]['study_id']
+        with self.lock:
+            self.batches.append(first)
+        if first in self.fail_batches:
+            raise requests.exceptions.RequestException(
+                str({'error': 'failed batch starting with ' + first}))
+        return {'count': len(batch)}
+
+
+@pytest.fixture
+def logger():
+    slog.init_log(False, False, 'test_session_import', 'test_session_import', None)
+    return slog
+
+
+def get_session(red_api):
+    session = Session()
+    session.api['data_entry'] = red_api
+    session.__active_redcap_project__ = 'data_entry'
+    return session
+
+
+def get_records(num_records):
+    ids = ['X-{:05d}-M-0'.format(i) for i in range(num_records)]
+    return pd.DataFrame({
+        'study_id': ids,
+        'redcap_event_name': ['baseline_visit_arm_1'] * num_records,
+        'score': range(num_records),
+    }).set_index(['study_id', 'redcap_event_name'])
+
+
+@pytest.mark.parametrize("max_workers", [None, 1, 4])
+def test_import_record_batches(logger, max_workers):
+    red_api = MockRedcapProject()
+    session = get_session(red_api)
+
+    response = session.redcap_import_record('label', None, None, None, get_records(1234),
+                                            max_workers=max_workers)
+    assert response == {'count': 1234}
+    assert sorted(red_api.batches) == ['X-00000-M-0', 'X-00500-M-0', 'X-01000-M-0']
+
+
+def test_import_record_concurrent_failure(logger, capsys):
+    red_api = MockRedcapProject(fail_batches=['X-00500-M-0', 'X-01000-M-0'])
+    session = get_session(red_api)
+    failures = slog.metrics.get_counter('sibis_redcap_import_failures_total', api_type='data_entry')
+
+    response = session.redcap_import_record('label', None, None, None, get_records(1001),
+                                            max_workers=4)
+    assert response is None
+    # all batches are submitted and each failing batch is reported on its own
+    assert len(red_api.batches) == 3
+    assert slog.metrics.get_counter('sibis_redcap_import_failures_total', api_type='data_entry') == failures + 2
+    out = capsys.readouterr().out
+    assert 'failed batch starting with X-00500-M-0' in out
+    # the last batch only holds a single record, so it is reported with its key
+    assert 'X-01000-M-0_baseline_visit_arm_1_label' in out
+
+
+def test_import_record_sequential_failure_stops(logger):
+    red_api = MockRedcapProject(fail_batches=['X-00000-M-0'])
+    session = get_session(red_api)
+
+    assert session.redcap_import_record('label', None, None, None, get_records(1234)) is None
+    assert red_api.batches == ['X-00000-M-0']
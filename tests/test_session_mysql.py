@@ -0,0 +1,426 @@
+import warnings
+from io import StringIO
+
+import pandas as pd
+import pytest
+import redcap
+from sqlalchemy import create_engine, event, text
+
+from sibispy import sibislogger as slog
+from sibispy import redcap_locking_data
+from sibispy import utils
+from sibispy.session import Session
+
+
+def create_redcap_db(url="sqlite://"):
+    """
+    In-memory stand-in for the tables of the REDCap MySQL database used by
+    Session and redcap_locking_data
+    """
+    engine = create_engine(url)
+    pd.DataFrame({
+        'project_id': [19, 20],
+        'project_name': ['ncanda_subject_visit_log', 'ncanda_import_laptops'],
+    }).to_sql('redcap_projects', engine, index=False)
+    pd.DataFrame({
+        'arm_id': [30, 31, 40],
+        'project_id': [19, 19, 20],
+        'arm_num': [1, 2, 1],
+        'arm_name': ['Standard Protocol', 'Recovery Protocol', 'Arm 1'],
+    }).to_sql('redcap_events_arms', engine, index=False)
+    pd.DataFrame({
+        'event_id': [100, 101, 200, 300],
+        'arm_id': [30, 30, 31, 40],
+        'descrip': ['Baseline visit', '1y visit', 'Recovery day 1', 'Baseline visit'],
+    }).to_sql('redcap_events_metadata', engine, index=False)
+    pd.DataFrame({
+        'project_id': [19] * 4 + [20],
+        'event_id': [100, 100, 100, 101, 300],
+        'record': ['A-00001-F-1', 'A-00001-F-1', 'A-00002-M-1', 'A-00001-F-1', 'A-00001-F-1'],
+        'field_name': ['study_id', 'visit_date', 'study_id', 'study_id', 'study_id'],
+        'value': ['A-00001-F-1', '2020-01-01', 'A-00002-M-1', 'A-00001-F-1', 'A-00001-F-1'],
+        'instance': [None] * 5,
+    }).to_sql('redcap_data', engine, index=False)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE redcap_locking_data (ld_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "project_id INTEGER, record TEXT, event_id INTEGER, form_name TEXT, "
+            "username TEXT, timestamp DATETIME)"))
+    pd.DataFrame({
+        'ld_id': [1, 2, 3, 4, 5],
+        'project_id': [19, 19, 19, 19, 20],
+        'record': ['A-00001-F-1', 'A-00001-F-1', 'A-00002-M-1', 'A-00001-F-1', 'A-00001-F-1'],
+        'event_id': [100, 100, 100, 101, 300],
+        'form_name': ['stroop', 'asr', 'stroop', 'stroop', 'stroop'],
+        'username': ['admin'] * 5,
+        'timestamp': ['2020-01-0{} 10:00:00'.format(i) for i in range(1, 6)],
+    }).to_sql('redcap_locking_data', engine, index=False, if_exists='append')
+
+    engine.queries = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: engine.queries.append(statement))
+    return engine
+
+
+@pytest.fixture
+def session(tmpdir):
+    slog.init_log(False, False, 'test_session_mysql', 'test_session_mysql', None)
+    tmpdir.mkdir('operations').join('sibis_sys_config.yml').write(
+        'redcap_to_casesdir:\n'
+        '  event_dictionary:\n'
+        '    baseline_visit_arm_1: "\'standard\', \'baseline\'"\n'
+        '    1y_visit_arm_1: "\'standard\', \'followup_1y\'"\n')
+    config_file = tmpdir.join('.sibis-general-config.yml')
+    config_file.write('analysis_dir: {0}\ncache_dir: {0}/cache\n'
+                      'redcap:\n  user: locker\n  base_address: https://redcap.test/\n'.format(tmpdir))
+    session = Session()
+    session._Session__config_usr_data.configure(str(config_file))
+    session.api['redcap_mysql_db'] = create_redcap_db()
+    return session
+
+
+@pytest.fixture
+def red_lock(session):
+    red_lock = redcap_locking_data.redcap_locking_data()
+    red_lock.configure(session)
+    return red_lock
+
+
+def get_locks(session):
+    return pd.read_sql_query(
+        'SELECT record, event_id, form_name, username FROM redcap_locking_data ORDER BY ld_id',
+        session.api['redcap_mysql_db'])
+
+
+def test_table_records_filtered_in_db(session):
+    engine = session.api['redcap_mysql_db']
+    records = session.get_mysql_table_records(
+        'redcap_locking_data', 'ncanda_subject_visit_log', 'Standard Protocol', 'Baseline visit',
+        name_of_form='stroop')
+    assert records.ld_id.tolist() == [1, 3]
+    assert 'WHERE' in engine.queries[-1] and 'stroop' not in engine.queries[-1]
+
+    records = session.get_mysql_table_records(
+        'redcap_locking_data', 'ncanda_subject_visit_log', subject_id='A-00001-F-1',
+        columns=['ld_id', 'form_name'])
+    assert list(records.columns) == ['ld_id', 'form_name']
+    assert records.ld_id.tolist() == [1, 2, 4]
+
+    records = session.get_mysql_table_records(
+        'redcap_locking_data', 'ncanda_subject_visit_log', subject_id=['A-00001-F-1', 'A-00002-M-1'],
+        columns=['ld_id'])
+    assert records.ld_id.tolist() == [1, 2, 3, 4]
+
+    with pytest.raises(KeyError):
+        session.get_mysql_table_records('redcap_locking_data', 'unknown_project')
+
+
+def test_table_records_match_dataframe_path(session):
+    engine = session.api['redcap_mysql_db']
+    snapshot = pd.read_sql_table('redcap_locking_data', engine)
+    for kwargs in [dict(), dict(subject_id='A-00001-F-1'), dict(name_of_form='asr'),
+                   dict(arm_name='Standard Protocol', event_descrip='1y visit')]:
+        pushed_down = session.get_mysql_table_records(
+            'redcap_locking_data', 'ncanda_subject_visit_log', **kwargs)
+        in_memory = session.get_mysql_table_records_from_dataframe(
+            snapshot, 'ncanda_subject_visit_log', **kwargs)
+        # sqlite only reports the column type to read_sql_table
+        pushed_down['timestamp'] = pd.to_datetime(pushed_down.timestamp)
+        pd.testing.assert_frame_equal(pushed_down, in_memory.reset_index(drop=True))
+
+
+def test_lock_forms(session, red_lock, tmpdir):
+    engine = session.api['redcap_mysql_db']
+    outfile = str(tmpdir.join('locked_records.csv'))
+    num_queries = len(engine.queries)
+    counts = red_lock.lock_forms('ncanda_subject_visit_log', 'Standard Protocol',
+                                 ['Baseline visit', '1y visit'], ['stroop', 'asr', 'cnp'],
+                                 outfile=outfile)
+    assert counts == {'stroop': 3, 'asr': 3, 'cnp': 3}
+    # the number of statements does not depend on the number of subjects or forms
+    assert len(engine.queries) - num_queries <= 10
+
+    locks = get_locks(session)
+    # the lock of the other project is untouched
+    assert locks.iloc[0].tolist() == ['A-00001-F-1', 300, 'stroop', 'admin']
+    locks = locks.iloc[1:]
+    assert len(locks) == 9 and set(locks.username) == {'locker'}
+    assert sorted(zip(locks.record, locks.event_id, locks.form_name))[:3] == [
+        ('A-00001-F-1', 100, 'asr'), ('A-00001-F-1', 100, 'cnp'), ('A-00001-F-1', 100, 'stroop')]
+    with open(outfile) as fd:
+        assert fd.read().split() == ['A-00001-F-1', 'A-00002-M-1']
+
+
+def test_lock_and_unlock_subjects(session, red_lock):
+    counts = red_lock.lock_forms('ncanda_subject_visit_log', 'Standard Protocol',
+                                 ['Baseline visit'], ['cnp'], subject_ids=['A-00002-M-1'])
+    assert counts == {'cnp': 1}
+    assert red_lock.lock_forms('ncanda_subject_visit_log', 'Standard Protocol',
+                               ['Baseline visit'], ['cnp'], subject_ids=[]) == {'cnp': 0}
+
+    counts = red_lock.unlock_forms('ncanda_subject_visit_log', 'Standard Protocol',
+                                   ['Baseline visit', '1y visit'], ['stroop', 'cnp', 'asr'],
+                                   subject_ids=['A-00001-F-1', 'A-00002-M-1'])
+    assert counts == {'stroop': 3, 'cnp': 1, 'asr': 1}
+    assert get_locks(session).record.tolist() == ['A-00001-F-1']
+
+    assert red_lock.lock_form('ncanda_subject_visit_log', 'Standard Protocol', '1y visit', 'asr') == 1
+    assert red_lock.unlock_form('ncanda_subject_visit_log', 'Standard Protocol', '1y visit', 'asr',
+                                subject_id='A-00001-F-1') == 1
+    assert red_lock.unlock_form('ncanda_subject_visit_log', 'Standard Protocol', '1y visit', 'asr') == 0
+
+
+def test_lock_forms_sync(session, red_lock):
+    engine = session.api['redcap_mysql_db']
+    # duplicate lock and lock of a record that no longer exists
+    pd.DataFrame({
+        'project_id': [19, 19], 'record': ['A-00001-F-1', 'A-00003-F-1'], 'event_id': [100, 100],
+        'form_name': ['stroop', 'stroop'], 'username': ['admin'] * 2,
+        'timestamp': ['2020-01-06 10:00:00', '2020-01-07 10:00:00'],
+    }).to_sql('redcap_locking_data', engine, index=False, if_exists='append')
+
+    counts = red_lock.lock_forms('ncanda_subject_visit_log', 'Standard Protocol',
+                                 ['Baseline visit', '1y visit'], ['stroop'], sync=True)
+    assert counts == {'stroop': 3}
+    locks = pd.read_sql_query('SELECT ld_id, record, event_id, username FROM redcap_locking_data '
+                              'WHERE form_name = "stroop" ORDER BY ld_id', engine)
+    # the existing locks (and their timestamps) are kept, nothing else is inserted
+    assert locks.ld_id.tolist() == [1, 3, 4, 5]
+    assert set(locks.username) == {'admin'}
+
+    # the form that was not locked yet is only added
+    assert red_lock.lock_form('ncanda_subject_visit_log', 'Standard Protocol', 'Baseline visit', 'asr',
+                              sync=True) == 2
+    assert get_locks(session).form_name.value_counts()['asr'] == 2
+    num_queries = len(engine.queries)
+    assert red_lock.lock_form('ncanda_subject_visit_log', 'Standard Protocol', 'Baseline visit', 'asr',
+                              sync=True) == 2
+    # unchanged locks are neither deleted nor re-inserted
+    assert all(query.startswith('SELECT') for query in engine.queries[num_queries:])
+    assert get_locks(session).form_name.value_counts()['asr'] == 2
+
+
+def test_report_locked_forms_batch(session, red_lock):
+    enriched = red_lock.report_locked_forms_all('ncanda_subject_visit_log')
+    forms = ['stroop', 'asr', 'cnp']
+    report = red_lock.report_locked_forms_batch('ncanda_subject_visit_log', forms, enriched,
+                                                xnat_ids={'A-00001-F-1': 'NCANDA_S00001'})
+    assert report.index.names == ['subject', 'arm', 'visit']
+    assert list(report.columns) == forms
+    assert sorted(report.index.tolist()) == [('A-00002-M-1', 'standard', 'baseline'),
+                                     ('NCANDA_S00001', 'standard', 'baseline'),
+                                     ('NCANDA_S00001', 'standard', 'followup_1y')]
+    row = report.loc[('NCANDA_S00001', 'standard', 'baseline')]
+    assert str(row.stroop) == '2020-01-01 10:00:00' and str(row.asr) == '2020-01-02 10:00:00'
+    assert pd.isnull(row.cnp)
+
+    # the per-subject report is a slice of the batch report
+    single = red_lock.report_locked_forms_from_enriched_lock_table(
+        'A-00001-F-1', 'NCANDA_S00001', 'ncanda_subject_visit_log', forms, '1y_visit_arm_1', enriched)
+    assert single.columns.tolist() == ['subject', 'arm', 'visit'] + forms
+    assert single.iloc[0, :3].tolist() == ['NCANDA_S00001', 'standard', 'followup_1y']
+    assert str(single.at[0, 'stroop']) == '2020-01-04 10:00:00'
+    assert pd.isnull(single.at[0, 'asr'])
+
+    # a visit in several arms reports the last lock of each form in table order
+    enriched = pd.DataFrame({
+        'project_id': [19, 19, 19],
+        'record': ['A-00001-F-1'] * 3,
+        'export_arm': ['standard', 'recovery', 'recovery'],
+        'export_event': ['followup_1y'] * 3,
+        'form_name': ['stroop', 'stroop', 'asr'],
+        'timestamp': ['2020-01-05 10:00:00', '2020-01-01 10:00:00', '2020-01-02 10:00:00'],
+    })
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        single = red_lock.report_locked_forms_from_enriched_lock_table(
+            'A-00001-F-1', 'NCANDA_S00001', 'ncanda_subject_visit_log', forms, '1y_visit_arm_1', enriched)
+    assert single.loc[0, forms].tolist()[:2] == ['2020-01-01 10:00:00', '2020-01-02 10:00:00']
+    assert pd.isnull(single.at[0, 'cnp'])
+
+    # ... just like the batch report, which reports the visit with the arm of its last lock
+    report = red_lock.report_locked_forms_batch('ncanda_subject_visit_log', forms, enriched)
+    assert report.index.tolist() == [('A-00001-F-1', 'recovery', 'followup_1y')]
+    assert report.iloc[0].tolist()[:2] == single.loc[0, forms].tolist()[:2]
+
+    # the reports follow changes of the lock table
+    enriched.loc[2, 'timestamp'] = '2020-01-06 10:00:00'
+    single = red_lock.report_locked_forms_from_enriched_lock_table(
+        'A-00001-F-1', 'NCANDA_S00001', 'ncanda_subject_visit_log', forms, '1y_visit_arm_1', enriched)
+    assert single.at[0, 'asr'] == '2020-01-06 10:00:00'
+
+
+def test_event_names_cached(session, red_lock, tmpdir):
+    engine = session.api['redcap_mysql_db']
+    event_dict = red_lock.get_event_names_for_ids()
+    assert sorted(zip(event_dict.event_id, event_dict.redcap_event_name, event_dict.export_event.fillna(''))) == [
+        (100, 'baseline_visit_arm_1', 'baseline'), (101, '1y_visit_arm_1', 'followup_1y'),
+        (200, 'recovery_day_1_arm_2', ''), (300, 'baseline_visit_arm_1', 'baseline')]
+
+    # a second instance only checks whether events or arms were added
+    num_queries = len(engine.queries)
+    cached = redcap_locking_data.redcap_locking_data()
+    cached.configure(session)
+    assert len(engine.queries) - num_queries == 1
+    pd.testing.assert_frame_equal(cached.get_event_names_for_ids(), event_dict)
+
+    pd.DataFrame({'event_id': [301], 'arm_id': [31], 'descrip': ['Recovery day-2']}).to_sql(
+        'redcap_events_metadata', engine, index=False, if_exists='append')
+    refreshed = redcap_locking_data.redcap_locking_data()
+    refreshed.configure(session)
+    assert 'recovery_day2_arm_2' in refreshed.get_event_names_for_ids().redcap_event_name.tolist()
+
+    # another database does not read the cached names of the first one
+    other_db = create_redcap_db('sqlite:///{0}'.format(tmpdir.join('other.db')))
+    with other_db.begin() as conn:
+        conn.execute(text("UPDATE redcap_events_metadata SET descrip = 'Year 1' WHERE event_id = 101"))
+        # same largest event and arm ids
+        conn.execute(text("INSERT INTO redcap_events_metadata VALUES (301, 31, 'Recovery day-2')"))
+    session.api['redcap_mysql_db'] = other_db
+    other = redcap_locking_data.redcap_locking_data()
+    other.configure(session)
+    event_dict = other.get_event_names_for_ids()
+    assert event_dict.loc[event_dict.event_id == 101, 'redcap_event_name'].tolist() == ['year_1_arm_1']
+
+
+def test_redcap_link_builder(session):
+    class RedcapProject():
+        redcap_version = '13.1.2'
+
+    session.api['data_entry'] = RedcapProject()
+    session.__active_redcap_project__ = 'data_entry'
+    engine = session.api['redcap_mysql_db']
+
+    num_queries = len(engine.queries)
+    for idx in range(1000):
+        subject_id = 'A-{:05d}-F-1'.format(idx)
+        address = session.get_formattable_redcap_form_address(19, 'baseline_visit_arm_1', subject_id, 'stroop')
+        assert address == ('https://redcap.test/redcap_v13.1.2/DataEntry/index.php'
+                           '?pid=19&id={}&event_id=100&page=stroop'.format(subject_id))
+    # only the id tables were read
+    assert len(engine.queries) - num_queries == 3
+
+    address = session.get_formattable_redcap_form_address(19, '1y_visit_arm_1', name_of_form='asr')
+    assert address % 'A-00001-F-1' == ('https://redcap.test/redcap_v13.1.2/DataEntry/index.php'
+                                       '?pid=19&id=A-00001-F-1&event_id=101&page=asr')
+    assert session.get_formattable_redcap_subject_address(19, 2) == \
+        'https://redcap.test/redcap_v13.1.2/DataEntry/record_home.php?pid=19&arm=2&id=%s'
+
+
+class FakeRedcapProject(redcap.Project):
+    """
+    PyCap project of ncanda_subject_visit_log whose API serves the metadata
+    (as served to the metadata cache) and the records of API_EXPORT
+    """
+    def __init__(self):
+        super().__init__('https://redcap.example.org/api/', '0' * 32)
+
+        def field(name, form, field_type='text', choices='', validation=''):
+            return dict(field_name=name, form_name=form, field_type=field_type,
+                        select_choices_or_calculations=choices,
+                        text_validation_type_or_show_slider_number=validation)
+
+        self.api_metadata = [
+            field('study_id', 'visit'),
+            field('visit_date', 'visit', validation='date_ymd'),
+            field('visit_notes', 'visit', 'notes'),
+            field('race', 'demographics', 'checkbox', '1, White | 2, Black | -9, Unknown'),
+            field('age', 'demographics', validation='integer'),
+            field('age_note', 'demographics', 'descriptive'),
+        ]
+
+    def _call_api(self, payload, return_type, file=None):
+        if payload['content'] == 'metadata':
+            return self.api_metadata
+        if payload['content'] == 'formEventMapping':
+            return self.export_instrument_event_mappings()
+        assert payload['content'] == 'record' and payload['format'] == 'csv'
+        return API_EXPORT
+
+    def export_version(self):
+        return '13.1.0'
+
+    def export_project_info(self):
+        return dict(project_id=19)
+
+    def export_logging(self, **kwargs):
+        return []
+
+    def export_field_names(self):
+        names = [dict(original_field_name=name, choice_value='', export_field_name=name)
+                 for name in ['study_id', 'visit_date', 'visit_notes', 'age']]
+        names += [dict(original_field_name='race', choice_value=code, export_field_name=export_name)
+                  for code, export_name in [('1', 'race___1'), ('2', 'race___2'), ('-9', 'race____9')]]
+        return names
+
+    def export_events(self):
+        return [dict(event_name='Baseline visit', arm_num=1, unique_event_name='baseline_visit_arm_1'),
+                dict(event_name='1y visit', arm_num=1, unique_event_name='1y_visit_arm_1'),
+                dict(event_name='Recovery day 1', arm_num=2, unique_event_name='recovery_day_1_arm_2')]
+
+    def export_arms(self):
+        return [dict(arm_num=1, name='Standard Protocol'), dict(arm_num=2, name='Recovery Protocol')]
+
+    def export_instrument_event_mappings(self):
+        return [dict(arm_num=1, unique_event_name='baseline_visit_arm_1', form='visit'),
+                dict(arm_num=1, unique_event_name='baseline_visit_arm_1', form='demographics'),
+                dict(arm_num=1, unique_event_name='1y_visit_arm_1', form='visit')]
+
+
+# export_records(format_type='csv') of the API for the rows of the database
+API_EXPORT = """study_id,redcap_event_name,visit_date,visit_notes,visit_complete,race___1,race___2,race____9,age,demographics_complete
+A-00001-F-1,baseline_visit_arm_1,2020-01-01,"line one
+line, two",2,1,0,1,17,0
+A-00001-F-1,1y_visit_arm_1,2021-01-05,,1,,,,,
+A-00002-M-1,baseline_visit_arm_1,,,0,0,1,0,18,0
+"""
+
+
+def test_mysql_export_matches_api_export(session):
+    engine = session.api['redcap_mysql_db']
+    rows = [
+        ('A-00001-F-1', 100, 'visit_notes', 'line one\nline, two', None),
+        ('A-00001-F-1', 100, 'visit_complete', '2', None),
+        ('A-00001-F-1', 100, 'race', '1', None),
+        ('A-00001-F-1', 100, 'race', '-9', None),
+        ('A-00001-F-1', 100, 'age', '17', None),
+        ('A-00001-F-1', 101, 'visit_date', '2021-01-05', None),
+        ('A-00001-F-1', 101, 'visit_complete', '1', None),
+        ('A-00002-M-1', 100, 'race', '2', None),
+        ('A-00002-M-1', 100, 'age', '18', None),
+        ('A-00002-M-1', 100, 'demographics_complete', '0', None),
+        # neither repeated instances nor data of deleted events are exported
+        ('A-00002-M-1', 100, 'visit_date', '1999-01-01', 2),
+        ('A-00002-M-1', 999, 'study_id', 'A-00002-M-1', None),
+    ]
+    pd.DataFrame(rows, columns=['record', 'event_id', 'field_name', 'value', 'instance']).assign(
+        project_id=19).to_sql('redcap_data', engine, index=False, if_exists='append')
+
+    red_api = FakeRedcapProject()
+    session.api['data_entry'] = red_api
+
+    def api_export(fields=None):
+        return red_api.export_records(
+            format_type='df', df_kwargs=dict(dtype=utils.get_redcap_export_dtypes(red_api, fields)))
+
+    expected = api_export()
+    exported = session.redcap_mysql_export_records('ncanda_subject_visit_log', api_type='data_entry')
+    pd.testing.assert_frame_equal(exported, expected)
+
+    # without the dtypes of the metadata PyCap infers them from the values
+    inferred = red_api.export_records(format_type='df')
+    assert inferred.visit_complete.dtype == 'int64' and exported.visit_complete.dtype == 'float64'
+    pd.testing.assert_frame_equal(exported, inferred, check_dtype=False)
+
+    exported = session.redcap_mysql_export_records(
+        'ncanda_subject_visit_log', fields=['age'], forms=['visit'], api_type='data_entry')
+    columns = ['visit_date', 'visit_notes', 'visit_complete', 'age']
+    pd.testing.assert_frame_equal(exported, api_export(columns)[columns])
+
+    exported = session.redcap_mysql_export_records(
+        'ncanda_subject_visit_log', events=['baseline_visit_arm_1'], records=['A-00002-M-1'],
+        api_type='data_entry')
+    pd.testing.assert_frame_equal(exported, expected.iloc[[2]])
+    assert 'IN' in engine.queries[-1]
+
+    assert session.redcap_mysql_export_records('unknown_project', api_type='data_entry') is None
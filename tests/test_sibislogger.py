@@ -17,6 +17,7 @@ from sibispy import post_issues_to_github as pig
 import os 
 import sys
 import time 
+import json
 import pytest
 
 # if sys.argv.__len__() > 1 : 
@@ -148,4 +149,69 @@ def test_log_different_types(logger):
                             "floatkey":  float(9.87654321)
                           })
   except Exception as e:
-    print("ERROR: failed to log kwargs", str(e))
\ No newline at end of file
+    print("ERROR: failed to log kwargs", str(e))
+
+def test_timer_metrics_without_timer_dir(tmpdir):
+  # takeTimer feeds the metrics registry even if no time log was initiated
+  log = slog.sibisLogging()
+  assert not log.fileTime
+  before = slog.metrics.get_histogram('sibis_timer_seconds', label='no_timer_dir')
+  log.startTimer1()
+  log.takeTimer1('no_timer_dir')
+  log.startTimer2()
+  log.takeTimer2('no_timer_dir')
+  summary = slog.metrics.get_histogram('sibis_timer_seconds', label='no_timer_dir')
+  assert summary['count'] == (before['count'] if before else 0) + 2
+  assert not tmpdir.listdir()
+
+
+def test_metrics_timers_and_counters(tmpdir):
+  metrics = slog.MetricsRegistry()
+
+  @metrics.timer('stage_seconds', stage='decorated')
+  def stage():
+    with metrics.timer('inner_seconds', instrument='asr'):
+      pass
+
+  with metrics.timer('outer_seconds', api_type='data_entry') as outer:
+    stage()
+  assert outer.elapsed >= 0
+
+  # nested timers carry the name of the enclosing timer
+  assert metrics.get_histogram('outer_seconds', api_type='data_entry')['count'] == 1
+  assert metrics.get_histogram('stage_seconds', stage='decorated', parent='outer_seconds')['count'] == 1
+  assert metrics.get_histogram('inner_seconds', instrument='asr', parent='stage_seconds')['count'] == 1
+  assert metrics.get_histogram('inner_seconds', instrument='asr') is None
+
+  metrics.count('exports_total', api_type='data_entry')
+  metrics.count('exports_total', 2, api_type='data_entry')
+  assert metrics.get_counter('exports_total', api_type='data_entry') == 3
+  assert metrics.get_counter('exports_total', api_type='import_laptops') == 0
+
+
+def test_metrics_percentiles_and_flush(tmpdir):
+  metrics = slog.MetricsRegistry()
+  for value in range(1, 101):
+    metrics.observe('latency_seconds', value, api_type='data_entry')
+  metrics.count('failures_total', api_type='data_entry')
+
+  summary = metrics.get_histogram('latency_seconds', api_type='data_entry')
+  assert (summary['count'], summary['sum']) == (100, 5050)
+  assert (summary['p50'], summary['p95'], summary['p99']) == (50, 95, 99)
+
+  prom_file = str(tmpdir.join('metrics.prom'))
+  metrics.flush(prom_file)
+  with open(prom_file) as fd:
+    prom = fd.read().splitlines()
+  assert '# TYPE failures_total counter' in prom
+  assert 'failures_total{api_type="data_entry"} 1' in prom
+  assert 'latency_seconds{api_type="data_entry",quantile="0.95"} 95' in prom
+  assert 'latency_seconds_count{api_type="data_entry"} 100' in prom
+
+  json_file = str(tmpdir.join('metrics.jsonl'))
+  metrics.flush(json_file)
+  metrics.flush(json_file)
+  with open(json_file) as fd:
+    entries = [json.loads(line) for line in fd]
+  assert len(entries) == 4
+  assert entries[1]['name'] == 'latency_seconds' and entries[1]['p99'] == 99
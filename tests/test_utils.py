@@ -9,6 +9,7 @@ from __future__ import print_function
 from builtins import str
 import os
 import sys
+from unittest import mock
 from sibispy import sibislogger as slog
 from sibispy import utils as sutils
 from sibispy import session as sess
@@ -66,3 +67,57 @@ if ecode > 1:
     print("Error: mdb_export: (" + str(ecode) +")", eout)
 
 
+
+
+def test_safe_dataframe_to_csv_digests(tmpdir):
+    import pandas
+
+    df = pandas.DataFrame(dict(subject=['A-00001-F-1'], value=[1.5]))
+    fname = str(tmpdir.join('measures.csv'))
+    assert sutils.safe_dataframe_to_csv(df, str(tmpdir.join('plain.csv')))
+
+    # no digest yet - the existing file is compared and kept
+    assert sutils.safe_dataframe_to_csv(df, fname)
+    mtime = os.stat(fname).st_mtime_ns
+    digests = dict()
+    assert sutils.safe_dataframe_to_csv(df, fname, digests=digests)
+    assert os.stat(fname).st_mtime_ns == mtime
+    assert digests == {fname: sutils.get_csv_digest(open(fname, 'rb').read())}
+
+    # matching digest - the file is not touched at all (neither opened nor
+    # replaced) and the digest is looked up once
+    class CountingDigests(dict):
+        lookups = 0
+
+        def get(self, key, default=None):
+            CountingDigests.lookups += 1
+            return dict.get(self, key, default)
+
+        def __contains__(self, key):
+            CountingDigests.lookups += 1
+            return dict.__contains__(self, key)
+
+    opened = []
+    real_open = open
+    with mock.patch('builtins.open', lambda name, *args, **kwargs: opened.append(name) or real_open(name, *args, **kwargs)), \
+            mock.patch('os.rename', side_effect=AssertionError('file replaced')):
+        assert sutils.safe_dataframe_to_csv(df, fname, digests=CountingDigests(digests))
+    assert not [name for name in opened if str(name).startswith(fname)]
+    assert CountingDigests.lookups == 1
+    assert os.stat(fname).st_mtime_ns == mtime
+
+    # an unknown file is looked up once as well before it is compared
+    CountingDigests.lookups = 0
+    assert sutils.safe_dataframe_to_csv(df, fname, digests=CountingDigests())
+    assert CountingDigests.lookups == 1
+    assert os.stat(fname).st_mtime_ns == mtime
+
+    # unless it was deleted
+    os.remove(fname)
+    assert sutils.safe_dataframe_to_csv(df, fname, digests=digests)
+    assert open(fname, 'rb').read() == open(str(tmpdir.join('plain.csv')), 'rb').read()
+
+    df.loc[0, 'value'] = 2
+    assert sutils.safe_dataframe_to_csv(df, fname, digests=digests)
+    assert open(fname, 'rb').read() == open(str(tmpdir.join('plain.csv')), 'rb').read().replace(b'1.5', b'2.0')
+    assert not os.path.exists(fname + '.new')
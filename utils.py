@@ -23,12 +23,23 @@ date_format_ymd = '%Y-%m-%d'
 # up. This function will also confirm whether the newly created file is
 # different from an already existing file of the same name. Only changed files
 # will be updated.
-def safe_dataframe_to_csv(df, fname, verbose=False):
+#
+# If digests (a mapping of file name to the sha1 of its content, e.g., kept by
+# the writer across runs) is given, the csv is serialized in memory and its
+# hash compared to the stored digest instead - unchanged files that still exist
+# are then neither read nor written (a mapping like
+# cases_manifest.ManifestDigests also drops digests of files modified since).
+# Files without a stored digest are compared to the existing file once and
+# their digest is added to the mapping.
+def safe_dataframe_to_csv(df, fname, verbose=False, digests=None):
     import pandas
     import time
     import filecmp
     import os
 
+    if digests is not None:
+        return __digest_dataframe_to_csv__(df, fname, digests, verbose)
+
     success = False
     retries = 10
     last_e = IOError(-999, "Default error - SHOULD NOT BE REACHED")
@@ -64,6 +75,58 @@ def safe_dataframe_to_csv(df, fname, verbose=False):
 
     return True
 
+def get_csv_digest(content):
+    """
+    sha1 of the (encoded) csv content of a file
+    """
+    return hashlib.sha1(content).hexdigest()
+
+def __digest_dataframe_to_csv__(df, fname, digests, verbose=False):
+    import time
+
+    content = df.to_csv(index=False).encode('utf-8')
+    digest = get_csv_digest(content)
+    # a single lookup (for a manifest, a query and a stat of the file)
+    known_digest = digests.get(fname)
+    if known_digest == digest and os.path.exists(fname):
+        return True
+
+    success = False
+    retries = 10
+    last_e = IOError(-999, "Default error - SHOULD NOT BE REACHED")
+
+    while (not success) and (retries > 0):
+        try:
+            old_content = None
+            if known_digest is None and os.path.exists(fname):
+                with open(fname, 'rb') as fd:
+                    old_content = fd.read()
+
+            if old_content != content:
+                with open(fname + '.new', 'wb') as fd:
+                    fd.write(content)
+                os.rename(fname + '.new', fname)
+                if verbose:
+                    print("Updated", fname)
+            success = True
+        except IOError as e:
+            last_e = e
+            if e.errno == 11:
+                if verbose : 
+                    print("Failed to write to csv ! Retrying in 5s...")
+                time.sleep(5)
+                retries -= 1
+            else:
+                retries = 0
+
+    if not success:
+        slog.info("safe_dataframe_to_csv",
+                  f"ERROR: failed to write file {fname} with errno {last_e.errno}")
+        return False
+
+    digests[fname] = digest
+    return True
+
 def dicom2bxh(dicom_path, bhx_file) :
     cmd = "dicom2bxh " 
     if dicom_path and bhx_file :
@@ -278,6 +341,7 @@ def ncanda_id_lookup(base_id, print_keys=False):
 
 import time
 import pathlib
+from sibispy.redcap_transport import get_backoff_delay
 
 def try_redcap_export_records(project, max_tries=3, timeout=30, **kwargs):
     errors = []
@@ -299,10 +363,88 @@ def try_redcap_export_records(project, max_tries=3, timeout=30, **kwargs):
                     slog_f.write(f"    Called as export_records({', '.join(arg_info)})\n")
                     slog_f.write(f"{exc_str}\n")
             errors.append(ex)
-            time.sleep(timeout)
+            # exponential backoff with jitter, capped at timeout seconds
+            if try_num + 1 < max_tries:
+                time.sleep(get_backoff_delay(try_num, backoff_max=timeout))
 
     raise ExceptionGroup(
         f"Maximum retries exceeded for <redcap_project>.export_records({', '.join(arg_info)})",
         errors
     )  
-    
\ No newline at end of file
+    
+
+def get_redcap_export_dtypes(project, fields=None):
+    """
+    Derive pandas dtypes of exported REDCap fields from the project metadata so
+    that separately exported chunks of a project end up with the same dtypes.
+    Numeric fields (calculations, sliders, yes/no, checkboxes, completion
+    status, numeric text and coded fields with numeric codes) are float64,
+    everything else is read as string.
+    """
+    numeric_validations = ('number', 'integer')
+    dtypes = dict()
+    forms = set()
+    for field in project.metadata:
+        field_name = field['field_name']
+        if field_name == project.def_field:
+            continue
+        forms.add(field['form_name'])
+        if fields and field_name not in fields and field['form_name'] + '_complete' not in fields:
+            continue
+
+        field_type = field['field_type']
+        validation = field['text_validation_type_or_show_slider_number'] or ''
+        if field_type == 'checkbox':
+            for choice in field['select_choices_or_calculations'].split('|'):
+                code = choice.split(',')[0].strip().lower()
+                dtypes['%s___%s' % (field_name, code)] = 'float64'
+                dtypes['%s___%s' % (field_name, code.replace('-', '_'))] = 'float64'
+        elif field_type in ['calc', 'slider', 'yesno', 'truefalse']:
+            dtypes[field_name] = 'float64'
+        elif field_type in ['radio', 'dropdown']:
+            codes = [choice.split(',')[0].strip()
+                     for choice in field['select_choices_or_calculations'].split('|')]
+            if all(re.match(r'^-?[0-9]+(\.[0-9]+)?$', code) for code in codes):
+                dtypes[field_name] = 'float64'
+            else:
+                dtypes[field_name] = 'str'
+        elif field_type == 'descriptive':
+            continue
+        elif field_type == 'text' and validation.startswith(numeric_validations):
+            dtypes[field_name] = 'float64'
+        else:
+            dtypes[field_name] = 'str'
+
+    for form in forms:
+        dtypes[form + '_complete'] = 'float64'
+
+    return dtypes
+
+
+def redcap_export_records_chunked(project, chunk_records=500, max_tries=3, timeout=30, **kwargs):
+    """
+    Generator version of try_redcap_export_records: the records to export are
+    split into chunks of chunk_records record ids, each chunk is exported (and
+    retried) on its own and yielded. When exporting DataFrames, the dtypes are
+    derived from the project metadata so that all chunks are consistent.
+    """
+    records = kwargs.pop('records', None)
+    if records is None:
+        id_select = dict(fields=[project.def_field], format_type='json')
+        for key in ['events', 'filter_logic', 'date_begin', 'date_end']:
+            if kwargs.get(key) is not None:
+                id_select[key] = kwargs[key]
+        id_records = try_redcap_export_records(project, max_tries, timeout, **id_select)
+        # unique ids in the order returned by REDCap
+        records = list(dict.fromkeys(rec[project.def_field] for rec in id_records))
+
+    if kwargs.get('format_type') == 'df':
+        df_kwargs = dict(kwargs.get('df_kwargs') or {})
+        dtypes = get_redcap_export_dtypes(project, kwargs.get('fields'))
+        dtypes.update(df_kwargs.get('dtype', {}))
+        df_kwargs['dtype'] = dtypes
+        kwargs['df_kwargs'] = df_kwargs
+
+    for start in range(0, len(records), chunk_records):
+        yield try_redcap_export_records(project, max_tries, timeout,
+                                        records=records[start:start + chunk_records], **kwargs)